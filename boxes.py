@@ -0,0 +1,115 @@
+import sys
+import json
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import database
+
+SOURCE_LABEL: str = 'label'
+SOURCE_PREDICTION: str = 'prediction'
+
+BoxRow = Tuple[int, int, float, float, float, float, Optional[float], str, str]
+
+def create_boxes_table(conn: sqlite3.Connection) -> None:
+    """One row per bounding box, labels have model = '' so it can be part of the indexes.
+
+    A new table is filled from the labels and predictions already stored.
+    """
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS boxes (
+            id INTEGER PRIMARY KEY,
+            image_id INTEGER NOT NULL,
+            class_id INTEGER NOT NULL,
+            x REAL NOT NULL,
+            y REAL NOT NULL,
+            w REAL NOT NULL,
+            h REAL NOT NULL,
+            conf REAL,
+            source TEXT NOT NULL,
+            model TEXT NOT NULL DEFAULT '',
+            FOREIGN KEY (image_id) REFERENCES images(id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_boxes_image ON boxes(image_id, source, model)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_boxes_class ON boxes(source, model, class_id, image_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_boxes_size ON boxes(source, model, class_id, w, h, image_id)')
+    if 'boxes' not in tables:
+        fill_boxes(conn)
+    conn.commit()
+
+def box_coordinates(box: Dict[str, Any]) -> List[float]:
+    # the UI and exports use 'coordinates', older ingests wrote 'bbox'
+    return box['coordinates'] if 'coordinates' in box else box['bbox']
+
+def class_id_for(box: Dict[str, Any], class_names: Sequence[str] = ()) -> Optional[int]:
+    """Numeric class of a label or prediction, predictions may only carry the class name"""
+    if 'class_id' in box:
+        return int(box['class_id'])
+    value = box.get('class')
+    if isinstance(value, str):
+        if value in class_names:
+            return list(class_names).index(value)
+        return int(value) if value.isdigit() else None
+    return int(value) if value is not None else None
+
+def box_rows(image_id: int, boxes: Iterable[Dict[str, Any]], source: str, model: str = '', class_names: Sequence[str] = ()) -> List[BoxRow]:
+    rows: List[BoxRow] = []
+    for box in boxes:
+        class_id = class_id_for(box, class_names)
+        if class_id is None: continue
+        x, y, w, h = box_coordinates(box)[:4]
+        rows.append((image_id, class_id, x, y, w, h, box.get('conf'), source, model))
+    return rows
+
+def replace_boxes(conn: sqlite3.Connection, image_id: int, boxes: Iterable[Dict[str, Any]], source: str, model: str = '', class_names: Sequence[str] = ()) -> None:
+    """Replace one image's boxes for a source and model, the caller commits"""
+    conn.execute('DELETE FROM boxes WHERE image_id = ? AND source = ? AND model = ?', (image_id, source, model))
+    conn.executemany('''
+        INSERT INTO boxes (image_id, class_id, x, y, w, h, conf, source, model)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', box_rows(image_id, boxes, source, model, class_names))
+
+def replace_label_boxes(conn: sqlite3.Connection, image_id: int, labels: Iterable[Dict[str, Any]]) -> None:
+    replace_boxes(conn, image_id, labels, SOURCE_LABEL)
+
+def class_names_for_image(conn: sqlite3.Connection, image_id: int) -> List[str]:
+    row = conn.execute('''
+        SELECT r.label_classes FROM root_dirs AS r JOIN images AS i ON r.id = i.root_dir_id WHERE i.id = ?
+    ''', (image_id,)).fetchone()
+    return row[0].split(" ") if row and row[0] else []
+
+def replace_prediction_boxes(conn: sqlite3.Connection, model: str, file: str, predictions: Iterable[Dict[str, Any]]) -> None:
+    """Replace the prediction boxes of model for the image named file, if the image is in the db"""
+    row = conn.execute('SELECT id FROM images WHERE file = ?', (file,)).fetchone()
+    if row is None:
+        return
+    predictions = list(predictions)
+    class_names = class_names_for_image(conn, row[0]) if any('class_id' not in p for p in predictions) else []
+    replace_boxes(conn, row[0], predictions, SOURCE_PREDICTION, model, class_names)
+
+def fill_boxes(conn: sqlite3.Connection) -> None:
+    """Insert the boxes of every stored label and prediction, the caller commits"""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if 'labels' in tables:
+        for image_id, labels_json in conn.execute('SELECT image_id, labels_json FROM labels').fetchall():
+            labels = json.loads(labels_json) if labels_json else []
+            if isinstance(labels, list):
+                replace_label_boxes(conn, image_id, labels)
+    if 'model_predictions' in tables and 'images' in tables:
+        for model, file, predictions_json in conn.execute('SELECT model, file, predictions FROM model_predictions').fetchall():
+            replace_prediction_boxes(conn, model, file, json.loads(predictions_json) if predictions_json else [])
+
+def rebuild_boxes(conn: sqlite3.Connection) -> None:
+    """Refill the boxes table from labels and model_predictions"""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    create_boxes_table(conn)
+    if 'boxes' in tables:
+        conn.execute('DELETE FROM boxes')
+        fill_boxes(conn)
+        conn.commit()
+
+if __name__ == "__main__":
+    conn = database.connect(sys.argv[1] if len(sys.argv) > 1 else database.DB_PATH)
+    rebuild_boxes(conn)
+    print(f"boxes: {conn.execute('SELECT COUNT(*) FROM boxes').fetchone()[0]}")
+    conn.close()
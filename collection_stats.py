@@ -0,0 +1,207 @@
+import sys
+import json
+import sqlite3
+from typing import Any, Dict, Iterator, List
+import database
+
+# an image counts as labeled when its labels_json holds at least one box
+LABELED_SQL: str = "({0}.labels_json IS NOT NULL AND {0}.labels_json NOT IN ('[]', '{{}}'))"
+
+# Triggers keep the stats current for every writer (ingest scripts, the label
+# UI, prediction jobs) at the cost of one primary key upsert per written row.
+# They are grouped by the table they fire on, a table that does not exist yet
+# gets its triggers the next time create_collection_stats runs.
+TRIGGERS: Dict[str, List[str]] = {
+    'images': [
+        '''CREATE TRIGGER IF NOT EXISTS collection_stats_images_insert AFTER INSERT ON images BEGIN
+            INSERT INTO collection_stats (root_dir_id, image_count, labeled_count, cover_image_id)
+            VALUES (NEW.root_dir_id, 1, 0, NEW.id)
+            ON CONFLICT(root_dir_id) DO UPDATE SET
+                image_count = image_count + 1,
+                cover_image_id = COALESCE(MIN(cover_image_id, NEW.id), NEW.id);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS collection_stats_images_delete AFTER DELETE ON images BEGIN
+            UPDATE collection_stats SET
+                image_count = image_count - 1,
+                cover_image_id = CASE WHEN cover_image_id = OLD.id
+                    THEN (SELECT MIN(id) FROM images WHERE root_dir_id = OLD.root_dir_id)
+                    ELSE cover_image_id END
+            WHERE root_dir_id = OLD.root_dir_id;
+        END''',
+    ],
+    'labels': [
+        f'''CREATE TRIGGER IF NOT EXISTS collection_stats_labels_insert AFTER INSERT ON labels
+        WHEN {LABELED_SQL.format('NEW')} BEGIN
+            UPDATE collection_stats SET labeled_count = labeled_count + 1
+            WHERE root_dir_id = (SELECT root_dir_id FROM images WHERE id = NEW.image_id);
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS collection_stats_labels_update AFTER UPDATE OF labels_json ON labels
+        WHEN {LABELED_SQL.format('NEW')} != {LABELED_SQL.format('OLD')} BEGIN
+            UPDATE collection_stats SET labeled_count = labeled_count + {LABELED_SQL.format('NEW')} - {LABELED_SQL.format('OLD')}
+            WHERE root_dir_id = (SELECT root_dir_id FROM images WHERE id = NEW.image_id);
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS collection_stats_labels_delete AFTER DELETE ON labels
+        WHEN {LABELED_SQL.format('OLD')} BEGIN
+            UPDATE collection_stats SET labeled_count = labeled_count - 1
+            WHERE root_dir_id = (SELECT root_dir_id FROM images WHERE id = OLD.image_id);
+        END''',
+    ],
+    'boxes': [
+        '''CREATE TRIGGER IF NOT EXISTS collection_stats_boxes_insert AFTER INSERT ON boxes
+        WHEN NEW.source = 'label' BEGIN
+            INSERT INTO collection_class_stats (root_dir_id, class_id, box_count)
+            SELECT root_dir_id, NEW.class_id, 1 FROM images WHERE id = NEW.image_id
+            ON CONFLICT(root_dir_id, class_id) DO UPDATE SET box_count = box_count + 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS collection_stats_boxes_delete AFTER DELETE ON boxes
+        WHEN OLD.source = 'label' BEGIN
+            UPDATE collection_class_stats SET box_count = box_count - 1
+            WHERE root_dir_id = (SELECT root_dir_id FROM images WHERE id = OLD.image_id) AND class_id = OLD.class_id;
+        END''',
+    ],
+    'model_predictions': [
+        '''CREATE TRIGGER IF NOT EXISTS collection_stats_predictions_insert AFTER INSERT ON model_predictions
+        WHEN NEW.loss IS NOT NULL BEGIN
+            INSERT INTO collection_model_stats (root_dir_id, model, scored_count, loss_sum, max_loss)
+            SELECT root_dir_id, NEW.model, 1, NEW.loss, NEW.loss FROM images WHERE file = NEW.file
+            ON CONFLICT(root_dir_id, model) DO UPDATE SET
+                scored_count = scored_count + 1,
+                loss_sum = loss_sum + excluded.loss_sum,
+                max_loss = MAX(max_loss, excluded.max_loss);
+        END''',
+        # the max only has to be recomputed when the removed loss was the max
+        '''CREATE TRIGGER IF NOT EXISTS collection_stats_predictions_delete AFTER DELETE ON model_predictions
+        WHEN OLD.loss IS NOT NULL BEGIN
+            UPDATE collection_model_stats SET
+                scored_count = scored_count - 1,
+                loss_sum = loss_sum - OLD.loss,
+                max_loss = CASE WHEN OLD.loss < max_loss THEN max_loss ELSE (
+                    SELECT MAX(mp.loss) FROM model_predictions AS mp JOIN images AS i ON i.file = mp.file
+                    WHERE mp.model = OLD.model AND i.root_dir_id = collection_model_stats.root_dir_id) END
+            WHERE model = OLD.model AND root_dir_id = (SELECT root_dir_id FROM images WHERE file = OLD.file);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS collection_stats_predictions_update AFTER UPDATE OF model, file, loss ON model_predictions BEGIN
+            UPDATE collection_model_stats SET
+                scored_count = scored_count - 1,
+                loss_sum = loss_sum - OLD.loss,
+                max_loss = CASE WHEN OLD.loss < max_loss THEN max_loss ELSE (
+                    SELECT MAX(mp.loss) FROM model_predictions AS mp JOIN images AS i ON i.file = mp.file
+                    WHERE mp.model = OLD.model AND i.root_dir_id = collection_model_stats.root_dir_id) END
+            WHERE OLD.loss IS NOT NULL AND model = OLD.model AND root_dir_id = (SELECT root_dir_id FROM images WHERE file = OLD.file);
+            INSERT INTO collection_model_stats (root_dir_id, model, scored_count, loss_sum, max_loss)
+            SELECT root_dir_id, NEW.model, 1, NEW.loss, NEW.loss FROM images WHERE file = NEW.file AND NEW.loss IS NOT NULL
+            ON CONFLICT(root_dir_id, model) DO UPDATE SET
+                scored_count = scored_count + 1,
+                loss_sum = loss_sum + excluded.loss_sum,
+                max_loss = MAX(max_loss, excluded.max_loss);
+        END''',
+    ],
+}
+
+def create_collection_stats(conn: sqlite3.Connection) -> None:
+    """Create the per collection stats tables and their triggers, filling the tables on first use"""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS collection_stats (
+            root_dir_id INTEGER PRIMARY KEY,
+            image_count INTEGER NOT NULL DEFAULT 0,
+            labeled_count INTEGER NOT NULL DEFAULT 0,
+            cover_image_id INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS collection_model_stats (
+            root_dir_id INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            scored_count INTEGER NOT NULL DEFAULT 0,
+            loss_sum REAL NOT NULL DEFAULT 0,
+            max_loss REAL,
+            PRIMARY KEY (root_dir_id, model)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS collection_class_stats (
+            root_dir_id INTEGER NOT NULL,
+            class_id INTEGER NOT NULL,
+            box_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (root_dir_id, class_id)
+        )
+    ''')
+    for table, statements in TRIGGERS.items():
+        if table not in tables: continue
+        for statement in statements:
+            conn.execute(statement)
+    if 'collection_stats' not in tables:
+        rebuild_collection_stats(conn)
+    conn.commit()
+
+def rebuild_collection_stats(conn: sqlite3.Connection) -> None:
+    """Recompute every collection's stats from scratch, the triggers keep them current afterwards"""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.execute('DELETE FROM collection_stats')
+    conn.execute('DELETE FROM collection_model_stats')
+    conn.execute('DELETE FROM collection_class_stats')
+    if 'images' not in tables:
+        return
+    labeled = f"SUM({LABELED_SQL.format('l')})" if 'labels' in tables else '0'
+    labels_join = 'LEFT JOIN labels AS l ON l.image_id = i.id' if 'labels' in tables else ''
+    conn.execute(f'''
+        INSERT INTO collection_stats (root_dir_id, image_count, labeled_count, cover_image_id)
+        SELECT i.root_dir_id, COUNT(*), COALESCE({labeled}, 0), MIN(i.id)
+        FROM images AS i {labels_join}
+        GROUP BY i.root_dir_id
+    ''')
+    if 'boxes' in tables:
+        conn.execute('''
+            INSERT INTO collection_class_stats (root_dir_id, class_id, box_count)
+            SELECT i.root_dir_id, b.class_id, COUNT(*)
+            FROM boxes AS b JOIN images AS i ON i.id = b.image_id
+            WHERE b.source = 'label'
+            GROUP BY i.root_dir_id, b.class_id
+        ''')
+    if 'model_predictions' in tables:
+        conn.execute('''
+            INSERT INTO collection_model_stats (root_dir_id, model, scored_count, loss_sum, max_loss)
+            SELECT i.root_dir_id, mp.model, COUNT(*), SUM(mp.loss), MAX(mp.loss)
+            FROM model_predictions AS mp JOIN images AS i ON i.file = mp.file
+            WHERE mp.loss IS NOT NULL
+            GROUP BY i.root_dir_id, mp.model
+        ''')
+
+def iter_collection_summaries(conn: sqlite3.Connection) -> Iterator[Dict[str, Any]]:
+    """Every collection with images, its cover image and stats, in one query, yielded as rows are read"""
+    rows = conn.execute('''
+        SELECT r.id, r.root_dir, r.label_classes, i.file AS cover_image,
+               s.image_count, s.labeled_count,
+               (SELECT json_group_object(m.model, json_object(
+                           'scored', m.scored_count,
+                           'mean_loss', m.loss_sum / m.scored_count,
+                           'max_loss', m.max_loss))
+                FROM collection_model_stats AS m
+                WHERE m.root_dir_id = r.id AND m.scored_count > 0) AS models,
+               (SELECT json_group_object(c.class_id, c.box_count)
+                FROM collection_class_stats AS c
+                WHERE c.root_dir_id = r.id AND c.box_count > 0) AS classes
+        FROM root_dirs AS r
+        JOIN collection_stats AS s ON s.root_dir_id = r.id
+        JOIN images AS i ON i.id = s.cover_image_id
+        WHERE s.image_count > 0
+        ORDER BY r.id
+    ''')
+    keys = ('id', 'root_dir', 'label_classes', 'cover_image', 'image_count', 'labeled_count')
+    for row in rows:
+        yield {**dict(zip(keys, row[:6])),
+               'models': json.loads(row[6]) if row[6] else {},
+               'classes': {int(k): v for k, v in json.loads(row[7]).items()} if row[7] else {}}
+
+def collection_summaries(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+    """Every collection with images, its cover image and stats"""
+    return list(iter_collection_summaries(conn))
+
+if __name__ == "__main__":
+    conn = database.connect(sys.argv[1] if len(sys.argv) > 1 else database.DB_PATH)
+    create_collection_stats(conn)
+    rebuild_collection_stats(conn)
+    conn.commit()
+    print(f"collections: {conn.execute('SELECT COUNT(*) FROM collection_stats').fetchone()[0]}")
+    conn.close()
@@ -0,0 +1,125 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+DB_PATH: Path = Path(os.environ.get("HINT_DB", Path(__file__).parent / "images.db"))
+
+# WAL lets the web server read and write while a batch job holds a write
+# transaction, synchronous=NORMAL is safe under WAL and avoids an fsync per commit
+PRAGMAS: Dict[str, Union[str, int]] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 10000,
+    "mmap_size": 256 * 1024**2,
+    "cache_size": -64 * 1024,
+    "temp_store": "MEMORY",
+}
+CACHED_STATEMENTS: int = 256
+
+INDEXES: Dict[str, List[str]] = {
+    'images': [
+        'CREATE INDEX IF NOT EXISTS idx_images_root_dir_id ON images(root_dir_id, id)',
+    ],
+    'labels': [
+        'CREATE INDEX IF NOT EXISTS idx_labels_image_id ON labels(image_id)',
+    ],
+    'model_predictions': [
+        'CREATE INDEX IF NOT EXISTS idx_model_predictions_file_model ON model_predictions(file, model, loss)',
+        'CREATE INDEX IF NOT EXISTS idx_model_predictions_model_loss ON model_predictions(model, loss)',
+    ],
+}
+
+def connect(db_path: Union[str, Path] = DB_PATH, row_factory: Optional[type] = None,
+            factory: type = sqlite3.Connection) -> sqlite3.Connection:
+    """Open a connection with the shared pragmas applied, factory is the connection class"""
+    conn = sqlite3.connect(db_path, timeout=PRAGMAS["busy_timeout"] / 1000, factory=factory,
+                           check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+    if row_factory is not None:
+        conn.row_factory = row_factory
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
+
+def create_model_predictions(conn: sqlite3.Connection) -> None:
+    """The table prediction runs write, the caller creates the indexes and derived tables that depend on it"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS model_predictions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            model TEXT NOT NULL,
+            file TEXT NOT NULL,
+            base_path TEXT NOT NULL,
+            predictions JSON,
+            loss REAL,
+            timestamp DATETIME,
+            UNIQUE(model, file)
+        )
+    ''')
+
+def create_indexes(conn: sqlite3.Connection) -> None:
+    """Create the shared indexes for whichever of their tables exist"""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for table, statements in INDEXES.items():
+        if table not in tables: continue
+        for statement in statements:
+            conn.execute(statement)
+    conn.commit()
+
+class ConnectionPool:
+    """Hands out reusable connections, one per thread at a time.
+
+    `connection()` is a context manager that commits on success, rolls back on
+    error and always returns the connection to the pool. Nested use on the same
+    thread gets the same connection and only the outermost block commits.
+    Keeping connections open also keeps their prepared statement caches warm.
+    """
+
+    def __init__(self, db_path: Union[str, Path] = DB_PATH, max_idle: int = 8,
+                 factory: type = sqlite3.Connection) -> None:
+        self.db_path: Union[str, Path] = db_path
+        self.max_idle: int = max_idle
+        self.factory: type = factory
+        self._idle: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _acquire(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return connect(self.db_path, row_factory=sqlite3.Row, factory=self.factory)
+
+    def _release(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._release(conn)
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+pool: ConnectionPool = ConnectionPool()
@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+CACHE_DIR: Path = Path(__file__).parent / "cache" / "embeddings"
+DEFAULT_K: int = 50
+NPROBE: int = 8
+KMEANS_ITERS: int = 10
+KMEANS_SAMPLE: int = 100_000
+CHUNK_ROWS: int = 65_536
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2 normalized float32 rows, so a dot product is the cosine similarity"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+class FeatureHook:
+    """Captures the globally average pooled input of a YOLO detection head during predict.
+
+    The detection head reads several feature maps, the deepest one is used as
+    the image embedding. Registering the hook costs nothing extra, the
+    features are a by-product of the forward pass that predicts the boxes.
+    """
+
+    def __init__(self, yolo: Any) -> None:
+        layers = yolo.model.model
+        head = layers[-1]
+        layer = layers[head.f[-1]] if isinstance(head.f, (list, tuple)) else layers[-2]
+        self._features: List[np.ndarray] = []
+        self._handle = layer.register_forward_hook(self._hook)
+
+    def _hook(self, module: Any, inputs: Any, output: Any) -> None:
+        self._features.append(output.mean(dim=(2, 3)).float().cpu().numpy())
+
+    def clear(self) -> None:
+        self._features = []
+
+    def pop(self) -> Optional[np.ndarray]:
+        """Features of every forward pass since the last pop, one row per image"""
+        features, self._features = self._features, []
+        return np.concatenate(features) if features else None
+
+    def remove(self) -> None:
+        self._handle.remove()
+
+class IVFIndex:
+    """Inverted file index over normalized vectors, pure NumPy.
+
+    Vectors are clustered with spherical k-means and stored grouped by their
+    nearest centroid. A query only scores the vectors of the `nprobe` lists
+    whose centroids are closest to it, about nprobe / nlist of the rows.
+    """
+
+    def __init__(self, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray) -> None:
+        self.centroids: np.ndarray = centroids
+        self.order: np.ndarray = order
+        self.offsets: np.ndarray = offsets
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, nlist: Optional[int] = None, iters: int = KMEANS_ITERS,
+              sample: int = KMEANS_SAMPLE, seed: int = 0) -> "IVFIndex":
+        n = len(vectors)
+        nlist = max(1, min(nlist or int(4 * np.sqrt(n)), n))
+        rng = np.random.default_rng(seed)
+        train = normalize(vectors[np.sort(rng.choice(n, min(n, max(sample, nlist)), replace=False))])
+        centroids = train[rng.choice(len(train), nlist, replace=False)]
+        for _ in range(iters):
+            assign = (train @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, train)
+            counts = np.bincount(assign, minlength=nlist)
+            empty = counts == 0
+            # an empty list is reseeded with a random training vector
+            sums[empty] = train[rng.choice(len(train), int(empty.sum()))]
+            centroids = normalize(sums)
+        assign = np.concatenate([(normalize(vectors[i:i + CHUNK_ROWS]) @ centroids.T).argmax(axis=1)
+                                 for i in range(0, n, CHUNK_ROWS)]) if n else np.zeros(0, dtype=np.int64)
+        order = np.argsort(assign, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+        return cls(centroids, order, offsets)
+
+    def save(self, path: Path) -> None:
+        tmp = path.with_suffix('.tmp.npz')
+        np.savez(tmp, centroids=self.centroids, order=self.order, offsets=self.offsets)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "IVFIndex":
+        data = np.load(path)
+        return cls(data['centroids'], data['order'], data['offsets'])
+
+    def candidates(self, query: np.ndarray, nprobe: int = NPROBE) -> np.ndarray:
+        nprobe = min(nprobe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        rows = np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+        # sorted rows read the memory-mapped matrix front to back
+        return np.sort(rows)
+
+def top_k(rows: np.ndarray, scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    if len(scores) > k:
+        best = np.argpartition(-scores, k - 1)[:k]
+        rows, scores = rows[best], scores[best]
+    order = np.argsort(-scores, kind='stable')
+    return rows[order], scores[order]
+
+class EmbeddingStore:
+    """Per model image embeddings in a float16 memory-mapped matrix with an IVF index.
+
+    Writers append to their own segment files, so parallel prediction shards
+    never write the same file. `build_index` compacts the segments into the
+    main matrix, sorted by image id, and rebuilds the index. Rows that were
+    appended after the last build are still searched, by brute force.
+    """
+
+    def __init__(self, model: str, root: Path = CACHE_DIR) -> None:
+        self.model: str = model
+        self.dir: Path = Path(root) / model
+        self._loaded_mtime: Optional[float] = None
+        self._lock = threading.Lock()
+        self.ids: np.ndarray = np.zeros(0, dtype=np.int64)
+        self.vectors: np.ndarray = np.zeros((0, 0), dtype=np.float16)
+        self.index: Optional[IVFIndex] = None
+
+    @property
+    def _meta_path(self) -> Path:
+        return self.dir / "meta.json"
+
+    def _segment_paths(self) -> List[Path]:
+        return sorted((self.dir / "segments").glob("*.ids"))
+
+    def _read_segment(self, ids_path: Path) -> Tuple[np.ndarray, np.ndarray]:
+        dim = json.loads(ids_path.with_suffix('.json').read_text())['dim']
+        ids = np.fromfile(ids_path, dtype='<i8')
+        vectors = np.fromfile(ids_path.with_suffix('.f16'), dtype='<f2')
+        # a writer that died between the two appends leaves one file longer than the other
+        count = min(len(ids), len(vectors) // dim)
+        return ids[:count], vectors[:count * dim].reshape(count, dim)
+
+    def append(self, image_ids: Sequence[int], vectors: np.ndarray, segment: str = "default") -> None:
+        vectors = normalize(vectors).astype('<f2')
+        segments = self.dir / "segments"
+        segments.mkdir(parents=True, exist_ok=True)
+        meta = segments / f"{segment}.json"
+        if not meta.exists():
+            meta.write_text(json.dumps({'dim': vectors.shape[1]}))
+        elif json.loads(meta.read_text())['dim'] != vectors.shape[1]:
+            raise ValueError(f"segment {segment} of {self.model} holds vectors of another size")
+        with open(segments / f"{segment}.f16", 'ab') as f:
+            f.write(vectors.tobytes())
+        with open(segments / f"{segment}.ids", 'ab') as f:
+            f.write(np.asarray(image_ids, dtype='<i8').tobytes())
+
+    def build_index(self, nlist: Optional[int] = None) -> int:
+        """Merge the segments into the main matrix, keeping the newest vector per image, and rebuild the index"""
+        parts = []
+        if self._meta_path.exists():
+            meta = json.loads(self._meta_path.read_text())
+            parts.append((np.load(self.dir / "ids.npy"),
+                          np.memmap(self.dir / "vectors.f16", dtype='<f2', mode='r', shape=(meta['count'], meta['dim']))))
+        segment_paths = self._segment_paths()
+        parts += [self._read_segment(p) for p in segment_paths]
+        if not parts:
+            return 0
+        ids = np.concatenate([p[0] for p in parts])
+        # the last occurrence of an id wins, later segments and rows are newer
+        _, last = np.unique(ids[::-1], return_index=True)
+        keep = np.sort(len(ids) - 1 - last)
+        keep = keep[np.argsort(ids[keep], kind='stable')]
+        dim = parts[0][1].shape[1]
+        sources = np.concatenate([[0], np.cumsum([len(p[0]) for p in parts])])
+        tmp = self.dir / "vectors.f16.tmp"
+        out = np.memmap(tmp, dtype='<f2', mode='w+', shape=(len(keep), dim))
+        for start in range(0, len(keep), CHUNK_ROWS):
+            rows = keep[start:start + CHUNK_ROWS]
+            part = np.searchsorted(sources, rows, side='right') - 1
+            for p in np.unique(part):
+                sel = part == p
+                out[start:start + CHUNK_ROWS][sel] = parts[p][1][rows[sel] - sources[p]]
+        out.flush()
+        del out
+        os.replace(tmp, self.dir / "vectors.f16")
+        np.save(self.dir / "ids.npy", ids[keep])
+        vectors = np.memmap(self.dir / "vectors.f16", dtype='<f2', mode='r', shape=(len(keep), dim))
+        IVFIndex.build(vectors, nlist).save(self.dir / "ivf.npz")
+        self._meta_path.write_text(json.dumps({'count': int(len(keep)), 'dim': int(dim)}))
+        for p in segment_paths:
+            for suffix in ('.ids', '.f16', '.json'):
+                p.with_suffix(suffix).unlink(missing_ok=True)
+        return int(len(keep))
+
+    def _refresh(self) -> None:
+        """Map the main matrix again when build_index replaced it"""
+        mtime = self._meta_path.stat().st_mtime if self._meta_path.exists() else None
+        if mtime == self._loaded_mtime:
+            return
+        with self._lock:
+            if mtime is not None:
+                meta = json.loads(self._meta_path.read_text())
+                self.ids = np.load(self.dir / "ids.npy")
+                self.vectors = np.memmap(self.dir / "vectors.f16", dtype='<f2', mode='r', shape=(meta['count'], meta['dim']))
+                self.index = IVFIndex.load(self.dir / "ivf.npz")
+            self._loaded_mtime = mtime
+
+    def _tail(self) -> Tuple[np.ndarray, np.ndarray]:
+        parts = [self._read_segment(p) for p in self._segment_paths()]
+        if not parts:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, self.vectors.shape[1] if self.vectors.size else 0), dtype='<f2')
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+    def vector(self, image_id: int, tail: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> Optional[np.ndarray]:
+        self._refresh()
+        tail_ids, tail_vectors = tail if tail is not None else self._tail()
+        hits = np.flatnonzero(tail_ids == image_id)
+        if len(hits):
+            return tail_vectors[hits[-1]].astype(np.float32)
+        row = int(np.searchsorted(self.ids, image_id))
+        if row < len(self.ids) and self.ids[row] == image_id:
+            return np.asarray(self.vectors[row], dtype=np.float32)
+        return None
+
+    def search(self, image_id: int, k: int = DEFAULT_K, nprobe: int = NPROBE) -> List[Tuple[int, float]]:
+        """The k images most similar to image_id as (image_id, cosine similarity), best first"""
+        tail_ids, tail_vectors = tail = self._tail()
+        query = self.vector(image_id, tail)
+        if query is None:
+            raise KeyError(image_id)
+        ids, scores = [], []
+        if self.index is not None and len(self.ids):
+            rows = self.index.candidates(query, nprobe)
+            ids.append(self.ids[rows])
+            scores.append(np.asarray(self.vectors[rows], dtype=np.float32) @ query)
+        if len(tail_ids):
+            ids.append(tail_ids)
+            scores.append(tail_vectors.astype(np.float32) @ query)
+        if not ids:
+            return []
+        ids, scores = np.concatenate(ids), np.concatenate(scores)
+        # a vector re-embedded since the last build is in both, the tail copy is newer
+        unique_ids, first = np.unique(ids[::-1], return_index=True)
+        keep = len(ids) - 1 - first
+        ids, scores = ids[keep], scores[keep]
+        mask = ids != image_id
+        ids, scores = top_k(ids[mask], scores[mask], k)
+        return [(int(i), float(s)) for i, s in zip(ids, scores)]
+
+_stores: Dict[str, EmbeddingStore] = {}
+_stores_lock = threading.Lock()
+
+def models(root: Path = CACHE_DIR) -> List[str]:
+    """Models that have an embeddings directory"""
+    if not Path(root).exists():
+        return []
+    return sorted(p.name for p in Path(root).iterdir() if p.is_dir())
+
+def store_for(model: str) -> EmbeddingStore:
+    """The shared store of a model from models(), KeyError for any other name"""
+    if model not in models():
+        raise KeyError(model)
+    with _stores_lock:
+        if model not in _stores:
+            _stores[model] = EmbeddingStore(model)
+        return _stores[model]
+
+if __name__ == "__main__":
+    # compact the appended embeddings of a model and rebuild its index
+    print(f"indexed {EmbeddingStore(sys.argv[1]).build_index()} embeddings of {sys.argv[1]}")
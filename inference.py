@@ -0,0 +1,283 @@
+import threading
+import queue
+import time
+import pickle
+import itertools
+import multiprocessing
+from concurrent.futures import Future
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+import numpy as np
+from PIL import Image
+from instrumentation import INFERENCE_BATCH, INFERENCE_SECONDS
+
+MODELS_DIR: Path = Path(__file__).parent / "models"
+DEFAULT_MODEL: str = "feb16"
+# ultralytics and torch are only imported by the process that runs the models
+
+ImageInput = Union[Path, np.ndarray]
+
+def boxes_to_dicts(result: Any) -> List[Dict[str, Any]]:
+    """Convert one ultralytics result into the label dicts the UI draws"""
+    boxes = result.boxes
+    return [{"class": _cls, "conf": _conf, "coordinates": _xywhn}
+            for _cls, _conf, _xywhn in zip(boxes.cls.tolist(), boxes.conf.tolist(), boxes.xywhn.tolist())]
+
+class ModelRegistry:
+    """Keeps named YOLO models loaded and warm for the lifetime of the process"""
+
+    def __init__(self, models_dir: Path = MODELS_DIR) -> None:
+        self.models_dir: Path = Path(models_dir)
+        self._models: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def path_for(self, name: str) -> Path:
+        """Weights of a model in models_dir, any other name, like one with a path in it, is rejected"""
+        if name not in self.available():
+            raise FileNotFoundError(f"no model {name} in {self.models_dir}")
+        return self.models_dir / f"{name}.pt"
+
+    def available(self) -> List[str]:
+        if not self.models_dir.exists():
+            return []
+        return sorted(p.stem for p in self.models_dir.glob("*.pt"))
+
+    def get(self, name: str) -> Any:
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        from ultralytics import YOLO
+        with self._lock:
+            if name not in self._models:
+                model_path = self.path_for(name)
+                with INFERENCE_SECONDS.time(model=name, stage="load"):
+                    model = YOLO(model_path)
+                    # one throwaway pass so the first real request does not pay for fusing and allocation
+                    model.predict(Image.new("RGB", (64, 64)), verbose=False)
+                self._models[name] = model
+        return self._models[name]
+
+class BatchPredictor:
+    """Groups concurrent predict calls per model into one batched forward pass.
+
+    Each model gets a single worker thread, so a model is never used by two
+    threads at once. The worker waits at most `window` seconds after the first
+    queued request for more requests to arrive, up to `max_batch` images.
+    Images are paths or decoded BGR uint8 arrays, as ultralytics expects them.
+    """
+
+    def __init__(self, registry: ModelRegistry, max_batch: int = 8, window: float = 0.01) -> None:
+        self.registry: ModelRegistry = registry
+        self.max_batch: int = max_batch
+        self.window: float = window
+        self._queues: Dict[str, "queue.Queue[Tuple[ImageInput, Future]]"] = {}
+        self._lock = threading.Lock()
+
+    def _queue_for(self, model_name: str) -> "queue.Queue[Tuple[ImageInput, Future]]":
+        q = self._queues.get(model_name)
+        if q is not None:
+            return q
+        with self._lock:
+            if model_name not in self._queues:
+                self._queues[model_name] = queue.Queue()
+                threading.Thread(target=self._run, args=(model_name, self._queues[model_name]),
+                                 name=f"predict-{model_name}", daemon=True).start()
+        return self._queues[model_name]
+
+    def _collect(self, q: "queue.Queue[Tuple[ImageInput, Future]]") -> List[Tuple[ImageInput, Future]]:
+        batch = [q.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, model_name: str, q: "queue.Queue[Tuple[ImageInput, Future]]") -> None:
+        while True:
+            batch = self._collect(q)
+            batch = [(image, fut) for image, fut in batch if fut.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                model = self.registry.get(model_name)
+                results = model.predict([str(image) if isinstance(image, Path) else image for image, _ in batch], verbose=False)
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            self._record(model_name, len(batch), [result.speed for result in results])
+            for (_, fut), result in zip(batch, results):
+                fut.set_result(boxes_to_dicts(result))
+
+    def _record(self, model_name: str, batch_size: int, speeds: List[Dict[str, float]]) -> None:
+        record_speeds(model_name, batch_size, speeds)
+
+    def submit(self, model_name: str, image: ImageInput) -> Future:
+        fut: Future = Future()
+        self._queue_for(model_name).put((image if isinstance(image, np.ndarray) else Path(image), fut))
+        return fut
+
+    def predict(self, model_name: str, image_path: Path, timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        return self.submit(model_name, image_path).result(timeout=timeout)
+
+def record_speeds(model_name: str, batch_size: int, speeds: List[Dict[str, float]]) -> None:
+    INFERENCE_BATCH.observe(batch_size, model=model_name)
+    for speed in speeds:
+        # ultralytics reports milliseconds per image for each stage
+        for stage, key in (("preprocess", "preprocess"), ("forward", "inference"), ("postprocess", "postprocess")):
+            if key in speed:
+                INFERENCE_SECONDS.observe(speed[key] / 1000, model=model_name, stage=stage)
+
+def load_image(image_path: Path) -> np.ndarray:
+    """Decoded BGR uint8 array of an image, the channel order ultralytics assumes for arrays"""
+    with Image.open(image_path) as image:
+        return np.ascontiguousarray(np.asarray(image.convert("RGB"))[..., ::-1])
+
+class _WorkerPredictor(BatchPredictor):
+    """BatchPredictor that reports its metrics to the web process instead of its own registry"""
+
+    def __init__(self, registry: ModelRegistry, results: Any, max_batch: int, window: float) -> None:
+        super().__init__(registry, max_batch, window)
+        self.results = results
+
+    def _record(self, model_name: str, batch_size: int, speeds: List[Dict[str, float]]) -> None:
+        self.results.put(("metrics", model_name, batch_size, [dict(speed) for speed in speeds]))
+
+def _reply(results: Any, request_id: int, fut: Future) -> None:
+    error = fut.exception()
+    if error is None:
+        results.put(("result", request_id, fut.result()))
+        return
+    try:
+        pickle.dumps(error)
+    except Exception:
+        error = RuntimeError(f"{type(error).__name__}: {error}")
+    results.put(("error", request_id, error))
+
+def _worker_main(requests: Any, results: Any, models_dir: Path, max_batch: int, window: float) -> None:
+    """Entry point of the inference process: batch the requests of the web process and send back the boxes"""
+    local = _WorkerPredictor(ModelRegistry(models_dir), results, max_batch, window)
+    while True:
+        item = requests.get()
+        if item is None:
+            return
+        request_id, model_name, shm_name, shape = item
+        try:
+            shm = SharedMemory(name=shm_name)
+        except FileNotFoundError as e:
+            # predict timed out before the worker got here and unlinked the block, nobody reads this answer
+            results.put(("error", request_id, e))
+            continue
+        # one copy out of the shared block so the web process can free it as soon as the answer arrives
+        image = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).copy()
+        shm.close()
+        local.submit(model_name, image).add_done_callback(lambda fut, request_id=request_id: _reply(results, request_id, fut))
+
+class ProcessPredictor:
+    """BatchPredictor running in a separate long-lived process, with the same submit and predict.
+
+    The web process decodes the image and places the pixels in a
+    multiprocessing.shared_memory block, only its name and shape go through
+    the request queue. ultralytics and torch are never imported by the web
+    process, a prediction runs next to the request threads instead of in
+    them. The worker starts with the first request or `start`, and again
+    after it died; the requests it held fail with a RuntimeError.
+    """
+
+    def __init__(self, models_dir: Path = MODELS_DIR, max_batch: int = 8, window: float = 0.01) -> None:
+        self.models_dir: Path = Path(models_dir)
+        self.max_batch: int = max_batch
+        self.window: float = window
+        self._context = multiprocessing.get_context("spawn")
+        self._process: Optional[Any] = None
+        self._requests: Optional[Any] = None
+        # request id -> (future, image block, the process the request went to)
+        self._pending: Dict[int, Tuple[Future, SharedMemory, Any]] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._process is not None and self._process.is_alive():
+                return
+            self._requests, results = self._context.Queue(), self._context.Queue()
+            self._process = self._context.Process(target=_worker_main, name="inference",
+                                                  args=(self._requests, results, self.models_dir, self.max_batch, self.window),
+                                                  daemon=True)
+            self._process.start()
+            threading.Thread(target=self._read, args=(self._process, results), name="inference-results", daemon=True).start()
+
+    def _finish(self, request_id: int) -> Optional[Future]:
+        with self._lock:
+            fut, shm, _ = self._pending.pop(request_id, (None, None, None))
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+        return fut
+
+    def _read(self, process: Any, results: Any) -> None:
+        while True:
+            try:
+                message = results.get(timeout=1)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                break
+            if message[0] == "metrics":
+                record_speeds(*message[1:])
+                continue
+            kind, request_id, value = message
+            fut = self._finish(request_id)
+            if fut is None:
+                continue
+            if kind == "result":
+                fut.set_result(value)
+            else:
+                fut.set_exception(value)
+        with self._lock:
+            lost = [request_id for request_id, (_, _, owner) in self._pending.items() if owner is process]
+        for request_id in lost:
+            fut = self._finish(request_id)
+            if fut is not None:
+                fut.set_exception(RuntimeError(f"inference worker exited with code {process.exitcode}"))
+
+    def _send(self, model_name: str, image_path: Path) -> Tuple[int, Future]:
+        self.start()
+        image = load_image(image_path)
+        shm = SharedMemory(create=True, size=max(1, image.nbytes))
+        np.ndarray(image.shape, dtype=np.uint8, buffer=shm.buf)[:] = image
+        fut: Future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = (fut, shm, self._process)
+            requests = self._requests
+        requests.put((request_id, model_name, shm.name, image.shape))
+        return request_id, fut
+
+    def submit(self, model_name: str, image_path: Path) -> Future:
+        return self._send(model_name, image_path)[1]
+
+    def predict(self, model_name: str, image_path: Path, timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        request_id, fut = self._send(model_name, image_path)
+        try:
+            return fut.result(timeout=timeout)
+        except TimeoutError:
+            # free the image now, the answer is dropped by _read whenever it comes
+            self._finish(request_id)
+            raise
+
+    def close(self) -> None:
+        with self._lock:
+            process, requests, self._process = self._process, self._requests, None
+        if process is not None:
+            requests.put(None)
+            process.join(timeout=5)
+
+registry: ModelRegistry = ModelRegistry()
+predictor: ProcessPredictor = ProcessPredictor(registry.models_dir)
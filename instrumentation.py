@@ -0,0 +1,265 @@
+import os
+import re
+import sys
+import time
+import bisect
+import logging
+import sqlite3
+import threading
+from collections import Counter as StackCounter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger("hint")
+
+SLOW_QUERY_SECONDS: float = float(os.environ.get("HINT_SLOW_QUERY_MS", 100)) / 1000
+PROFILER_ENABLED: bool = os.environ.get("HINT_PROFILER", "0") not in ("", "0")
+LATENCY_BUCKETS: Tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS: Tuple[float, ...] = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+BATCH_BUCKETS: Tuple[float, ...] = (1, 2, 4, 8, 16, 32, 64)
+
+LabelValues = Tuple[str, ...]
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra: pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Monotonic counter with labels, exported in the Prometheus text format"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+class Histogram:
+    """Cumulative bucket histogram with labels, exported in the Prometheus text format"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        # per label set: counts per bucket (the last one is +Inf), sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def time(self, **labels: Any) -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}"
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, Any]) -> None:
+        self.histogram, self.labels = histogram, labels
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+REGISTRY: List[Any] = []
+
+REQUEST_SECONDS = Histogram("hint_request_duration_seconds", "Request latency by route", ("route", "method", "status"))
+RESPONSE_BYTES = Counter("hint_response_bytes_total", "Response body bytes sent by route", ("route",))
+QUERY_SECONDS = Histogram("hint_sqlite_query_duration_seconds", "SQLite execute time by statement kind and table",
+                          ("statement",), QUERY_BUCKETS)
+SLOW_QUERIES = Counter("hint_sqlite_slow_queries_total", "Queries slower than HINT_SLOW_QUERY_MS", ("statement",))
+INFERENCE_SECONDS = Histogram("hint_inference_duration_seconds", "Model time per stage, per image except for load",
+                              ("model", "stage"))
+INFERENCE_BATCH = Histogram("hint_inference_batch_size", "Images per batched forward pass", ("model",), BATCH_BUCKETS)
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+_STATEMENT = re.compile(r"\s*(?:WITH\b.*?\)\s*)?(?:(UPDATE)(?:\s+OR\s+\w+)?\s+(\w+)|(\w+)(?:.*?\b(?:FROM|INTO|TABLE|ON)\s+(\w+))?)",
+                        re.IGNORECASE | re.DOTALL)
+
+def statement_label(sql: str) -> str:
+    """Low cardinality label for a statement, e.g. 'SELECT images'"""
+    match = _STATEMENT.match(sql)
+    if not match:
+        return "other"
+    verb, table = (match.group(1) or match.group(3)).upper(), match.group(2) or match.group(4)
+    return f"{verb} {table}" if table and verb != "PRAGMA" else verb
+
+def _timed(sql: str, start: float) -> None:
+    elapsed = time.perf_counter() - start
+    label = statement_label(sql)
+    QUERY_SECONDS.observe(elapsed, statement=label)
+    if elapsed >= SLOW_QUERY_SECONDS:
+        SLOW_QUERIES.inc(statement=label)
+        logger.warning("slow query %.1f ms: %s", elapsed * 1000, " ".join(sql.split())[:500])
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records how long execute and executemany take.
+
+    SQLite computes the first row inside execute, so for most queries this is
+    close to the full query time. Rows fetched afterwards are not counted.
+    """
+
+    def execute(self, sql: str, parameters: Any = ()) -> "TimedCursor":
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _timed(sql, start)
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Any]) -> "TimedCursor":
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _timed(sql, start)
+
+class TimedConnection(sqlite3.Connection):
+    """Connection factory for sqlite3.connect whose cursors, including the ones behind conn.execute, are timed"""
+
+    def cursor(self, factory: Any = TimedCursor) -> sqlite3.Cursor:
+        return super().cursor(factory)
+
+    # the C implementations of these shortcuts bypass cursor(), so they are routed through it here
+    def execute(self, sql: str, parameters: Any = ()) -> sqlite3.Cursor:
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Any]) -> sqlite3.Cursor:
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class SamplingProfiler:
+    """Samples the stacks of every thread at a fixed interval.
+
+    The result is in the collapsed stack format ('frame;frame;frame count'
+    per line) that flamegraph tools read. Sampling costs one
+    sys._current_frames call per interval, so it is cheap enough to run
+    against a live server for a while.
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval: float = interval
+        self._samples: StackCounter = StackCounter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own: continue
+                names = []
+                while frame is not None:
+                    names.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self._samples[";".join(reversed(names))] += 1
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._samples.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return "\n".join(f"{stack} {count}" for stack, count in self._samples.most_common()) + "\n"
+
+profiler: SamplingProfiler = SamplingProfiler()
+
+def _count_bytes(chunks: Iterable[Any], route: str) -> Iterator[Any]:
+    for chunk in chunks:
+        RESPONSE_BYTES.inc(len(chunk), route=route)
+        yield chunk
+
+def install(app: Any, pool: Any = None) -> None:
+    """Time every request of a Flask app, time the SQL of a database.ConnectionPool and add /metrics.
+
+    With HINT_PROFILER=1 the sampling profiler can be started with
+    POST /debug/profiler/start and POST /debug/profiler/stop returns the
+    collected stacks.
+    """
+    from flask import Response, g, request
+
+    if pool is not None:
+        pool.factory = TimedConnection
+
+    @app.before_request
+    def _start_timer() -> None:
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def _record(response: Any) -> Any:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        start = g.get("request_start")
+        if start is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, route=route, method=request.method, status=response.status_code)
+        if response.content_length is not None:
+            RESPONSE_BYTES.inc(response.content_length, route=route)
+        elif response.is_streamed:
+            # streamed bodies are counted as they are sent, their time is not in the histogram
+            response.response = _count_bytes(response.response, route)
+        return response
+
+    @app.route('/metrics')
+    def metrics() -> Any:
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+    if not PROFILER_ENABLED:
+        return
+
+    @app.route('/debug/profiler/start', methods=['POST'])
+    def start_profiler() -> Any:
+        profiler.interval = request.args.get('interval', profiler.interval, type=float)
+        profiler.start()
+        return "profiler started\n"
+
+    @app.route('/debug/profiler/stop', methods=['POST'])
+    def stop_profiler() -> Any:
+        return Response(profiler.stop(), mimetype="text/plain")
@@ -0,0 +1,222 @@
+import json
+import sqlite3
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+import boxes
+import loss_overview
+from matching import IOU_THRESHOLD, pairwise_iou
+
+CHUNK_ROWS: int = 1000
+ACCEPT_MODES: Tuple[str, ...] = ('missing', 'replace', 'append')
+# fields every operation of BulkEditor.apply needs, set also needs image_id or file
+REQUIRED_FIELDS: Dict[str, Tuple[str, ...]] = {
+    'set': ('labels',),
+    'remap': ('collection_id', 'classes'),
+    'filter_size': ('collection_id',),
+    'accept_predictions': ('collection_id', 'model'),
+}
+
+Labels = List[Dict[str, Any]]
+
+class RevisionConflict(Exception):
+    """Raised when labels were written against a revision that is no longer current"""
+
+    def __init__(self, conflicts: List[Dict[str, Any]]) -> None:
+        super().__init__(f"{len(conflicts)} images were changed by someone else")
+        self.conflicts: List[Dict[str, Any]] = conflicts
+
+class UnknownImage(LookupError):
+    """Raised when a write names an image that is not in the database"""
+
+def dedupe_labels(labels: Labels) -> Labels:
+    """Drop labels with the same class and coordinates as an earlier one"""
+    unique: Dict[Tuple[Any, Tuple[float, ...]], Dict[str, Any]] = {}
+    for label in labels:
+        unique.setdefault((label.get('class'), tuple(label.get('coordinates', []))), label)
+    return list(unique.values())
+
+def write_labels(conn: sqlite3.Connection, image_id: int, labels: Labels, revision: Optional[int] = None) -> int:
+    """Store an image's labels, bump its revision and keep boxes and loss aggregates in sync.
+
+    The caller commits and only then drops the image's cached overlays, so a
+    rolled back write leaves them alone.
+
+    With `revision` the write only happens when it is still the image's
+    revision, otherwise RevisionConflict is raised. Returns the new revision.
+    """
+    if revision is None:
+        cursor = conn.execute('UPDATE images SET revisions = COALESCE(revisions, 0) + 1 WHERE id = ?', (image_id,))
+    else:
+        cursor = conn.execute('''UPDATE images SET revisions = COALESCE(revisions, 0) + 1
+                                 WHERE id = ? AND COALESCE(revisions, 0) = ?''', (image_id, revision))
+    if not cursor.rowcount:
+        row = conn.execute('SELECT COALESCE(revisions, 0) FROM images WHERE id = ?', (image_id,)).fetchone()
+        if row is None:
+            raise UnknownImage(image_id)
+        raise RevisionConflict([{'image_id': image_id, 'revision': revision, 'current': row[0]}])
+    row = conn.execute('SELECT labels_json FROM labels WHERE image_id = ?', (image_id,)).fetchone()
+    old = json.loads(row[0]) if row and row[0] else []
+    labels_json = json.dumps(labels)
+    if not conn.execute('UPDATE labels SET labels_json = ? WHERE image_id = ?', (labels_json, image_id)).rowcount:
+        conn.execute('INSERT INTO labels (image_id, labels_json) VALUES (?, ?)', (image_id, labels_json))
+    boxes.replace_label_boxes(conn, image_id, labels)
+    loss_overview.relabel(conn, {image_id: old if isinstance(old, list) else []})
+    return conn.execute('SELECT revisions FROM images WHERE id = ?', (image_id,)).fetchone()[0]
+
+def collection_labels(conn: sqlite3.Connection, collection_id: int) -> Iterator[Tuple[int, int, Labels]]:
+    """(image_id, revision, labels) of a collection's images, read in chunks so writes can interleave"""
+    last_id = -1
+    while True:
+        rows = conn.execute('''
+            SELECT i.id, COALESCE(i.revisions, 0), l.labels_json
+            FROM images AS i LEFT JOIN labels AS l ON l.image_id = i.id
+            WHERE i.root_dir_id = ? AND i.id > ?
+            ORDER BY i.id
+            LIMIT ?
+        ''', (collection_id, last_id, CHUNK_ROWS)).fetchall()
+        if not rows:
+            return
+        for image_id, revision, labels_json in rows:
+            labels = json.loads(labels_json) if labels_json else []
+            yield image_id, revision, labels if isinstance(labels, list) else []
+        last_id = rows[-1][0]
+
+def remap_classes(labels: Labels, classes: Dict[int, Optional[int]]) -> Labels:
+    """Labels with their class replaced through classes, a class mapped to None is removed"""
+    out = []
+    for label in labels:
+        class_id = boxes.class_id_for(label)
+        if class_id not in classes:
+            out.append(label)
+        elif classes[class_id] is not None:
+            out.append({**label, 'class': classes[class_id]})
+    return out
+
+def size_filter(labels: Labels, bounds: Dict[str, float], classes: Optional[Sequence[int]] = None) -> Labels:
+    """Labels whose width, height and area are inside bounds, labels of other classes are kept"""
+    def inside(label: Dict[str, Any]) -> bool:
+        if classes is not None and boxes.class_id_for(label) not in classes:
+            return True
+        w, h = boxes.box_coordinates(label)[2:4]
+        sizes = {'w': w, 'h': h, 'area': w * h}
+        return all(bounds.get(f'min_{k}', -np.inf) <= v <= bounds.get(f'max_{k}', np.inf) for k, v in sizes.items())
+    return [label for label in labels if inside(label)]
+
+def merge_predictions(labels: Labels, predictions: Labels, threshold: float = IOU_THRESHOLD) -> Labels:
+    """Labels plus the predictions that do not overlap a label of the same class by more than threshold"""
+    if not labels or not predictions:
+        return labels + predictions
+    iou = pairwise_iou(np.array([boxes.box_coordinates(p)[:4] for p in predictions], dtype=np.float64),
+                       np.array([boxes.box_coordinates(l)[:4] for l in labels], dtype=np.float64))
+    same = np.array([[p['class'] == boxes.class_id_for(l) for l in labels] for p in predictions])
+    return labels + [p for p, covered in zip(predictions, (np.where(same, iou, 0.0) > threshold).any(axis=1)) if not covered]
+
+class BulkEditor:
+    """Applies label operations inside the caller's transaction.
+
+    Every write checks the revision the image had when it was read, or the
+    one the client sent, so an edit made elsewhere in the meantime is a
+    conflict instead of being overwritten. Conflicts are collected; `apply`
+    raises RevisionConflict with all of them at the end, and the caller rolls
+    the whole batch back. Images whose labels do not change are not written,
+    `written` lists the ones that were for the caller to invalidate after commit.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, revisions: Optional[Dict[int, int]] = None) -> None:
+        self.conn: sqlite3.Connection = conn
+        self.revisions: Dict[int, int] = revisions or {}
+        self.conflicts: List[Dict[str, Any]] = []
+        self.written: List[int] = []
+
+    def _write(self, image_id: int, revision: int, old: Labels, new: Labels) -> bool:
+        if new == old:
+            return False
+        try:
+            write_labels(self.conn, image_id, new, self.revisions.get(image_id, revision))
+        except RevisionConflict as e:
+            self.conflicts += e.conflicts
+            return False
+        self.written.append(image_id)
+        return True
+
+    def set(self, op: Dict[str, Any]) -> Dict[str, Any]:
+        row = self.conn.execute(f'''
+            SELECT i.id, l.labels_json FROM images AS i LEFT JOIN labels AS l ON l.image_id = i.id
+            WHERE {'i.id' if 'image_id' in op else 'i.file'} = ?
+        ''', (op['image_id'] if 'image_id' in op else op['file'],)).fetchone()
+        if row is None:
+            raise UnknownImage(op.get('image_id', op.get('file')))
+        if not isinstance(op.get('labels'), list):
+            raise ValueError("set needs a list of labels")
+        try:
+            revision = write_labels(self.conn, row[0], dedupe_labels(op['labels']), op.get('revision', self.revisions.get(row[0])))
+        except RevisionConflict as e:
+            self.conflicts += e.conflicts
+            return {'image_id': row[0], 'changed': 0}
+        self.written.append(row[0])
+        return {'image_id': row[0], 'changed': 1, 'revision': revision}
+
+    def _each(self, collection_id: int, edit: Any) -> Dict[str, Any]:
+        changed = 0
+        for image_id, revision, labels in collection_labels(self.conn, collection_id):
+            changed += self._write(image_id, revision, labels, edit(image_id, labels))
+        return {'collection_id': collection_id, 'changed': changed}
+
+    def remap(self, op: Dict[str, Any]) -> Dict[str, Any]:
+        classes = {int(k): None if v is None else int(v) for k, v in op['classes'].items()}
+        return self._each(int(op['collection_id']), lambda _, labels: remap_classes(labels, classes))
+
+    def filter_size(self, op: Dict[str, Any]) -> Dict[str, Any]:
+        bounds = {k: float(op[k]) for k in ('min_w', 'min_h', 'min_area', 'max_w', 'max_h', 'max_area') if k in op}
+        classes = [int(c) for c in op['classes']] if op.get('classes') is not None else None
+        return self._each(int(op['collection_id']), lambda _, labels: size_filter(labels, bounds, classes))
+
+    def accept_predictions(self, op: Dict[str, Any]) -> Dict[str, Any]:
+        """Turn a model's predictions above min_conf into labels.
+
+        mode 'missing' only labels images without labels, 'replace' overwrites
+        the labels and 'append' adds the predictions no label already covers.
+        """
+        mode, min_conf = op.get('mode', 'missing'), float(op.get('min_conf', 0.5))
+        if mode not in ACCEPT_MODES:
+            raise ValueError(f"unknown mode {mode}, expected one of {ACCEPT_MODES}")
+        collection_id = int(op['collection_id'])
+        row = self.conn.execute('SELECT label_classes FROM root_dirs WHERE id = ?', (collection_id,)).fetchone()
+        class_names = row[0].split(" ") if row and row[0] else []
+        predicted: Dict[int, Labels] = {}
+        for image_id, predictions_json in self.conn.execute('''
+            SELECT i.id, mp.predictions FROM images AS i
+            JOIN model_predictions AS mp ON mp.file = i.file AND mp.model = ?
+            WHERE i.root_dir_id = ?
+        ''', (op['model'], collection_id)):
+            labels = []
+            for p in json.loads(predictions_json) if predictions_json else []:
+                class_id = boxes.class_id_for(p, class_names)
+                if class_id is not None and (p.get('conf') or 0) >= min_conf:
+                    labels.append({'class': class_id, 'coordinates': boxes.box_coordinates(p)[:4]})
+            predicted[image_id] = labels
+
+        def edit(image_id: int, labels: Labels) -> Labels:
+            if image_id not in predicted or (mode == 'missing' and labels):
+                return labels
+            return merge_predictions(labels, predicted[image_id]) if mode == 'append' else predicted[image_id]
+        return self._each(collection_id, edit)
+
+    def apply(self, operations: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Run the operations in order, a malformed one raises ValueError before any of them runs"""
+        for op in operations:
+            if not isinstance(op, dict) or op.get('op') not in REQUIRED_FIELDS:
+                raise ValueError(f"unknown operation {op.get('op') if isinstance(op, dict) else op}")
+            missing = [field for field in REQUIRED_FIELDS[op['op']] if op.get(field) is None]
+            if op['op'] == 'set' and op.get('image_id') is None and op.get('file') is None:
+                missing.append('image_id or file')
+            if missing:
+                raise ValueError(f"{op['op']} needs {', '.join(missing)}")
+        results = []
+        for op in operations:
+            handler = {'set': self.set, 'remap': self.remap, 'filter_size': self.filter_size,
+                       'accept_predictions': self.accept_predictions}[op['op']]
+            results.append({'op': op['op'], **handler(op)})
+        if self.conflicts:
+            raise RevisionConflict(self.conflicts)
+        return results
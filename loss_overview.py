@@ -0,0 +1,334 @@
+import sys
+import json
+import sqlite3
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import database
+import boxes
+from matching import class_counts_batch
+
+# composite losses lie in [0, 4], higher ones land in the last bucket
+LOSS_MAX: float = 4.0
+BUCKETS: int = 200
+BUCKET_WIDTH: float = LOSS_MAX / BUCKETS
+RESOLUTIONS: Dict[str, int] = {'minute': 60, 'hour': 3600, 'day': 86400}
+PERCENTILES: Tuple[float, ...] = (0.5, 0.9, 0.99)
+ALL_CLASSES: int = -1
+NO_COLLECTION: int = -1
+CHUNK_ROWS: int = 900
+
+# Aggregates per (model, collection, class), class -1 being every image, so a
+# dashboard reads a few hundred rows whatever the number of predictions.
+# record() adds a flush of new predictions with one upsert per touched key,
+# relabel() moves an image's contributions when its labels are rewritten.
+
+def create_loss_overview(conn: sqlite3.Connection) -> None:
+    """Create the aggregate tables, filling them from model_predictions on first use"""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS loss_summary (
+            model TEXT NOT NULL,
+            root_dir_id INTEGER NOT NULL,
+            class_id INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            loss_sum REAL NOT NULL DEFAULT 0,
+            loss_sq_sum REAL NOT NULL DEFAULT 0,
+            min_loss REAL,
+            max_loss REAL,
+            tp INTEGER NOT NULL DEFAULT 0,
+            fp INTEGER NOT NULL DEFAULT 0,
+            fn INTEGER NOT NULL DEFAULT 0,
+            first_seen DATETIME,
+            PRIMARY KEY (model, root_dir_id, class_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS loss_histogram (
+            model TEXT NOT NULL,
+            root_dir_id INTEGER NOT NULL,
+            class_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (model, root_dir_id, class_id, bucket)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS loss_series (
+            model TEXT NOT NULL,
+            resolution INTEGER NOT NULL,
+            start INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            loss_sum REAL NOT NULL DEFAULT 0,
+            min_loss REAL,
+            max_loss REAL,
+            PRIMARY KEY (model, resolution, start)
+        )
+    ''')
+    if 'loss_summary' not in tables and 'model_predictions' in tables:
+        rebuild_loss_overview(conn)
+    conn.commit()
+
+def bucket_of(loss: float) -> int:
+    return min(max(int(loss / BUCKET_WIDTH), 0), BUCKETS - 1)
+
+def _timestamp(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+ImageInfo = Tuple[int, List[Dict[str, Any]], List[str]]
+Aggregates = Tuple[Dict[Tuple[str, int, int], List[Any]], Dict[Tuple[str, int, int, int], int], Dict[Tuple[str, int, int], List[Any]]]
+
+def _has_predictions(conn: sqlite3.Connection) -> bool:
+    # a database made by scritps/db.py has no model_predictions table until the first prediction run
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'model_predictions'").fetchone() is not None
+
+def _images(conn: sqlite3.Connection, column: str, values: Sequence[Any]) -> Dict[Any, Tuple[str, ImageInfo]]:
+    """file and (collection, labels, class names) of images, keyed by the images column they were looked up by"""
+    images: Dict[Any, Tuple[str, ImageInfo]] = {}
+    for i in range(0, len(values), CHUNK_ROWS):
+        chunk = values[i:i + CHUNK_ROWS]
+        for key, file, root_dir_id, labels_json, label_classes in conn.execute(f'''
+            SELECT i.{column}, i.file, i.root_dir_id, l.labels_json, r.label_classes
+            FROM images AS i
+            JOIN root_dirs AS r ON r.id = i.root_dir_id
+            LEFT JOIN labels AS l ON l.image_id = i.id
+            WHERE i.{column} IN ({", ".join("?" * len(chunk))})
+        ''', chunk):
+            labels = json.loads(labels_json) if labels_json else []
+            images[key] = (file, (root_dir_id, labels if isinstance(labels, list) else [], label_classes.split(" ") if label_classes else []))
+    return images
+
+def _aggregate(rows: Sequence[Tuple[Any, ...]], images: Dict[str, ImageInfo]) -> Aggregates:
+    """Summary, histogram and series contributions of (model, file, base_path, predictions_json, loss, timestamp) rows"""
+    summary: Dict[Tuple[str, int, int], List[Any]] = {}
+    bucket_counts: Dict[Tuple[str, int, int, int], int] = defaultdict(int)
+    points: Dict[Tuple[str, int, int], List[Any]] = {}
+    labeled: List[Tuple[Tuple[str, int], Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]]] = []
+
+    def add(key: Tuple[str, int, int], loss: Optional[float], seen: Optional[datetime], tp: int = 0, fp: int = 0, fn: int = 0) -> None:
+        s = summary.setdefault(key, [0, 0.0, 0.0, None, None, 0, 0, 0, None])
+        if loss is not None:
+            s[0] += 1
+            s[1] += loss
+            s[2] += loss * loss
+            s[3] = loss if s[3] is None else min(s[3], loss)
+            s[4] = loss if s[4] is None else max(s[4], loss)
+            bucket_counts[key + (bucket_of(loss),)] += 1
+        s[5] += tp; s[6] += fp; s[7] += fn
+        if seen is not None and (s[8] is None or seen < s[8]):
+            s[8] = seen
+
+    for model, file, _, predictions_json, loss, timestamp in rows:
+        root_dir_id, labels, class_names = images.get(file, (NO_COLLECTION, [], []))
+        predictions = [{'class': boxes.class_id_for(p, class_names), 'bbox': boxes.box_coordinates(p)[:4]}
+                       for p in (json.loads(predictions_json) if predictions_json else [])]
+        ground_truth = [{'class': boxes.class_id_for(l, class_names), 'bbox': boxes.box_coordinates(l)[:4]} for l in labels]
+        seen = _timestamp(timestamp)
+        add((model, root_dir_id, ALL_CLASSES), loss, seen)
+        # an image's loss counts for every class it has a label or a prediction of
+        for class_id in {b['class'] for b in predictions + ground_truth if b['class'] is not None}:
+            add((model, root_dir_id, class_id), loss, seen)
+        if ground_truth:
+            labeled.append(((model, root_dir_id), (predictions, ground_truth)))
+        if loss is not None and seen is not None:
+            epoch = int(seen.timestamp())
+            for resolution in RESOLUTIONS.values():
+                s = points.setdefault((model, resolution, epoch // resolution * resolution), [0, 0.0, loss, loss])
+                s[0] += 1; s[1] += loss; s[2] = min(s[2], loss); s[3] = max(s[3], loss)
+
+    for ((model, root_dir_id), _), counts in zip(labeled, class_counts_batch([pair for _, pair in labeled])):
+        totals = [0, 0, 0]
+        for class_id, class_counts in counts.items():
+            if class_id is None: continue
+            add((model, root_dir_id, class_id), None, None, *class_counts)
+            totals = [t + c for t, c in zip(totals, class_counts)]
+        add((model, root_dir_id, ALL_CLASSES), None, None, *totals)
+    return summary, bucket_counts, points
+
+def _write(conn: sqlite3.Connection, summary: Dict[Tuple[str, int, int], List[Any]],
+           bucket_counts: Dict[Tuple[str, int, int, int], int], points: Dict[Tuple[str, int, int], List[Any]]) -> None:
+    conn.executemany('''
+        INSERT INTO loss_summary (model, root_dir_id, class_id, count, loss_sum, loss_sq_sum, min_loss, max_loss, tp, fp, fn, first_seen)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (model, root_dir_id, class_id) DO UPDATE SET
+            count = count + excluded.count,
+            loss_sum = loss_sum + excluded.loss_sum,
+            loss_sq_sum = loss_sq_sum + excluded.loss_sq_sum,
+            min_loss = MIN(COALESCE(min_loss, excluded.min_loss), COALESCE(excluded.min_loss, min_loss)),
+            max_loss = MAX(COALESCE(max_loss, excluded.max_loss), COALESCE(excluded.max_loss, max_loss)),
+            tp = tp + excluded.tp,
+            fp = fp + excluded.fp,
+            fn = fn + excluded.fn,
+            first_seen = MIN(COALESCE(first_seen, excluded.first_seen), COALESCE(excluded.first_seen, first_seen))
+    ''', [key + tuple(value) for key, value in summary.items()])
+    conn.executemany('''
+        INSERT INTO loss_histogram (model, root_dir_id, class_id, bucket, count) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (model, root_dir_id, class_id, bucket) DO UPDATE SET count = count + excluded.count
+    ''', [key + (count,) for key, count in bucket_counts.items()])
+    conn.executemany('''
+        INSERT INTO loss_series (model, resolution, start, count, loss_sum, min_loss, max_loss) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (model, resolution, start) DO UPDATE SET
+            count = count + excluded.count,
+            loss_sum = loss_sum + excluded.loss_sum,
+            min_loss = MIN(min_loss, excluded.min_loss),
+            max_loss = MAX(max_loss, excluded.max_loss)
+    ''', [key + tuple(value) for key, value in points.items()])
+
+def record(conn: sqlite3.Connection, rows: Sequence[Tuple[Any, ...]]) -> None:
+    """Add newly inserted (model, file, base_path, predictions_json, loss, timestamp) rows to the aggregates.
+
+    Rows of images with labels also add per class true positives, false
+    positives and false negatives. The caller commits.
+    """
+    if not rows or not _has_predictions(conn):
+        return
+    images = {file: info for file, (_, info) in _images(conn, 'file', list({row[1] for row in rows})).items()}
+    _write(conn, *_aggregate(rows, images))
+
+def relabel(conn: sqlite3.Connection, old_labels: Dict[int, List[Dict[str, Any]]]) -> None:
+    """Move the aggregates of images whose labels were just rewritten from their old labels to the stored ones.
+
+    Every prediction of those images is counted again with the old and with
+    the new labels, and the difference is applied: tp, fp, fn and which
+    classes an image's loss counts for. A class an image no longer belongs
+    to keeps its min_loss and max_loss. The caller commits.
+    """
+    if not old_labels or not _has_predictions(conn):
+        return
+    images = _images(conn, 'id', list(old_labels))
+    new = {file: info for file, info in images.values()}
+    old = {file: (root_dir_id, old_labels[image_id], class_names) for image_id, (file, (root_dir_id, _, class_names)) in images.items()}
+    files = list(new)
+    rows: List[Tuple[Any, ...]] = []
+    for i in range(0, len(files), CHUNK_ROWS):
+        chunk = files[i:i + CHUNK_ROWS]
+        rows += conn.execute(f'''
+            SELECT model, file, base_path, predictions, loss, timestamp FROM model_predictions
+            WHERE file IN ({", ".join("?" * len(chunk))})
+        ''', chunk).fetchall()
+    if not rows:
+        return
+    (new_summary, new_buckets, _), (old_summary, old_buckets, _) = _aggregate(rows, new), _aggregate(rows, old)
+    empty = [0, 0.0, 0.0, None, None, 0, 0, 0, None]
+    summary = {}
+    for key in new_summary.keys() | old_summary.keys():
+        n, o = new_summary.get(key, empty), old_summary.get(key, empty)
+        delta = [a - b for a, b in zip(n[:3], o[:3])] + n[3:5] + [a - b for a, b in zip(n[5:8], o[5:8])] + [n[8]]
+        if any(delta[:3]) or any(delta[5:8]):
+            summary[key] = delta
+    buckets = {key: new_buckets.get(key, 0) - old_buckets.get(key, 0) for key in new_buckets.keys() | old_buckets.keys()}
+    buckets = {key: count for key, count in buckets.items() if count}
+    _write(conn, summary, buckets, {})
+    conn.executemany('''DELETE FROM loss_summary WHERE model = ? AND root_dir_id = ? AND class_id = ?
+                          AND count = 0 AND tp = 0 AND fp = 0 AND fn = 0''', list(summary))
+    conn.executemany('''DELETE FROM loss_histogram WHERE model = ? AND root_dir_id = ? AND class_id = ? AND bucket = ?
+                          AND count = 0''', list(buckets))
+
+def rebuild_loss_overview(conn: sqlite3.Connection) -> None:
+    """Recompute the aggregates from every stored prediction, record keeps them current afterwards"""
+    conn.execute('DELETE FROM loss_summary')
+    conn.execute('DELETE FROM loss_histogram')
+    conn.execute('DELETE FROM loss_series')
+    last_id = 0
+    while True:
+        rows = conn.execute('''
+            SELECT id, model, file, base_path, predictions, loss, timestamp FROM model_predictions
+            WHERE id > ? ORDER BY id LIMIT ?
+        ''', (last_id, CHUNK_ROWS)).fetchall()
+        if not rows:
+            return
+        record(conn, [tuple(row)[1:] for row in rows])
+        last_id = rows[-1][0]
+
+def percentiles(counts: Dict[int, int], qs: Sequence[float] = PERCENTILES) -> Dict[str, Optional[float]]:
+    """Percentiles estimated from histogram bucket counts, interpolated linearly inside a bucket"""
+    total = sum(counts.values())
+    out: Dict[str, Optional[float]] = {}
+    for q in qs:
+        name = f"p{q * 100:g}"
+        if not total:
+            out[name] = None
+            continue
+        target, seen = q * total, 0
+        for bucket in sorted(counts):
+            if seen + counts[bucket] >= target:
+                out[name] = (bucket + (target - seen) / counts[bucket]) * BUCKET_WIDTH
+                break
+            seen += counts[bucket]
+    return out
+
+def _filters(collection_id: Optional[int]) -> Tuple[str, Tuple[Any, ...]]:
+    return ('', ()) if collection_id is None else ('AND root_dir_id = ?', (collection_id,))
+
+def summaries(conn: sqlite3.Connection, class_id: int = ALL_CLASSES, collection_id: Optional[int] = None,
+              models: Optional[Sequence[str]] = None, group_by_class: bool = False) -> List[Dict[str, Any]]:
+    """Count, mean, spread, percentiles, precision and recall per model, or per class of one model"""
+    collection_sql, params = _filters(collection_id)
+    where = 'class_id != ?' if group_by_class else 'class_id = ?'
+    model_sql = f'AND model IN ({", ".join("?" * len(models))})' if models else ''
+    key = 'class_id' if group_by_class else 'model'
+    rows = conn.execute(f'''
+        SELECT {key}, SUM(count), SUM(loss_sum), SUM(loss_sq_sum), MIN(min_loss), MAX(max_loss),
+               SUM(tp), SUM(fp), SUM(fn), MIN(first_seen)
+        FROM loss_summary
+        WHERE {where} {collection_sql} {model_sql}
+        GROUP BY {key}
+        ORDER BY MIN(first_seen), {key}
+    ''', (class_id, *params, *(models or ()))).fetchall()
+    hist_rows = conn.execute(f'''
+        SELECT {key}, bucket, SUM(count) FROM loss_histogram
+        WHERE {where} {collection_sql} {model_sql}
+        GROUP BY {key}, bucket
+    ''', (class_id, *params, *(models or ()))).fetchall()
+    buckets: Dict[Any, Dict[int, int]] = defaultdict(dict)
+    for name, bucket, count in hist_rows:
+        buckets[name][bucket] = count
+    out = []
+    for name, count, loss_sum, loss_sq_sum, min_loss, max_loss, tp, fp, fn, first_seen in rows:
+        mean = loss_sum / count if count else None
+        out.append({
+            key: name,
+            'count': count,
+            'mean_loss': mean,
+            'std_loss': max(loss_sq_sum / count - mean * mean, 0.0) ** 0.5 if count else None,
+            'min_loss': min_loss,
+            'max_loss': max_loss,
+            **percentiles(buckets.get(name, {})),
+            'precision': tp / (tp + fp) if tp + fp else None,
+            'recall': tp / (tp + fn) if tp + fn else None,
+            'first_seen': str(first_seen) if first_seen is not None else None,
+        })
+    return out
+
+def histogram(conn: sqlite3.Connection, model: str, class_id: int = ALL_CLASSES, collection_id: Optional[int] = None) -> List[int]:
+    """Image counts per loss bucket of BUCKET_WIDTH, from 0 to LOSS_MAX"""
+    collection_sql, params = _filters(collection_id)
+    counts = [0] * BUCKETS
+    for bucket, count in conn.execute(f'''
+        SELECT bucket, SUM(count) FROM loss_histogram
+        WHERE model = ? AND class_id = ? {collection_sql}
+        GROUP BY bucket
+    ''', (model, class_id, *params)):
+        counts[bucket] = count
+    return counts
+
+def series(conn: sqlite3.Connection, model: str, resolution: str = 'hour', since: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Loss over prediction time, one point per resolution interval starting at epoch second `start`"""
+    rows = conn.execute('''
+        SELECT start, count, loss_sum, min_loss, max_loss FROM loss_series
+        WHERE model = ? AND resolution = ? AND start >= ?
+        ORDER BY start
+    ''', (model, RESOLUTIONS[resolution], since or 0)).fetchall()
+    return [{'start': start, 'count': count, 'mean_loss': loss_sum / count, 'min_loss': min_loss, 'max_loss': max_loss}
+            for start, count, loss_sum, min_loss, max_loss in rows]
+
+if __name__ == "__main__":
+    conn = database.connect(sys.argv[1] if len(sys.argv) > 1 else database.DB_PATH)
+    create_loss_overview(conn)
+    rebuild_loss_overview(conn)
+    conn.commit()
@@ -0,0 +1,171 @@
+import numpy as np
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+IOU_THRESHOLD: float = 0.5
+
+Metrics = Tuple[float, float, float, float]
+
+def pairwise_iou(boxes1: np.ndarray, boxes2: np.ndarray) -> np.ndarray:
+    """IoU matrix for normalized xywh boxes, (..., P, 4) and (..., G, 4) give (..., P, G)"""
+    b1 = boxes1[..., :, None, :]
+    b2 = boxes2[..., None, :, :]
+    inter_w = np.minimum(b1[..., 0] + b1[..., 2]/2, b2[..., 0] + b2[..., 2]/2) - np.maximum(b1[..., 0] - b1[..., 2]/2, b2[..., 0] - b2[..., 2]/2)
+    inter_h = np.minimum(b1[..., 1] + b1[..., 3]/2, b2[..., 1] + b2[..., 3]/2) - np.maximum(b1[..., 1] - b1[..., 3]/2, b2[..., 1] - b2[..., 3]/2)
+    inter_area = np.maximum(inter_w, 0) * np.maximum(inter_h, 0)
+    union_area = b1[..., 2] * b1[..., 3] + b2[..., 2] * b2[..., 3] - inter_area
+    return np.divide(inter_area, union_area, out=np.zeros_like(inter_area), where=union_area > 0)
+
+def greedy_match(iou: np.ndarray, threshold: float = IOU_THRESHOLD) -> np.ndarray:
+    """Match each prediction, in order, to the unused ground truth box with the highest IoU.
+
+    `iou` is a (P, G) matrix that is already zero where classes differ. Returns
+    the matched ground truth index per prediction, -1 where the best remaining
+    IoU is not above threshold. Only rows that compete for the same ground
+    truth box fall back to a sequential pass.
+    """
+    matches = np.full(iou.shape[0], -1, dtype=np.int64)
+    if iou.size == 0:
+        return matches
+    best = iou.argmax(axis=1)
+    rows = np.flatnonzero(iou[np.arange(iou.shape[0]), best] > threshold)
+    if len(np.unique(best[rows])) == len(rows):
+        matches[rows] = best[rows]
+        return matches
+    available = np.ones(iou.shape[1], dtype=bool)
+    for row in rows:
+        masked = np.where(available, iou[row], 0.0)
+        col = masked.argmax()
+        if masked[col] > threshold:
+            matches[row] = col
+            available[col] = False
+    return matches
+
+def _pad(items: Sequence[List[Dict[str, Any]]], codes: Dict[Any, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Stack per-image box lists into padded (B, N, 4) boxes, (B, N) class codes and (B, N) validity"""
+    counts = np.fromiter((len(image_boxes) for image_boxes in items), dtype=np.int64, count=len(items))
+    n = int(counts.max()) if len(counts) else 0
+    flat = [b for image_boxes in items for b in image_boxes]
+    image_idx = np.repeat(np.arange(len(items)), counts)
+    pos = np.arange(len(flat)) - np.repeat(np.cumsum(counts) - counts, counts)
+    boxes = np.zeros((len(items), n, 4), dtype=np.float64)
+    classes = np.full((len(items), n), -1, dtype=np.int64)
+    valid = np.zeros((len(items), n), dtype=bool)
+    if flat:
+        boxes[image_idx, pos] = np.array([b['bbox'] for b in flat], dtype=np.float64)
+        classes[image_idx, pos] = [codes.setdefault(b['class'], len(codes)) for b in flat]
+        valid[image_idx, pos] = True
+    return boxes, classes, valid
+
+def batch_metrics(pred_boxes: np.ndarray, pred_cls: np.ndarray, pred_valid: np.ndarray,
+                  gt_boxes: np.ndarray, gt_cls: np.ndarray, gt_valid: np.ndarray,
+                  threshold: float = IOU_THRESHOLD) -> np.ndarray:
+    """Precision, recall, avg_iou and class_acc for a padded batch, returns a (B, 4) array"""
+    same_class = (pred_cls[:, :, None] == gt_cls[:, None, :]) & pred_valid[:, :, None] & gt_valid[:, None, :]
+    iou = np.where(same_class, pairwise_iou(pred_boxes, gt_boxes), 0.0)
+    n_pred = pred_valid.sum(axis=1)
+    n_gt = gt_valid.sum(axis=1)
+    tp = np.zeros(len(iou), dtype=np.int64)
+    iou_sum = np.zeros(len(iou), dtype=np.float64)
+    if iou.shape[1] and iou.shape[2]:
+        best = iou.argmax(axis=2)
+        best_iou = np.take_along_axis(iou, best[:, :, None], axis=2)[:, :, 0]
+        hit = best_iou > threshold
+        # images where two predictions want the same ground truth box need the sequential pass
+        image_idx, pred_idx = np.nonzero(hit)
+        keys = image_idx * iou.shape[2] + best[image_idx, pred_idx]
+        uniq, counts = np.unique(keys, return_counts=True)
+        conflicted = np.zeros(len(iou), dtype=bool)
+        conflicted[uniq[counts > 1] // iou.shape[2]] = True
+        clean = hit & ~conflicted[:, None]
+        tp += clean.sum(axis=1)
+        iou_sum += np.where(clean, best_iou, 0.0).sum(axis=1)
+        for i in np.flatnonzero(conflicted):
+            matches = greedy_match(iou[i], threshold)
+            matched = np.flatnonzero(matches >= 0)
+            tp[i] = len(matched)
+            iou_sum[i] = iou[i, matched, matches[matched]].sum()
+    gt_seen = (same_class.any(axis=1) & gt_valid).sum(axis=1)
+    precision = np.divide(tp, n_pred, out=np.zeros(len(iou)), where=n_pred > 0)
+    recall = np.divide(tp, n_gt, out=np.zeros(len(iou)), where=n_gt > 0)
+    avg_iou = np.divide(iou_sum, tp, out=np.zeros(len(iou)), where=tp > 0)
+    class_acc = np.divide(gt_seen, n_gt, out=np.zeros(len(iou)), where=n_gt > 0)
+    return np.stack([precision, recall, avg_iou, class_acc], axis=1)
+
+def calculate_metrics_batch(pairs: Sequence[Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]],
+                            threshold: float = IOU_THRESHOLD) -> List[Metrics]:
+    """calculate_metrics for many (predictions, ground_truth) pairs at once"""
+    if not pairs:
+        return []
+    codes: Dict[Any, int] = {}
+    pred_boxes, pred_cls, pred_valid = _pad([p for p, _ in pairs], codes)
+    gt_boxes, gt_cls, gt_valid = _pad([g for _, g in pairs], codes)
+    metrics = batch_metrics(pred_boxes, pred_cls, pred_valid, gt_boxes, gt_cls, gt_valid, threshold)
+    return [tuple(float(v) for v in row) for row in metrics]
+
+def match_batch(boxes_a: np.ndarray, valid_a: np.ndarray, boxes_b: np.ndarray, valid_b: np.ndarray,
+                threshold: float = IOU_THRESHOLD, cls_a: Optional[np.ndarray] = None,
+                cls_b: Optional[np.ndarray] = None) -> np.ndarray:
+    """One to one matching of a padded batch, returns the (B, Na) index into b, -1 where unmatched.
+
+    Boxes match whatever their class unless cls_a and cls_b are given.
+    """
+    pairs = valid_a[:, :, None] & valid_b[:, None, :]
+    if cls_a is not None and cls_b is not None:
+        pairs &= cls_a[:, :, None] == cls_b[:, None, :]
+    iou = np.where(pairs, pairwise_iou(boxes_a, boxes_b), 0.0)
+    matches = np.full(iou.shape[:2], -1, dtype=np.int64)
+    if not (iou.shape[1] and iou.shape[2]):
+        return matches
+    best = iou.argmax(axis=2)
+    hit = np.take_along_axis(iou, best[:, :, None], axis=2)[:, :, 0] > threshold
+    image_idx, box_idx = np.nonzero(hit)
+    keys = image_idx * iou.shape[2] + best[image_idx, box_idx]
+    uniq, counts = np.unique(keys, return_counts=True)
+    conflicted = np.zeros(len(iou), dtype=bool)
+    conflicted[uniq[counts > 1] // iou.shape[2]] = True
+    clean = hit & ~conflicted[:, None]
+    matches[clean] = best[clean]
+    for i in np.flatnonzero(conflicted):
+        matches[i] = greedy_match(iou[i], threshold)
+    return matches
+
+def compare_batch(pairs: Sequence[Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]],
+                  threshold: float = IOU_THRESHOLD) -> List[Tuple[int, int]]:
+    """(matched, class_flips) for many (boxes_a, boxes_b) pairs, boxes are matched on IoU whatever their class"""
+    if not pairs:
+        return []
+    codes: Dict[Any, int] = {}
+    boxes_a, cls_a, valid_a = _pad([a for a, _ in pairs], codes)
+    boxes_b, cls_b, valid_b = _pad([b for _, b in pairs], codes)
+    matches = match_batch(boxes_a, valid_a, boxes_b, valid_b, threshold)
+    matched = matches >= 0
+    flipped = matched & (cls_a != np.take_along_axis(cls_b, np.maximum(matches, 0), axis=1)) if cls_b.shape[1] else matched
+    return [(int(m), int(f)) for m, f in zip(matched.sum(axis=1), flipped.sum(axis=1))]
+
+def class_counts_batch(pairs: Sequence[Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]],
+                       threshold: float = IOU_THRESHOLD) -> List[Dict[Any, Tuple[int, int, int]]]:
+    """Per class (true positives, false positives, false negatives) for many (predictions, ground_truth) pairs"""
+    if not pairs:
+        return []
+    codes: Dict[Any, int] = {}
+    pred_boxes, pred_cls, pred_valid = _pad([p for p, _ in pairs], codes)
+    gt_boxes, gt_cls, gt_valid = _pad([g for _, g in pairs], codes)
+    matches = match_batch(pred_boxes, pred_valid, gt_boxes, gt_valid, threshold, pred_cls, gt_cls)
+    gt_matched = np.zeros(gt_valid.shape, dtype=bool)
+    image_idx, pred_idx = np.nonzero(matches >= 0)
+    gt_matched[image_idx, matches[image_idx, pred_idx]] = True
+    names = {code: name for name, code in codes.items()}
+    n = len(codes) + 1
+    # one bincount per kind over (image, class) keys
+    count = lambda mask, cls: np.bincount((np.arange(len(pairs))[:, None] * n + cls)[mask], minlength=len(pairs) * n).reshape(-1, n)
+    tp, fp = count(matches >= 0, pred_cls), count(pred_valid & (matches < 0), pred_cls)
+    fn = count(gt_valid & ~gt_matched, gt_cls)
+    out = []
+    for i in range(len(pairs)):
+        present = np.flatnonzero(tp[i] + fp[i] + fn[i])
+        out.append({names[c]: (int(tp[i, c]), int(fp[i, c]), int(fn[i, c])) for c in present})
+    return out
+
+def calculate_metrics(predictions: List[Dict[str, Any]], ground_truth: List[Dict[str, Any]]) -> Metrics:
+    """Calculate precision, recall, avg_iou, and class_accuracy"""
+    return calculate_metrics_batch([(predictions, ground_truth)])[0]
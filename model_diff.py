@@ -0,0 +1,202 @@
+import sys
+import json
+import sqlite3
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import database
+import boxes
+from matching import compare_batch
+
+CHUNK_ROWS: int = 2000
+# sort keys of a diff listing, all of them are columns of model_diffs with an index per model pair
+SORTS: Tuple[str, ...] = ('loss_delta', 'changes', 'gained', 'lost', 'class_flips')
+
+# A diff row is deleted as soon as the prediction of either of its models for
+# that file changes and the pair is marked dirty. log_predictions puts the rows
+# of registered pairs back right away, the next refresh recomputes any other
+# missing rows. Prediction jobs pay one indexed delete per row.
+TRIGGERS: List[str] = [
+    '''CREATE TRIGGER IF NOT EXISTS model_diff_predictions_insert AFTER INSERT ON model_predictions BEGIN
+        DELETE FROM model_diffs WHERE file = NEW.file AND (model_a = NEW.model OR model_b = NEW.model);
+        UPDATE model_diff_pairs SET dirty = 1 WHERE (model_a = NEW.model OR model_b = NEW.model) AND dirty = 0;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS model_diff_predictions_delete AFTER DELETE ON model_predictions BEGIN
+        DELETE FROM model_diffs WHERE file = OLD.file AND (model_a = OLD.model OR model_b = OLD.model);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS model_diff_predictions_update AFTER UPDATE OF model, file, predictions, loss ON model_predictions BEGIN
+        DELETE FROM model_diffs WHERE file = OLD.file AND (model_a = OLD.model OR model_b = OLD.model);
+        DELETE FROM model_diffs WHERE file = NEW.file AND (model_a = NEW.model OR model_b = NEW.model);
+        UPDATE model_diff_pairs SET dirty = 1 WHERE (model_a = NEW.model OR model_b = NEW.model) AND dirty = 0;
+    END''',
+]
+
+DiffRow = Tuple[str, str, int, int, str, Optional[float], Optional[float], float, int, int, int, int, int, int, int]
+
+def create_model_diff(conn: sqlite3.Connection) -> None:
+    """Create the diff tables, their indexes and the invalidation triggers"""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS model_diff_pairs (
+            model_a TEXT NOT NULL,
+            model_b TEXT NOT NULL,
+            dirty INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (model_a, model_b)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS model_diffs (
+            model_a TEXT NOT NULL,
+            model_b TEXT NOT NULL,
+            image_id INTEGER NOT NULL,
+            root_dir_id INTEGER,
+            file TEXT NOT NULL,
+            loss_a REAL,
+            loss_b REAL,
+            loss_delta REAL NOT NULL,
+            boxes_a INTEGER NOT NULL,
+            boxes_b INTEGER NOT NULL,
+            matched INTEGER NOT NULL,
+            gained INTEGER NOT NULL,
+            lost INTEGER NOT NULL,
+            class_flips INTEGER NOT NULL,
+            changes INTEGER NOT NULL,
+            PRIMARY KEY (model_a, model_b, image_id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_model_diffs_file ON model_diffs(file)')
+    for sort in SORTS:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_model_diffs_{sort} ON model_diffs(model_a, model_b, {sort}, image_id)')
+    if 'model_predictions' in tables:
+        for statement in TRIGGERS:
+            conn.execute(statement)
+    conn.commit()
+
+def prediction_boxes(predictions_json: Optional[str], class_names: Sequence[str] = ()) -> List[Dict[str, Any]]:
+    # older runs stored class names and newer ones class ids, both become the collection's class ids
+    predictions = json.loads(predictions_json) if predictions_json else []
+    return [{'bbox': boxes.box_coordinates(p), 'class': boxes.class_id_for(p, class_names)} for p in predictions]
+
+def diff_rows(model_a: str, model_b: str, rows: Sequence[Tuple[Any, ...]]) -> List[DiffRow]:
+    """Diff rows for (image_id, root_dir_id, file, predictions_a, loss_a, predictions_b, loss_b, label_classes) rows.
+
+    Boxes of the two models are matched on IoU alone, a matched pair with
+    different classes is a class flip. Boxes only model_b has are gained,
+    boxes only model_a has are lost. loss_delta is loss_b - loss_a, 0 when
+    either loss is missing, so a positive delta is a regression of model_b.
+    """
+    class_names = [row[7].split(" ") if row[7] else [] for row in rows]
+    pairs = [(prediction_boxes(row[3], names), prediction_boxes(row[5], names)) for row, names in zip(rows, class_names)]
+    out: List[DiffRow] = []
+    for (image_id, root_dir_id, file, _, loss_a, _, loss_b, _), (a, b), (matched, flips) in zip(rows, pairs, compare_batch(pairs)):
+        delta = loss_b - loss_a if loss_a is not None and loss_b is not None else 0.0
+        gained, lost = len(b) - matched, len(a) - matched
+        out.append((model_a, model_b, image_id, root_dir_id, file, loss_a, loss_b, delta,
+                    len(a), len(b), matched, gained, lost, flips, gained + lost + flips))
+    return out
+
+PAIR_ROWS_SQL: str = '''
+    SELECT i.id, i.root_dir_id, i.file, pa.predictions, pa.loss, pb.predictions, pb.loss, r.label_classes, pa.id, pb.id
+    FROM model_predictions AS pa
+    JOIN model_predictions AS pb ON pb.file = pa.file AND pb.model = ?
+    JOIN images AS i ON i.file = pa.file
+    LEFT JOIN root_dirs AS r ON r.id = i.root_dir_id
+'''
+
+def is_registered(conn: sqlite3.Connection, model_a: str, model_b: str) -> bool:
+    return conn.execute('SELECT 1 FROM model_diff_pairs WHERE model_a = ? AND model_b = ?', (model_a, model_b)).fetchone() is not None
+
+def write_rows(conn: sqlite3.Connection, model_a: str, model_b: str, rows: Sequence[Tuple[Any, ...]]) -> None:
+    """Store the diffs of PAIR_ROWS_SQL rows, the diff_rows columns followed by the two prediction ids.
+
+    A row is only stored while both predictions are still the ones it was
+    computed from, a prediction changed in the meantime already deleted it.
+    """
+    guard = 'EXISTS (SELECT 1 FROM model_predictions WHERE id = ? AND predictions IS ? AND loss IS ?)'
+    conn.executemany(f'INSERT OR REPLACE INTO model_diffs SELECT {", ".join("?" * 15)} WHERE {guard} AND {guard}',
+                     [(*diff, row[8], row[3], row[4], row[9], row[5], row[6])
+                      for row, diff in zip(rows, diff_rows(model_a, model_b, [tuple(row)[:8] for row in rows]))])
+
+def update(conn: sqlite3.Connection, model: str, files: Sequence[str]) -> int:
+    """Diff rows of files just predicted by model for every registered pair it is part of, the caller commits"""
+    pairs = conn.execute('SELECT model_a, model_b FROM model_diff_pairs WHERE model_a = ? OR model_b = ?', (model, model)).fetchall()
+    computed = 0
+    for model_a, model_b in pairs:
+        for start in range(0, len(files), CHUNK_ROWS):
+            chunk = files[start:start + CHUNK_ROWS]
+            rows = conn.execute(f'{PAIR_ROWS_SQL} WHERE pa.model = ? AND pa.file IN ({", ".join("?" * len(chunk))})',
+                                (model_b, model_a, *chunk)).fetchall()
+            write_rows(conn, model_a, model_b, rows)
+            computed += len(rows)
+    return computed
+
+def refresh(conn: sqlite3.Connection, model_a: str, model_b: str) -> int:
+    """Register a pair and compute its missing diff rows, returns how many were computed.
+
+    Meant for the CLI and batch jobs, it commits. A clean pair costs one
+    primary key lookup. Rows are computed outside of a transaction and every
+    chunk is written in its own short one, so prediction jobs and label edits
+    only ever wait for one chunk insert. A prediction written meanwhile marks
+    the pair dirty again for the next refresh.
+    """
+    row = conn.execute('SELECT dirty FROM model_diff_pairs WHERE model_a = ? AND model_b = ?', (model_a, model_b)).fetchone()
+    if row is not None and not row[0]:
+        return 0
+    conn.execute('''INSERT INTO model_diff_pairs (model_a, model_b, dirty) VALUES (?, ?, 0)
+                    ON CONFLICT (model_a, model_b) DO UPDATE SET dirty = 0''', (model_a, model_b))
+    conn.commit()
+    computed, last_id = 0, 0
+    while True:
+        rows = conn.execute(f'''{PAIR_ROWS_SQL}
+            WHERE pa.model = ? AND pa.id > ? AND NOT EXISTS (
+                SELECT 1 FROM model_diffs AS d WHERE d.model_a = ? AND d.model_b = ? AND d.image_id = i.id)
+            ORDER BY pa.id
+            LIMIT ?
+        ''', (model_b, model_a, last_id, model_a, model_b, CHUNK_ROWS)).fetchall()
+        if not rows:
+            return computed
+        last_id = rows[-1][8]
+        write_rows(conn, model_a, model_b, rows)
+        conn.commit()
+        computed += len(rows)
+
+def diff_page(conn: sqlite3.Connection, model_a: str, model_b: str, sort: str = 'loss_delta', descending: bool = True,
+              collection_id: Optional[int] = None, after: Optional[Sequence[Any]] = None, limit: int = 200) -> List[Dict[str, Any]]:
+    """One page of a pair's diff ranked by sort, `after` is the (sort value, image_id) keyset of the last row seen"""
+    if sort not in SORTS:
+        raise ValueError(f"unknown sort {sort}, expected one of {SORTS}")
+    cmp, order = ('<', 'DESC') if descending else ('>', 'ASC')
+    where, params = ['model_a = ?', 'model_b = ?'], [model_a, model_b]
+    if collection_id is not None:
+        where.append('root_dir_id = ?')
+        params.append(collection_id)
+    if after is not None:
+        where.append(f'({sort}, image_id) {cmp} (?, ?)')
+        params += list(after)
+    rows = conn.execute(f'''
+        SELECT image_id, root_dir_id, file, loss_a, loss_b, loss_delta, boxes_a, boxes_b,
+               matched, gained, lost, class_flips, changes
+        FROM model_diffs
+        WHERE {" AND ".join(where)}
+        ORDER BY {sort} {order}, image_id {order}
+        LIMIT ?
+    ''', (*params, limit)).fetchall()
+    keys = ('image_id', 'root_dir_id', 'file', 'loss_a', 'loss_b', 'loss_delta', 'boxes_a', 'boxes_b',
+            'matched', 'gained', 'lost', 'class_flips', 'changes')
+    return [dict(zip(keys, row)) for row in rows]
+
+def diff_summary(conn: sqlite3.Connection, model_a: str, model_b: str, collection_id: Optional[int] = None) -> Dict[str, Any]:
+    """Totals of a pair's diff, optionally for one collection"""
+    collection_sql = '' if collection_id is None else 'AND root_dir_id = ?'
+    row = conn.execute(f'''
+        SELECT COUNT(*), SUM(loss_delta > 0), SUM(loss_delta < 0), AVG(loss_delta),
+               SUM(gained), SUM(lost), SUM(class_flips), SUM(changes > 0)
+        FROM model_diffs WHERE model_a = ? AND model_b = ? {collection_sql}
+    ''', (model_a, model_b, *(() if collection_id is None else (collection_id,)))).fetchone()
+    keys = ('images', 'regressed', 'improved', 'mean_loss_delta', 'gained', 'lost', 'class_flips', 'changed')
+    return {key: (value if value is not None or key == 'mean_loss_delta' else 0) for key, value in zip(keys, row)}
+
+if __name__ == "__main__":
+    # model_diff.py model_a model_b [db]: register a pair and compute its diff, /model_diff only reads it
+    conn = database.connect(sys.argv[3] if len(sys.argv) > 3 else database.DB_PATH)
+    create_model_diff(conn)
+    print(f"computed {refresh(conn, sys.argv[1], sys.argv[2])} diff rows")
+    print(diff_summary(conn, sys.argv[1], sys.argv[2]))
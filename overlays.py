@@ -0,0 +1,185 @@
+import os
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from PIL import Image, ImageDraw
+import boxes
+from thumbnails import JPEG_QUALITY
+
+CACHE_DIR: Path = Path(__file__).parent / "cache" / "overlays"
+MAX_MEMORY_BYTES: int = 64 * 1024**2
+MAX_DISK_BYTES: int = 1024**3
+MAX_SIZE: int = 2048
+PALETTE: Tuple[str, ...] = ("#e6194b", "#3cb44b", "#ffe119", "#4363d8", "#f58231",
+                            "#911eb4", "#46f0f0", "#f032e6", "#bcf60c", "#fabebe")
+LABEL_WIDTH: int = 3
+PREDICTION_WIDTH: int = 1
+
+# (class_id, x, y, w, h, conf) with normalized center xywh, conf is None for labels
+Box = Tuple[int, float, float, float, float, Optional[float]]
+
+def overlay_boxes(items: Iterable[Dict[str, Any]], class_names: Sequence[str] = ()) -> List[Box]:
+    """Labels or stored predictions as plain tuples that can be sent to a worker process"""
+    result: List[Box] = []
+    for item in items:
+        class_id = boxes.class_id_for(item, class_names)
+        if class_id is None: continue
+        x, y, w, h = boxes.box_coordinates(item)[:4]
+        result.append((class_id, x, y, w, h, item.get('conf')))
+    return result
+
+def render_overlay(image_path: Path, size: int, labels: List[Box], predictions: List[Box],
+                   class_names: Sequence[str]) -> bytes:
+    """Draw labels (thick) and predictions (thin, with confidence) on a resized image, returns jpeg bytes.
+
+    Runs in a worker process.
+    """
+    with Image.open(image_path) as img:
+        img.draft("RGB", (size, size))
+        img = img.convert("RGB")
+    img.thumbnail((size, size))
+    draw = ImageDraw.Draw(img)
+    width, height = img.size
+    for items, line_width in ((labels, LABEL_WIDTH), (predictions, PREDICTION_WIDTH)):
+        for class_id, x, y, w, h, conf in items:
+            color = PALETTE[class_id % len(PALETTE)]
+            x0, y0 = (x - w / 2) * width, (y - h / 2) * height
+            x1, y1 = (x + w / 2) * width, (y + h / 2) * height
+            draw.rectangle((x0, y0, x1, y1), outline=color, width=line_width)
+            name = class_names[class_id] if class_id < len(class_names) else str(class_id)
+            text = name if conf is None else f"{name} {conf:.2f}"
+            text_box = draw.textbbox((x0, y0), text)
+            draw.rectangle(text_box, fill=color)
+            draw.text((x0, y0), text, fill="black")
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=JPEG_QUALITY)
+    return buf.getvalue()
+
+def overlay_key(image_id: int, revision: int, size: int, labels: bool, model: Optional[str], prediction_id: Optional[int]) -> str:
+    """Cache key of one rendering. A label edit bumps the revision and a re-logged prediction gets a new row id"""
+    parts = f"{revision}:{size}:{int(labels)}:{model or ''}:{prediction_id or ''}"
+    return f"{image_id}_{hashlib.sha1(parts.encode()).hexdigest()[:16]}"
+
+class OverlayCache:
+    """Rendered overlays in a memory LRU backed by a size-bounded disk cache.
+
+    Keys start with the image id so `invalidate` can drop every rendering of
+    an image when its labels change. Renders run in a background process pool
+    and concurrent requests for the same key share one render.
+    """
+
+    def __init__(self, cache_dir: Path = CACHE_DIR, max_memory_bytes: int = MAX_MEMORY_BYTES,
+                 max_disk_bytes: int = MAX_DISK_BYTES, workers: Optional[int] = None) -> None:
+        self.cache_dir: Path = Path(cache_dir)
+        self.max_memory_bytes: int = max_memory_bytes
+        self.max_disk_bytes: int = max_disk_bytes
+        self.workers: Optional[int] = workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes: int = 0
+        self._disk_bytes: Optional[int] = None
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def _path(self, key: str) -> Path:
+        image_id = int(key.split("_", 1)[0])
+        return self.cache_dir / f"{image_id % 256:02x}" / f"{key}.jpg"
+
+    def _remember(self, key: str, data: bytes) -> None:
+        """Add to the memory LRU, the caller holds the lock"""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes and self._memory:
+            _, old = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old)
+
+    def _disk_usage(self) -> int:
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(p.stat().st_size for p in self.cache_dir.rglob("*.jpg")) if self.cache_dir.exists() else 0
+        return self._disk_bytes
+
+    def _store(self, key: str, data: bytes) -> None:
+        out = self._path(key)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        tmp = out.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, out)
+        with self._lock:
+            self._remember(key, data)
+            self._disk_bytes = self._disk_usage() + len(data)
+            over = self._disk_bytes > self.max_disk_bytes
+        if over:
+            self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently served files until the disk cache is below 90% of max_disk_bytes"""
+        files = sorted((p.stat().st_mtime, p.stat().st_size, p) for p in self.cache_dir.rglob("*.jpg"))
+        total = sum(size for _, size, _ in files)
+        target = int(self.max_disk_bytes * 0.9)
+        for _, size, p in files:
+            if total <= target:
+                break
+            p.unlink(missing_ok=True)
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+
+    def get(self, key: str, image_path: Path, size: int, labels: List[Box], predictions: List[Box],
+            class_names: Sequence[str], timeout: Optional[float] = None) -> bytes:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+        out = self._path(key)
+        if out.exists():
+            data = out.read_bytes()
+            os.utime(out)
+            with self._lock:
+                self._remember(key, data)
+            return data
+        with self._lock:
+            fut = self._pending.get(key)
+            if fut is None:
+                fut = self._executor().submit(render_overlay, Path(image_path), size, labels, predictions, list(class_names))
+                self._pending[key] = fut
+                owner = True
+            else:
+                owner = False
+        try:
+            data = fut.result(timeout=timeout)
+        finally:
+            if owner:
+                with self._lock:
+                    self._pending.pop(key, None)
+        if owner:
+            self._store(key, data)
+        return data
+
+    def invalidate(self, image_id: int) -> None:
+        """Drop every cached rendering of an image"""
+        prefix = f"{image_id}_"
+        with self._lock:
+            for key in [k for k in self._memory if k.startswith(prefix)]:
+                self._memory_bytes -= len(self._memory.pop(key))
+        removed = 0
+        for p in (self.cache_dir / f"{image_id % 256:02x}").glob(f"{prefix}*.jpg"):
+            removed += p.stat().st_size
+            p.unlink(missing_ok=True)
+        if removed:
+            with self._lock:
+                self._disk_bytes = self._disk_usage() - removed
+
+cache: OverlayCache = OverlayCache()
@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+base_path = Path(__file__).parent.parent
+sys.path.insert(0, str(base_path))
+sys.path.insert(0, str(Path(__file__).parent))
+import database
+import boxes
+import collection_stats
+import model_diff
+import db
+from matching import calculate_metrics_batch
+
+CLASSES = ['ball', 'goalkeeper', 'player', 'referee']
+MODELS = ['bench_a', 'bench_b']
+INSERT_BATCH = 50000
+
+def random_boxes(rng: random.Random, max_boxes: int = 12, conf: bool = False) -> List[Dict[str, Any]]:
+    result = []
+    for _ in range(rng.randint(0, max_boxes)):
+        w, h = rng.uniform(0.01, 0.3), rng.uniform(0.01, 0.3)
+        box = {'class': rng.randrange(len(CLASSES)),
+               'coordinates': [rng.uniform(w / 2, 1 - w / 2), rng.uniform(h / 2, 1 - h / 2), w, h]}
+        if conf:
+            box['conf'] = rng.uniform(0.25, 1.0)
+        result.append(box)
+    return result
+
+def jitter(rng: random.Random, labels: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Predictions that mostly agree with the labels, like a reasonable model"""
+    predictions = []
+    for label in labels:
+        if rng.random() < 0.1: continue
+        x, y, w, h = label['coordinates']
+        predictions.append({'class_id': label['class'] if rng.random() > 0.05 else rng.randrange(len(CLASSES)),
+                            'class': CLASSES[label['class']], 'conf': rng.uniform(0.25, 1.0),
+                            'bbox': [x + rng.gauss(0, 0.01), y + rng.gauss(0, 0.01), w * rng.uniform(0.9, 1.1), h * rng.uniform(0.9, 1.1)]})
+    return predictions + [dict(b, class_id=b['class'], bbox=b['coordinates']) for b in random_boxes(rng, 2, conf=True)]
+
+def generate_db(db_name: Path, images: int, collections: int = 100, labeled: float = 0.5,
+                models: List[str] = MODELS, seed: int = 0) -> None:
+    """Write a synthetic images.db with random labels and model_predictions rows, the files do not exist"""
+    rng = random.Random(seed)
+    db.create_db(db_name)
+    conn = database.connect(db_name)
+    # scritps/model_predictions.py imports ultralytics, so its table is made here with the indexes and triggers on it
+    database.create_model_predictions(conn)
+    database.create_indexes(conn)
+    collection_stats.create_collection_stats(conn)
+    model_diff.create_model_diff(conn)
+    conn.executemany('INSERT INTO root_dirs (root_dir, label_classes) VALUES (?, ?)',
+                     [(f'/synthetic/match_{c:04d}', ' '.join(CLASSES)) for c in range(collections)])
+    root_ids = [row[0] for row in conn.execute('SELECT id FROM root_dirs ORDER BY id')]
+    for start in range(0, images, INSERT_BATCH):
+        count = min(INSERT_BATCH, images - start)
+        names = [f'frame_{start + i:08d}.jpg' for i in range(count)]
+        conn.executemany('INSERT INTO images (root_dir_id, file, mtime, size) VALUES (?, ?, 0, 0)',
+                         [(root_ids[(start + i) * collections // images], name) for i, name in enumerate(names)])
+        first_id = conn.execute('SELECT id FROM images WHERE file = ?', (names[0],)).fetchone()[0]
+        label_rows, box_rows, prediction_rows = [], [], []
+        for i, name in enumerate(names):
+            image_id = first_id + i
+            labels = random_boxes(rng) if rng.random() < labeled else []
+            label_rows.append((image_id, json.dumps(labels) if labels else None))
+            box_rows += boxes.box_rows(image_id, labels, boxes.SOURCE_LABEL)
+            for model in models:
+                predictions = jitter(rng, labels)
+                prediction_rows.append((model, name, '/synthetic', json.dumps(predictions), rng.random() * 3, datetime.now()))
+                box_rows += boxes.box_rows(image_id, predictions, boxes.SOURCE_PREDICTION, model)
+        conn.executemany('INSERT INTO labels (image_id, labels_json) VALUES (?, ?)', label_rows)
+        conn.executemany('''INSERT INTO boxes (image_id, class_id, x, y, w, h, conf, source, model)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', box_rows)
+        conn.executemany('''INSERT INTO model_predictions (model, file, base_path, predictions, loss, timestamp)
+                            VALUES (?, ?, ?, ?, ?, ?)''', prediction_rows)
+        conn.commit()
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+def generate_jpeg_tree(root: Path, dirs: int, per_dir: int, size: int = 64, seed: int = 0) -> Path:
+    """Small random JPEGs under root/images/dir_*/ and matching YOLO label files under root/labels/dir_*/"""
+    from PIL import Image
+    rng = random.Random(seed)
+    for d in range(dirs):
+        image_dir, label_dir = root / 'images' / f'dir_{d:03d}', root / 'labels' / f'dir_{d:03d}'
+        image_dir.mkdir(parents=True, exist_ok=True)
+        label_dir.mkdir(parents=True, exist_ok=True)
+        for i in range(per_dir):
+            name = f'd{d:03d}_{i:06d}'
+            Image.frombytes('RGB', (size, size), rng.randbytes(size * size * 3)).save(image_dir / f'{name}.jpg', quality=80)
+            lines = [f"{b['class']} " + ' '.join(f'{v:.6f}' for v in b['coordinates']) for b in random_boxes(rng, 6)]
+            (label_dir / f'{name}.txt').write_text('\n'.join(lines))
+    return root
+
+def summarize(name: str, samples: List[float], **extra: Any) -> Dict[str, Any]:
+    ordered = sorted(samples)
+    result = {
+        'name': name,
+        'runs': len(samples),
+        'min': ordered[0],
+        'median': statistics.median(ordered),
+        'mean': statistics.fmean(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'max': ordered[-1],
+    }
+    result.update(extra)
+    return result
+
+def timed(name: str, fn: Callable[[], Any], repeat: int = 3, setup: Optional[Callable[[], Any]] = None, **extra: Any) -> Dict[str, Any]:
+    """Run fn repeat times after an optional setup each time, returns wall clock seconds"""
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summarize(name, samples, **extra)
+
+def jpeg_tree(work: Path, dirs: int, per_dir: int) -> Path:
+    tree = work / f'tree_{dirs}x{per_dir}'
+    if not tree.exists():
+        generate_jpeg_tree(tree, dirs, per_dir)
+    return tree
+
+def bench_ingest(work: Path, dirs: int, per_dir: int, repeat: int) -> List[Dict[str, Any]]:
+    tree = jpeg_tree(work, dirs, per_dir)
+    db_name = work / 'ingest.db'
+    n = dirs * per_dir
+
+    def fresh():
+        for suffix in ('', '-wal', '-shm'):
+            Path(f'{db_name}{suffix}').unlink(missing_ok=True)
+        db.create_db(db_name)
+
+    results = [timed('ingest.images', lambda: db.populate_db_with_images(tree / 'images', db_name), repeat, fresh, images=n)]
+    results.append(timed('ingest.images_unchanged', lambda: db.populate_db_with_images(tree / 'images', db_name), repeat, images=n))
+    results.append(timed('ingest.labels', lambda: db.update_db_with_labels(tree / 'labels', db_name, full=True), repeat, images=n))
+    results.append(timed('ingest.labels_unchanged', lambda: db.update_db_with_labels(tree / 'labels', db_name), repeat, images=n))
+    return results
+
+def bench_metrics(images: int, repeat: int, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(images):
+        labels = random_boxes(rng)
+        predictions = [{'class': p['class_id'], 'bbox': p['bbox']} for p in jitter(rng, labels)]
+        pairs.append((predictions, [{'class': b['class'], 'bbox': b['coordinates']} for b in labels]))
+    return [timed('metrics.calculate_metrics_batch', lambda: calculate_metrics_batch(pairs), repeat, images=images)]
+
+def bench_export(work: Path, dirs: int, per_dir: int, repeat: int) -> List[Dict[str, Any]]:
+    """Export the labeled JPEG tree, the synthetic database has no image files to export"""
+    import db2file
+    tree = jpeg_tree(work, dirs, per_dir)
+    db_name, out = work / 'export.db', work / 'export'
+    if not db_name.exists():
+        db.create_db(db_name)
+        db.populate_db_with_images(tree / 'images', db_name)
+        db.update_db_with_labels(tree / 'labels', db_name)
+    collection_ids = db2file.get_collection_ids(db_name)
+    return [timed(f'export.{mode}', lambda mode=mode: db2file.export_collections(collection_ids, db_name, str(out), mode=mode), repeat,
+                  setup=lambda: shutil.rmtree(out, ignore_errors=True), images=dirs * per_dir)
+            for mode in ('auto', 'copy')]
+
+def bench_http(db_name: Path, requests: int, concurrency: int) -> List[Dict[str, Any]]:
+    """Latency of the main read endpoints under concurrent load, through the Flask test client"""
+    os.environ['HINT_DB'] = str(db_name)
+    database.DB_PATH = db_name
+    database.pool.db_path = db_name
+    import server
+    server.init_db()
+    conn = database.connect(db_name)
+    collection_id = conn.execute('SELECT MIN(id) FROM root_dirs').fetchone()[0]
+    files = [row[0] for row in conn.execute('SELECT file FROM images WHERE root_dir_id = ? LIMIT 100', (collection_id,))]
+    conn.close()
+    cursor = server.app.test_client().get(f'/images/{collection_id}?limit=200').get_json()['next_cursor']
+    endpoints = {
+        'http.image_collections': lambda i: '/image_collections',
+        'http.images_first_page': lambda i: f'/images/{collection_id}?limit=200',
+        'http.images_next_page': lambda i: f'/images/{collection_id}?limit=200&cursor={cursor}',
+        'http.inspect_data': lambda i: f'/inspect_data/{files[i % len(files)]}',
+        'http.search': lambda i: f'/search?q=match_00&labeled=0&class=1&source=prediction&model={MODELS[0]}',
+        'http.boxes_stats': lambda i: f'/boxes/stats?collection_id={collection_id}',
+    }
+    if cursor is None:
+        # the collection fits in one page
+        del endpoints['http.images_next_page']
+    results = []
+    for name, url in endpoints.items():
+        def one(i, url=url):
+            client = server.app.test_client()
+            start = time.perf_counter()
+            response = client.get(url(i))
+            body = response.get_data()
+            assert response.status_code == 200, f'{url(i)} returned {response.status_code}'
+            return time.perf_counter() - start, len(body)
+        one(0)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            samples = list(pool.map(one, range(requests)))
+        elapsed = time.perf_counter() - start
+        results.append(summarize(name, [s for s, _ in samples], concurrency=concurrency,
+                                 requests_per_second=requests / elapsed, mean_bytes=statistics.fmean(b for _, b in samples)))
+    return results
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=base_path, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'time': datetime.now().isoformat()}
+
+def compare(results: List[Dict[str, Any]], baseline_path: Path) -> None:
+    baseline = {r['name']: r for r in json.loads(Path(baseline_path).read_text())['results']}
+    for r in results:
+        old = baseline.get(r['name'])
+        if old and 'median' in old and 'median' in r:
+            print(f"{r['name']:<40} {old['median']*1000:10.2f} ms -> {r['median']*1000:10.2f} ms  x{r['median'] / old['median']:.2f}")
+
+def bench_generate(db_name: Path, images: int, collections: int, seed: int) -> List[Dict[str, Any]]:
+    print(f"generating {images} images in {db_name}...")
+    start = time.perf_counter()
+    try:
+        generate_db(db_name, images, collections, seed=seed)
+    except Exception:
+        # a half written database would be reused by the next run
+        for suffix in ('', '-wal', '-shm'):
+            Path(f'{db_name}{suffix}').unlink(missing_ok=True)
+        raise
+    return [summarize('generate_db', [time.perf_counter() - start], images=images)]
+
+def run(name: str, results: List[Dict[str, Any]], fn: Callable[[], List[Dict[str, Any]]]) -> None:
+    print(f"running {name}...")
+    try:
+        results += fn()
+    except Exception as e:
+        # keep going so one broken path does not hide the numbers for the rest
+        results.append({'name': name, 'error': repr(e)})
+        print(f"  {name} failed: {e!r}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time ingest, metrics, export and the HTTP endpoints on synthetic data')
+    parser.add_argument('--images', type=int, default=10000, help='images in the synthetic database, e.g. 10000 to 5000000')
+    parser.add_argument('--collections', type=int, default=100)
+    parser.add_argument('--jpeg-dirs', type=int, default=10, help='directories in the synthetic JPEG tree for ingest and export')
+    parser.add_argument('--jpeg-per-dir', type=int, default=200)
+    parser.add_argument('--metric-images', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='*', choices=['ingest', 'metrics', 'export', 'http'])
+    parser.add_argument('--work-dir', type=Path, help='keep generated data here instead of a temporary directory')
+    parser.add_argument('--out', type=Path, default=base_path / 'bench_output.json')
+    parser.add_argument('--compare', type=Path, help='earlier --out file to compare medians against')
+    args = parser.parse_args()
+
+    work = args.work_dir or Path(tempfile.mkdtemp(prefix='hint-bench-'))
+    work.mkdir(parents=True, exist_ok=True)
+    selected = set(args.only or ['ingest', 'metrics', 'export', 'http'])
+    results: List[Dict[str, Any]] = []
+    db_name = work / f'synthetic_{args.images}.db'
+    if 'http' in selected and not db_name.exists():
+        run('generate_db', results, lambda: bench_generate(db_name, args.images, args.collections, args.seed))
+    if 'ingest' in selected:
+        run('ingest', results, lambda: bench_ingest(work, args.jpeg_dirs, args.jpeg_per_dir, args.repeat))
+    if 'metrics' in selected:
+        run('metrics', results, lambda: bench_metrics(args.metric_images, args.repeat, args.seed))
+    if 'export' in selected:
+        run('export', results, lambda: bench_export(work, args.jpeg_dirs, args.jpeg_per_dir, args.repeat))
+    if 'http' in selected:
+        run('http', results, lambda: bench_http(db_name, args.requests, args.concurrency))
+
+    report = {'environment': environment(), 'args': {k: str(v) for k, v in vars(args).items()}, 'results': results}
+    args.out.write_text(json.dumps(report, indent=2))
+    for r in results:
+        if 'error' in r:
+            print(f"{r['name']:<40} error: {r['error']}")
+        else:
+            print(f"{r['name']:<40} median {r['median']*1000:10.2f} ms  p95 {r['p95']*1000:10.2f} ms")
+    if args.compare:
+        compare(results, args.compare)
+    if args.work_dir is None:
+        shutil.rmtree(work, ignore_errors=True)
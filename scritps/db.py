@@ -1,9 +1,23 @@
-import sqlite3
+import sys
 import os
 import json
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
 
 base_path = Path(__file__).parent.parent
+sys.path.insert(0, str(base_path))
+import database
+import boxes
+import collection_stats
+import search
+import model_diff
+import loss_overview
+import overlays
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+LABEL_EXTENSIONS = ('.txt',)
+BATCH_SIZE = 10000
+SCAN_WORKERS = 16
 
 def convert_label_to_json(label_path):
     label_list = []
@@ -13,7 +27,7 @@ def convert_label_to_json(label_path):
         parts = line.strip().split()
         label_dict = {
             "class": int(parts[0]),
-            "bbox": [float(parts[1]), float(parts[2]), float(parts[3]), float(parts[4])]
+            "coordinates": [float(parts[1]), float(parts[2]), float(parts[3]), float(parts[4])]
         }
         label_list.append(label_dict)
     label_json = json.dumps(label_list)
@@ -21,7 +35,7 @@ def convert_label_to_json(label_path):
 
 
 def create_db(db_name=base_path/'images.db'):
-    conn = sqlite3.connect(db_name)
+    conn = database.connect(db_name)
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS root_dirs (
@@ -36,6 +50,8 @@ def create_db(db_name=base_path/'images.db'):
             root_dir_id INTEGER,
             file TEXT NOT NULL,
             revisions INTEGER DEFAULT 0,
+            mtime REAL,
+            size INTEGER,
             UNIQUE(file),
             FOREIGN KEY (root_dir_id) REFERENCES root_dirs(id)
         )
@@ -48,7 +64,33 @@ def create_db(db_name=base_path/'images.db'):
             FOREIGN KEY (image_id) REFERENCES images(id)
         )
     ''')
+    # bookkeeping for incremental ingest, see populate_db_with_images and update_db_with_labels
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scanned_dirs (
+            path TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            mtime REAL,
+            PRIMARY KEY (path, kind)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS label_files (
+            path TEXT PRIMARY KEY,
+            mtime REAL,
+            size INTEGER,
+            labels_json TEXT
+        )
+    ''')
+    add_column_if_missing(cursor, 'images', 'mtime', 'REAL')
+    add_column_if_missing(cursor, 'images', 'size', 'INTEGER')
+    add_column_if_missing(cursor, 'label_files', 'labels_json', 'TEXT')
     conn.commit()
+    boxes.create_boxes_table(conn)
+    database.create_indexes(conn)
+    collection_stats.create_collection_stats(conn)
+    search.create_search_index(conn)
+    model_diff.create_model_diff(conn)
+    loss_overview.create_loss_overview(conn)
     conn.close()
 
 def get_or_insert_root_dir(cursor, root_dir):
@@ -60,40 +102,185 @@ def get_or_insert_root_dir(cursor, root_dir):
         cursor.execute('INSERT OR IGNORE INTO root_dirs (root_dir) VALUES (?)', (root_dir,))
         return cursor.lastrowid
 
+def add_column_if_missing(cursor, table, column, decl):
+    columns = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+    if column not in columns:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+def scan_dir(path, extensions, known_mtime=None):
+    """List one directory with os.scandir.
+
+    Returns the directory mtime, the matching files as (name, mtime, size) and
+    the subdirectories. When the directory mtime equals known_mtime no entries
+    were added or removed since the last scan, so files is None and nothing
+    is stat'ed.
+    """
+    dir_mtime = os.stat(path).st_mtime
+    files = None if known_mtime == dir_mtime else []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif files is not None and entry.name.lower().endswith(extensions) and entry.is_file():
+                st = entry.stat()
+                files.append((entry.name, st.st_mtime, st.st_size))
+    return path, dir_mtime, files, subdirs
+
+def scan_tree(top, extensions, known_mtimes=None, workers=SCAN_WORKERS):
+    """Walk top like os.walk but scan directories in parallel, yields (path, dir_mtime, files)"""
+    known_mtimes = known_mtimes or {}
+    with ThreadPoolExecutor(workers) as pool:
+        pending = {pool.submit(scan_dir, top, extensions, known_mtimes.get(top))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                path, dir_mtime, files, subdirs = fut.result()
+                pending |= {pool.submit(scan_dir, d, extensions, known_mtimes.get(d)) for d in subdirs}
+                yield path, dir_mtime, files
+
+def flush_images(cursor, image_rows, dir_rows):
+    cursor.execute('SELECT COALESCE(MAX(id), 0) FROM images')
+    max_id = cursor.fetchone()[0]
+    cursor.executemany('''
+        INSERT INTO images (root_dir_id, file, mtime, size)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(file) DO UPDATE SET mtime = excluded.mtime, size = excluded.size
+        WHERE mtime IS NOT excluded.mtime OR size IS NOT excluded.size
+    ''', image_rows)
+    # every image gets a labels row so label ingest and the UI can update it in place
+    cursor.execute('''
+        INSERT INTO labels (image_id)
+        SELECT id FROM images
+        WHERE id > ? AND NOT EXISTS (SELECT 1 FROM labels WHERE labels.image_id = images.id)
+    ''', (max_id,))
+    cursor.executemany('''
+        INSERT OR REPLACE INTO scanned_dirs (path, kind, mtime) VALUES (?, 'D', ?)
+    ''', dir_rows)
+
 # Function to populate SQLite database with image paths
-def populate_db_with_images(image_path, db_name=base_path/'images.db'):
-    conn = sqlite3.connect(db_name)
+def populate_db_with_images(image_path, db_name=base_path/'images.db', full=False, workers=SCAN_WORKERS):
+    """Add new or changed images under image_path.
+
+    Directories whose mtime did not change since the last run are not
+    re-listed, pass full=True to rescan everything.
+    """
+    conn = database.connect(db_name)
+    cursor = conn.cursor()
+    known_mtimes = {} if full else dict(cursor.execute("SELECT path, mtime FROM scanned_dirs WHERE kind = 'D'"))
+    image_rows, dir_rows = [], []
+    for root, dir_mtime, files in scan_tree(str(image_path), IMAGE_EXTENSIONS, known_mtimes, workers):
+        if files is None: continue
+        if files:
+            root_dir_id = get_or_insert_root_dir(cursor, root)
+            image_rows += [(root_dir_id, name, mtime, size) for name, mtime, size in files]
+        dir_rows.append((root, dir_mtime))
+        if len(image_rows) >= BATCH_SIZE:
+            flush_images(cursor, image_rows, dir_rows)
+            conn.commit()
+            image_rows, dir_rows = [], []
+    flush_images(cursor, image_rows, dir_rows)
+    conn.commit()
+    conn.close()
+
+def image_names_for_label(file):
+    stem = os.path.splitext(file)[0]
+    return [stem + ext for ext in IMAGE_EXTENSIONS]
+
+def parse_label_file(label_path):
+    return label_path, convert_label_to_json(label_path)
+
+def flush_labels(cursor, parsed, stats, previous):
+    """Write a batch of parsed label files, returns the ids of the images whose labels changed.
+
+    An image takes a file's labels while its own are empty or still what that
+    file contained when it was last read, `previous` maps paths to those
+    contents. Labels edited in the UI since then win. The caller commits and
+    then drops the overlays of the changed images.
+    """
+    placeholders = ", ".join("?" * len(IMAGE_EXTENSIONS))
+    updates, old_labels = [], {}
+    for path, label_json in parsed:
+        cursor.execute(f'''
+            SELECT l.image_id, l.labels_json FROM labels AS l JOIN images AS i ON i.id = l.image_id
+            WHERE i.file IN ({placeholders}) AND (l.labels_json IS NULL OR l.labels_json = ? OR l.labels_json = ?)
+              AND l.labels_json IS NOT ?
+        ''', (*image_names_for_label(os.path.basename(path)), json.dumps({}), previous.get(path), label_json))
+        for image_id, old_json in cursor.fetchall():
+            updates.append((label_json, image_id))
+            old = json.loads(old_json) if old_json else []
+            old_labels.setdefault(image_id, old if isinstance(old, list) else [])
+    cursor.executemany('UPDATE labels SET labels_json = ? WHERE image_id = ?', updates)
+    changed = list(old_labels)
+    # a new revision makes clients that loaded the old labels conflict instead of overwriting these
+    cursor.executemany('UPDATE images SET revisions = COALESCE(revisions, 0) + 1 WHERE id = ?', [(image_id,) for image_id in changed])
+    for label_json, image_id in updates:
+        boxes.replace_label_boxes(cursor.connection, image_id, json.loads(label_json))
+    loss_overview.relabel(cursor.connection, old_labels)
+    cursor.executemany('''
+        INSERT OR REPLACE INTO label_files (path, mtime, size, labels_json) VALUES (?, ?, ?, ?)
+    ''', [(path, *stats[path], label_json) for path, label_json in parsed])
+    return changed
+
+def update_db_with_labels(label_path, db_name=base_path/'images.db', full=False, workers=None):
+    """Parse new or changed YOLO label files under label_path into the labels table.
+
+    Label files are matched to images by file stem. Files whose mtime and size
+    match the previous run are skipped unless full=True, the rest are parsed
+    in a process pool and written in batches. A changed file replaces labels
+    that were not edited since it was last read, see flush_labels.
+    """
+    conn = database.connect(db_name)
     cursor = conn.cursor()
-    for root, dirs, files in os.walk(image_path):
-        root_dir_id = get_or_insert_root_dir(cursor, root)
-        for file in files:
-            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                cursor.execute('''
-                    INSERT OR IGNORE INTO images (root_dir_id, file) 
-                    VALUES (?, ?)
-                ''', (root_dir_id, file))
+    label_path = str(label_path)
+    known, previous = {}, {}
+    for path, mtime, size, labels_json in cursor.execute(
+            'SELECT path, mtime, size, labels_json FROM label_files WHERE path >= ? AND path < ?', (label_path, label_path + '\uffff')):
+        known[path], previous[path] = (mtime, size), labels_json
+    stats, seen = {}, set()
+    for root, _, files in scan_tree(label_path, LABEL_EXTENSIONS):
+        for name, mtime, size in files:
+            path = os.path.join(root, name)
+            seen.add(path)
+            if full or known.get(path) != (mtime, size):
+                stats[path] = (mtime, size)
+    # labels read from a deleted file stay, the file is only forgotten so it is read again if it comes back
+    cursor.executemany('DELETE FROM label_files WHERE path = ?', [(path,) for path in known.keys() - seen])
+    with ProcessPoolExecutor(workers) as pool:
+        parsed = []
+        for result in pool.map(parse_label_file, stats, chunksize=256):
+            parsed.append(result)
+            if len(parsed) >= BATCH_SIZE:
+                changed = flush_labels(cursor, parsed, stats, previous)
+                conn.commit()
+                for image_id in changed:
+                    overlays.cache.invalidate(image_id)
+                parsed = []
+        changed = flush_labels(cursor, parsed, stats, previous)
     conn.commit()
+    for image_id in changed:
+        overlays.cache.invalidate(image_id)
     conn.close()
 
-def update_db_with_labels(label_path, db_name=base_path/'images.db'):
-    conn = sqlite3.connect(db_name)
+def rename_bbox_keys(db_name=base_path/'images.db'):
+    """Rewrite labels stored with the old 'bbox' key to the 'coordinates' key the UI and exports read"""
+    conn = database.connect(db_name)
     cursor = conn.cursor()
-    for root, dirs, files in os.walk(label_path):
-        for file in files:
-            if file.lower().endswith('.txt'):
-                label_path = os.path.join(root, file)
-                label_json = convert_label_to_json(label_path)
-                cursor.execute('''
-                    UPDATE labels 
-                    SET labels_json = ? 
-                    WHERE image_id = (SELECT id FROM images WHERE file = ?) 
-                      AND (labels_json IS NULL OR labels_json = ?)
-                ''', (label_json, file, json.dumps({})))
+    cursor.execute("SELECT image_id, labels_json FROM labels WHERE labels_json LIKE '%\"bbox\"%'")
+    updates = []
+    for image_id, labels_json in cursor.fetchall():
+        labels = json.loads(labels_json)
+        if not isinstance(labels, list): continue
+        for label in labels:
+            if 'bbox' in label:
+                label['coordinates'] = label.pop('bbox')
+        updates.append((json.dumps(labels), image_id))
+    cursor.executemany('UPDATE labels SET labels_json = ? WHERE image_id = ?', updates)
     conn.commit()
     conn.close()
 
 def migrate_labels(db_name=base_path/'images.db'):
-    conn = sqlite3.connect(db_name)
+    conn = database.connect(db_name)
     cursor = conn.cursor()
 
     # Step 1: Add labels_json to labels table from images.labels
@@ -109,7 +296,7 @@ def migrate_labels(db_name=base_path/'images.db'):
     conn.close()
 
 def remove_labels_column(db_name=base_path/'images.db'):
-    conn = sqlite3.connect(db_name)
+    conn = database.connect(db_name)
     cursor = conn.cursor()
 
     # Begin Transaction
@@ -132,7 +319,7 @@ def remove_labels_column(db_name=base_path/'images.db'):
     conn.close()
 
 def set_classes_for_rootdir(db_name=base_path/'images.db'):
-    conn = sqlite3.connect(db_name)
+    conn = database.connect(db_name)
     cursor = conn.cursor()
     cursor.execute('''
         UPDATE root_dirs 
@@ -144,10 +331,8 @@ def set_classes_for_rootdir(db_name=base_path/'images.db'):
 if __name__ == "__main__":
     print("create db...")
     create_db()
-    print("migrate labels...")
-    migrate_labels()
-    print("remove labels column...")
-    remove_labels_column()
+    # migrate_labels and remove_labels_column are one-off steps for databases that still have images.labels,
+    # remove_labels_column rebuilds images without the ingest columns and triggers, so neither runs here
 
     with open("paths.txt", "r") as f:
         f = f.read().splitlines()
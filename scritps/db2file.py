@@ -1,79 +1,189 @@
-import sqlite3
+import sys
 import json
 import os
-import random
+import errno
+import fcntl
 import shutil
+import zlib
+import argparse
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import Deque
 
 base_path = Path(__file__).parent.parent
+sys.path.insert(0, str(base_path))
+import database
+import boxes
+import shards
+from collection_stats import LABELED_SQL
+
+MODES = ('auto', 'hardlink', 'reflink', 'symlink', 'copy')
+FORMATS = ('yolo', 'shards')
+FICLONE = 0x40049409  # linux ioctl that shares the extents of one file with another (btrfs, xfs)
+WORKERS = 16
+TRAIN_RATIO = 0.8
 
 def get_collection_ids(db_name=base_path/'images.db'):
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM root_dirs')
-    rows = cursor.fetchall()
+    conn = database.connect(db_name)
+    rows = conn.execute('SELECT id FROM root_dirs ORDER BY id').fetchall()
     conn.close()
-    return list(set(int(x[0]) for x in rows))
-
-def export_labels_from_collection(collection_id, db_name=base_path/'images.db', output_dir='data'):
-    # Define train and validation split ratio
-    train_ratio = 0.8
-
-    # Create the required folder structure
-    train_labels_dir = os.path.join(output_dir, 'train', 'labels')
-    valid_labels_dir = os.path.join(output_dir, 'valid', 'labels')
-    train_images_dir = os.path.join(output_dir, 'train', 'images')
-    valid_images_dir = os.path.join(output_dir, 'valid', 'images')
-
-    for directory in [train_labels_dir, valid_labels_dir, train_images_dir, valid_images_dir]:
-        os.makedirs(directory, exist_ok=True)
-
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    # Fetch all relevant images with labels
-    cursor.execute('''
-        SELECT i.image_full, i.image_name, i.labels, c.root_dir
-        FROM images i
-        JOIN root_dirs c ON i.root_dir_id = c.id
-        WHERE c.id = ? AND i.labels IS NOT NULL
-    ''', (collection_id,))
-    rows = cursor.fetchall()
+    return [int(x[0]) for x in rows]
+
+def split_for(file, seed=0, train_ratio=TRAIN_RATIO):
+    """'train' or 'valid' from a hash of the file name, so a split is the same on every run and for every order"""
+    return 'train' if zlib.crc32(f'{seed}:{file}'.encode()) / 2**32 < train_ratio else 'valid'
+
+def label_lines(labels):
+    return "\n".join(f"{label['class']} " + " ".join(map(str, boxes.box_coordinates(label))) for label in labels)
+
+def reflink(src, dst):
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.unlink(dst)
+            raise
+
+def materialize(src, dst, mode):
+    """Put src at dst with the cheapest method mode allows, returns the method used.
+
+    'auto' tries a hardlink, then a reflink and copies when neither works,
+    e.g. across filesystems. Links and reflinks use no extra disk space.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if mode in ('auto', 'hardlink'):
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            if mode == 'hardlink' or e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+    if mode in ('auto', 'reflink'):
+        try:
+            reflink(src, dst)
+            return 'reflink'
+        except OSError:
+            if mode == 'reflink':
+                raise
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+        return 'symlink'
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+def export_image(root_dir, file, labels_json, split_dir, mode):
+    labels = json.loads(labels_json)
+    (split_dir / 'labels' / f"{Path(file).stem}.txt").write_text(label_lines(labels))
+    return materialize(os.path.join(root_dir, file), split_dir / 'images' / file, mode)
+
+def export_labels_from_collection(collection_id, db_name=base_path/'images.db', output_dir='data',
+                                  train_ratio=TRAIN_RATIO, seed=0, mode='auto', workers=WORKERS):
+    """Write a collection's labeled images as a YOLO dataset under output_dir/{train,valid}/{images,labels}.
+
+    Rows are streamed from one cursor into a thread pool that writes the
+    label file and links or copies the image, with a bounded number of
+    images in flight. Returns how many images each split and method got.
+    """
+    return export_collections([collection_id], db_name, output_dir, train_ratio, seed, mode, workers)
+
+def export_collections(collection_ids, db_name=base_path/'images.db', output_dir='data',
+                       train_ratio=TRAIN_RATIO, seed=0, mode='auto', workers=WORKERS):
+    if mode not in MODES:
+        raise ValueError(f"unknown mode {mode}, expected one of {MODES}")
+    split_dirs = {split: Path(output_dir) / split for split in ('train', 'valid')}
+    for split_dir in split_dirs.values():
+        (split_dir / 'images').mkdir(parents=True, exist_ok=True)
+        (split_dir / 'labels').mkdir(parents=True, exist_ok=True)
+    stats = Counter()
+    conn = database.connect(db_name)
+    rows = conn.execute(f'''
+        SELECT r.root_dir, i.file, l.labels_json
+        FROM images AS i
+        JOIN root_dirs AS r ON r.id = i.root_dir_id
+        JOIN labels AS l ON l.image_id = i.id
+        WHERE i.root_dir_id IN ({", ".join("?" * len(collection_ids))}) AND {LABELED_SQL.format('l')}
+    ''', list(collection_ids))
+    pending: Deque[Future] = deque()
+    with ThreadPoolExecutor(workers) as pool:
+        for root_dir, file, labels_json in rows:
+            split = split_for(file, seed, train_ratio)
+            stats[split] += 1
+            pending.append(pool.submit(export_image, root_dir, file, labels_json, split_dirs[split], mode))
+            if len(pending) >= workers * 4:
+                stats[pending.popleft().result()] += 1
+        while pending:
+            stats[pending.popleft().result()] += 1
     conn.close()
-
-    # Shuffle the data
-    random.shuffle(rows)
-
-    # Split the data
-    split_index = int(len(rows) * train_ratio)
-    train_data = rows[:split_index]
-    valid_data = rows[split_index:]
-
-    # Function to export labels
-    def export(data, labels_dir, images_dir):
-        for image_full, image_name, labels_json, root_dir in data:
-            # Parse labels JSON
-            labels = json.loads(labels_json)
-
-            # Prepare label file content
-            label_lines = []
-            for label in labels:
-                label_line = f"{label['class']} " + " ".join(map(str, label['coordinates']))
-                label_lines.append(label_line)
-
-            # Write to label file
-            label_file_path = os.path.join(labels_dir, f"{image_name}.txt")
-            with open(label_file_path, 'w') as label_file:
-                label_file.write("\n".join(label_lines))
-
-            #original_image_path = os.path.join(root_dir, image_name)
-            shutil.copy(image_full, os.path.join(images_dir, image_full.split("/")[-1]))
-
-    # Export training and validation labels
-    export(train_data, train_labels_dir, train_images_dir)
-    export(valid_data, valid_labels_dir, valid_images_dir)
+    return dict(stats)
+
+def read_sample(root_dir, file, labels_json):
+    with open(os.path.join(root_dir, file), 'rb') as f:
+        image = f.read()
+    return file, image, shards.boxes_array(json.loads(labels_json))
+
+def export_shards(collection_ids, db_name=base_path/'images.db', output_dir='data',
+                  train_ratio=TRAIN_RATIO, seed=0, shard_bytes=shards.SHARD_BYTES, workers=WORKERS):
+    """Pack labeled images into train and valid shard sets under output_dir/{train,valid}, see shards.ShardWriter.
+
+    Images are read in a thread pool and appended in cursor order, so the
+    shards are the same on every run.
+    """
+    conn = database.connect(db_name)
+    classes = {}
+    for root_dir_id, label_classes in conn.execute(f'''
+        SELECT id, label_classes FROM root_dirs WHERE id IN ({", ".join("?" * len(collection_ids))})
+    ''', list(collection_ids)):
+        classes[root_dir_id] = label_classes.split(" ") if label_classes else []
+    rows = conn.execute(f'''
+        SELECT r.root_dir, i.file, l.labels_json
+        FROM images AS i
+        JOIN root_dirs AS r ON r.id = i.root_dir_id
+        JOIN labels AS l ON l.image_id = i.id
+        WHERE i.root_dir_id IN ({", ".join("?" * len(collection_ids))}) AND {LABELED_SQL.format('l')}
+        ORDER BY i.id
+    ''', list(collection_ids))
+    metadata = {'collections': list(collection_ids), 'classes': {str(k): v for k, v in classes.items()}, 'seed': seed}
+    writers = {split: shards.ShardWriter(Path(output_dir) / split, split, shard_bytes, metadata) for split in ('train', 'valid')}
+    stats = Counter()
+    pending: Deque[Future] = deque()
+
+    def write(fut):
+        file, image, box_array = fut.result()
+        split = split_for(file, seed, train_ratio)
+        writers[split].add(file, image, box_array)
+        stats[split] += 1
+
+    with ThreadPoolExecutor(workers) as pool:
+        for row in rows:
+            pending.append(pool.submit(read_sample, *row))
+            if len(pending) >= workers * 4:
+                write(pending.popleft())
+        while pending:
+            write(pending.popleft())
+    for writer in writers.values():
+        writer.close()
+    conn.close()
+    return dict(stats)
 
 if __name__ == "__main__":
-    for id in get_collection_ids():
-        export_labels_from_collection(collection_id=id)
-
+    parser = argparse.ArgumentParser(description='Export labeled images as a YOLO train/valid dataset')
+    parser.add_argument('--db', type=Path, default=base_path/'images.db')
+    parser.add_argument('--output', default='data')
+    parser.add_argument('--collections', type=int, nargs='*', help='root_dirs ids, all collections by default')
+    parser.add_argument('--train-ratio', type=float, default=TRAIN_RATIO)
+    parser.add_argument('--seed', type=int, default=0, help='changes which images land in train and valid')
+    parser.add_argument('--mode', choices=MODES, default='auto',
+                        help='auto hardlinks or reflinks when possible and copies otherwise')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--format', choices=FORMATS, default='yolo',
+                        help='yolo writes images and label files, shards packs them into memory-mappable shard files')
+    parser.add_argument('--shard-mb', type=int, default=shards.SHARD_BYTES // 1024**2)
+    args = parser.parse_args()
+    collection_ids = args.collections or get_collection_ids(args.db)
+    if args.format == 'shards':
+        print(export_shards(collection_ids, args.db, args.output, args.train_ratio, args.seed, args.shard_mb * 1024**2, args.workers))
+    else:
+        print(export_collections(collection_ids, args.db, args.output, args.train_ratio, args.seed, args.mode, args.workers))
@@ -1,56 +1,94 @@
+import os
+import sys
+import time
+import zlib
 import sqlite3
+import multiprocessing
 import json
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 import argparse
+import numpy as np
+from PIL import Image
 from ultralytics import YOLO
 from datetime import datetime
-from typing import List, Dict, Any, Tuple, Optional
+from typing import List, Dict, Any, Callable, Deque, Iterable, Iterator, Tuple, Optional
 
 p: Path = Path(__file__).parent.parent
+sys.path.insert(0, str(p))
+import database
+import boxes
+import collection_stats
+import embeddings
+import model_diff
+import loss_overview
+from matching import calculate_metrics_batch
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.webp'}
+BATCH_SIZE: int = 16
+PREFETCH_WORKERS: int = 4
+FLUSH_ROWS: int = 512
+REPORT_EVERY: float = 10.0
 
 def create_db_connection(db_path: str) -> sqlite3.Connection:
-    conn: sqlite3.Connection = sqlite3.connect(db_path)
+    conn: sqlite3.Connection = database.connect(db_path)
+    database.create_model_predictions(conn)
+    boxes.create_boxes_table(conn)
+    database.create_indexes(conn)
+    collection_stats.create_collection_stats(conn)
+    model_diff.create_model_diff(conn)
+    loss_overview.create_loss_overview(conn)
+    return conn
+
+PredictionRow = Tuple[str, str, str, str, float, datetime]
+
+def prediction_row(model_name: str, file: str, image_base_path: Path, predictions: List[Dict[str, Any]], loss: float) -> PredictionRow:
+    return (model_name, file, str(image_base_path), json.dumps(predictions), loss, datetime.now())
+
+def log_predictions(conn: sqlite3.Connection, rows: List[PredictionRow]) -> None:
+    """Insert many prediction rows and their boxes, add them to the loss overview and the diffs of registered model pairs, the caller commits"""
+    inserted: List[PredictionRow] = []
+    for row in rows:
+        cursor = conn.execute('''INSERT OR IGNORE INTO model_predictions 
+                     (model, file, base_path, predictions, loss, timestamp)
+                     VALUES (?, ?, ?, ?, ?, ?)''', row)
+        if cursor.rowcount:
+            model_name, file, _, predictions_json, _, _ = row
+            boxes.replace_prediction_boxes(conn, model_name, file, json.loads(predictions_json))
+            inserted.append(row)
+    loss_overview.record(conn, inserted)
+    for model_name in {row[0] for row in inserted}:
+        model_diff.update(conn, model_name, [row[1] for row in inserted if row[0] == model_name])
+
+def log_prediction(conn: sqlite3.Connection, model_name: str, file: str, image_base_path: Path, predictions: List[Dict[str, Any]], loss: float) -> None:
+    log_predictions(conn, [prediction_row(model_name, file, image_base_path, predictions, loss)])
+    conn.commit()
+
+def create_jobs_table(conn: sqlite3.Connection) -> None:
     conn.execute('''
-        CREATE TABLE IF NOT EXISTS model_predictions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+        CREATE TABLE IF NOT EXISTS prediction_jobs (
             model TEXT NOT NULL,
-            file TEXT NOT NULL,
-            base_path TEXT NOT NULL,
-            predictions JSON,
-            loss REAL,
-            timestamp DATETIME,
-            UNIQUE(model, file)
+            shard INTEGER NOT NULL,
+            num_shards INTEGER NOT NULL,
+            last_file TEXT,
+            processed INTEGER DEFAULT 0,
+            status TEXT,
+            updated DATETIME,
+            PRIMARY KEY (model, shard, num_shards)
         );
     ''')
-    return conn
-
-def log_prediction(conn: sqlite3.Connection, model_name: str, file: str, image_base_path: Path, predictions: List[Dict[str, Any]], loss: float) -> None:
-    conn.execute('''INSERT OR IGNORE INTO model_predictions 
-                 (model, file, base_path, predictions, loss, timestamp)
-                 VALUES (?, ?, ?, ?, ?, ?)''',
-                 (model_name, file, str(image_base_path), json.dumps(predictions), loss, datetime.now()))
     conn.commit()
 
-def calculate_iou(box1: List[float], box2: List[float]) -> float:
-    """Calculate Intersection over Union for normalized xywh boxes"""
-    # Convert boxes to xyxy format
-    b1_x1, b1_y1 = box1[0] - box1[2]/2, box1[1] - box1[3]/2
-    b1_x2, b1_y2 = box1[0] + box1[2]/2, box1[1] + box1[3]/2
-    b2_x1, b2_y1 = box2[0] - box2[2]/2, box2[1] - box2[3]/2
-    b2_x2, b2_y2 = box2[0] + box2[2]/2, box2[1] + box2[3]/2
-
-    # Intersection area
-    inter_x1: float = max(b1_x1, b2_x1)
-    inter_y1: float = max(b1_y1, b2_y1)
-    inter_x2: float = min(b1_x2, b2_x2)
-    inter_y2: float = min(b1_y2, b2_y2)
-    inter_area: float = max(inter_x2 - inter_x1, 0) * max(inter_y2 - inter_y1, 0)
-
-    # Union area
-    b1_area: float = box1[2] * box1[3]
-    b2_area: float = box2[2] * box2[3]
-    union_area: float = b1_area + b2_area - inter_area
-    return inter_area / union_area if union_area > 0 else 0.0
+def load_checkpoint(conn: sqlite3.Connection, model_name: str, shard: int, num_shards: int) -> Tuple[Optional[str], int, Optional[str]]:
+    row = conn.execute('''SELECT last_file, processed, status FROM prediction_jobs
+                 WHERE model = ? AND shard = ? AND num_shards = ?''', (model_name, shard, num_shards)).fetchone()
+    return (row[0], row[1], row[2]) if row else (None, 0, None)
+
+def save_checkpoint(conn: sqlite3.Connection, model_name: str, shard: int, num_shards: int, last_file: Optional[str], processed: int, status: str) -> None:
+    conn.execute('''INSERT OR REPLACE INTO prediction_jobs
+                 (model, shard, num_shards, last_file, processed, status, updated)
+                 VALUES (?, ?, ?, ?, ?, ?, ?)''', (model_name, shard, num_shards, last_file, processed, status, datetime.now()))
 
 def load_ground_truth(label_path: Path) -> List[Dict[str, Any]]:
     """Load YOLO format ground truth labels"""
@@ -62,76 +100,218 @@ def load_ground_truth(label_path: Path) -> List[Dict[str, Any]]:
             'bbox': list(map(float, line.split()[1:5]))
         } for line in f.read().splitlines()]
 
-def calculate_metrics(predictions: List[Dict[str, Any]], ground_truth: List[Dict[str, Any]]) -> Tuple[float, float, float, float]:
-    """Calculate precision, recall, avg_iou, and class_accuracy"""
-    tp: int = 0
-    fp: int = 0
-    iou_sum: float = 0.0
-    used_gt: set = set()
-    for pred in predictions:
-        best_iou: float = 0.0
-        best_gt_idx: int = -1
-        for gt_idx, gt in enumerate(ground_truth):
-            if gt_idx in used_gt:
-                continue
-            iou: float = calculate_iou(pred['bbox'], gt['bbox'])
-            if iou > best_iou and pred['class'] == gt['class']:
-                best_iou = iou
-                best_gt_idx = gt_idx
-        if best_iou > 0.5:  # IoU threshold
-            tp += 1
-            used_gt.add(best_gt_idx)
-            iou_sum += best_iou
-        else:
-            fp += 1
-    fn: int = len(ground_truth) - len(used_gt)
-    precision: float = tp / (tp + fp) if (tp + fp) > 0 else 0.0
-    recall: float = tp / len(ground_truth) if ground_truth else 0.0
-    avg_iou: float = iou_sum / tp if tp > 0 else 0.0
-    class_acc: float = sum(1 for gt in ground_truth if any(p['class'] == gt['class'] for p in predictions)) / len(ground_truth) if ground_truth else 0.0
-    return precision, recall, avg_iou, class_acc
-
-def process_images(model: YOLO, model_name: str, input_dirs: List[str], conn: sqlite3.Connection) -> None:
-    for input_dir in input_dirs:
-        image_paths: List[Path] = [p for p in Path(input_dir).rglob('*') 
-                          if p.suffix.lower() in {'.jpg', '.jpeg', '.png', '.webp'}]
+def processed_files(conn: sqlite3.Connection, model_name: str) -> set:
+    """All files that already have a prediction for model_name, read once up front"""
+    return {row[0] for row in conn.execute('SELECT file FROM model_predictions WHERE model = ?', (model_name,))}
 
+def load_sample(image_path: Path) -> Tuple[Path, Image.Image, List[Dict[str, Any]]]:
+    """Decode an image and read its ground truth, runs in a prefetch thread"""
+    with Image.open(image_path) as img:
+        image = img.convert('RGB')
+    return image_path, image, load_ground_truth(image_path.with_suffix('.txt'))
+
+def prefetch(image_paths: Iterable[Path], workers: int = PREFETCH_WORKERS, depth: int = 2 * BATCH_SIZE) -> Iterator[Tuple[Path, Image.Image, List[Dict[str, Any]]]]:
+    """Yield decoded samples in order while up to `depth` more are decoded in the background"""
+    with ThreadPoolExecutor(workers) as pool:
+        pending: Deque[Future] = deque()
         for image_path in image_paths:
-            cursor = conn.execute('''
-                SELECT 1 FROM model_predictions 
-                WHERE model = ? AND file = ? LIMIT 1
-            ''', (model_name, image_path.name))
-            if cursor.fetchone():
-                # Skip processing if entry exists
-                continue
-
-            # Get predictions
-            results = model.predict(image_path)
-            boxes = results[0].boxes
-            predictions: List[Dict[str, Any]] = [{
-                'class': model.names[int(cls.item())],
-                'conf': float(conf.item()),
-                'bbox': box.tolist()
-            } for cls, conf, box in zip(boxes.cls, boxes.conf, boxes.xywhn)]
-
-            # Load ground truth
-            label_path: Path = image_path.with_suffix('.txt')
-            ground_truth: List[Dict[str, Any]] = load_ground_truth(label_path)
-
-            # Calculate metrics-based loss
-            if ground_truth:
-                precision, recall, avg_iou, class_acc = calculate_metrics(predictions, ground_truth)
-                # Composite loss (weighted combination)
-                loss: float = (1.0 - avg_iou) + (1.0 - precision) + (1.0 - recall) + (1.0 - class_acc)
-            else:
-                # Fallback to confidence-based loss if no ground truth
-                confidences: List[float] = [p['conf'] for p in predictions]
-                loss = 1 - (sum(confidences)/len(confidences)) if confidences else 1.0
-            log_prediction(conn, model_name, image_path.name, image_path.parent, predictions, loss)
+            pending.append(pool.submit(load_sample, image_path))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def batched(items: Iterable[Any], n: int) -> Iterator[List[Any]]:
+    batch: List[Any] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def composite_loss(predictions: List[Dict[str, Any]], metrics: Optional[Tuple[float, float, float, float]]) -> float:
+    if metrics is not None:
+        precision, recall, avg_iou, class_acc = metrics
+        # Composite loss (weighted combination)
+        return (1.0 - avg_iou) + (1.0 - precision) + (1.0 - recall) + (1.0 - class_acc)
+    # Fallback to confidence-based loss if no ground truth
+    confidences: List[float] = [p['conf'] for p in predictions]
+    return 1 - (sum(confidences)/len(confidences)) if confidences else 1.0
+
+def predict_batch(model: YOLO, model_name: str, samples: List[Tuple[Path, Image.Image, List[Dict[str, Any]]]]) -> List[PredictionRow]:
+    results = model.predict([image for _, image, _ in samples], verbose=False)
+    all_predictions: List[List[Dict[str, Any]]] = []
+    for result in results:
+        boxes = result.boxes
+        all_predictions.append([{
+            'class': model.names[int(cls)],
+            'class_id': int(cls),
+            'conf': conf,
+            'bbox': box
+        } for cls, conf, box in zip(boxes.cls.tolist(), boxes.conf.tolist(), boxes.xywhn.tolist())])
+    labeled = [i for i, (_, _, ground_truth) in enumerate(samples) if ground_truth]
+    metrics = dict(zip(labeled, calculate_metrics_batch([(all_predictions[i], samples[i][2]) for i in labeled])))
+    return [prediction_row(model_name, image_path.name, image_path.parent, predictions, composite_loss(predictions, metrics.get(i)))
+            for i, ((image_path, _, _), predictions) in enumerate(zip(samples, all_predictions))]
+
+def find_images(input_dirs: List[str]) -> Iterator[Path]:
+    for input_dir in input_dirs:
+        yield from (p for p in Path(input_dir).rglob('*') if p.suffix.lower() in IMAGE_SUFFIXES)
+
+def log_embeddings(conn: sqlite3.Connection, store: embeddings.EmbeddingStore, files: List[str],
+                   vectors: List[np.ndarray], segment: str) -> None:
+    """Append the embeddings of the files that are in the images table"""
+    if not files:
+        return
+    ids: Dict[str, int] = {}
+    for i in range(0, len(files), 900):
+        chunk = files[i:i + 900]
+        ids.update(conn.execute(f'SELECT file, id FROM images WHERE file IN ({", ".join("?" * len(chunk))})', chunk).fetchall())
+    keep = [i for i, file in enumerate(files) if file in ids]
+    if keep:
+        matrix = np.concatenate(vectors)
+        store.append([ids[files[i]] for i in keep], matrix[keep], segment)
+
+def run_pipeline(model: YOLO, model_name: str, image_paths: Iterable[Path], conn: sqlite3.Connection,
+                 batch_size: int = BATCH_SIZE, workers: int = PREFETCH_WORKERS, flush_rows: int = FLUSH_ROWS,
+                 checkpoint: Optional[Callable[[Path, int], None]] = None, label: Optional[str] = None,
+                 embed: bool = False, segment: str = "default") -> int:
+    """Predict image_paths and write the results, returns the number of images processed.
+
+    Images are decoded ahead of time in background threads, run through the
+    model `batch_size` at a time and written in transactions of `flush_rows`.
+    `checkpoint(last_path, count)` runs inside each write transaction. With
+    embed the pooled backbone features of the same forward pass are appended
+    to the model's embedding store, in the given segment.
+    """
+    label = label or model_name
+    rows: List[PredictionRow] = []
+    embedded_files: List[str] = []
+    embedded: List[np.ndarray] = []
+    count: int = 0
+    start: float = time.monotonic()
+    last_report: float = start
+    store: Optional[embeddings.EmbeddingStore] = embeddings.EmbeddingStore(model_name) if embed else None
+    hook: Optional[embeddings.FeatureHook] = embeddings.FeatureHook(model) if embed else None
+
+    def flush(last_path: Optional[Path]) -> None:
+        log_predictions(conn, rows)
+        if store is not None:
+            log_embeddings(conn, store, embedded_files, embedded, segment)
+        if checkpoint is not None and last_path is not None:
+            checkpoint(last_path, count)
+        conn.commit()
+
+    last_path: Optional[Path] = None
+    for samples in batched(prefetch(image_paths, workers, depth=2 * batch_size), batch_size):
+        if hook is not None:
+            hook.clear()
+        rows += predict_batch(model, model_name, samples)
+        if hook is not None:
+            features = hook.pop()
+            if features is not None and len(features) == len(samples):
+                embedded_files += [image_path.name for image_path, _, _ in samples]
+                embedded.append(features)
+        count += len(samples)
+        last_path = samples[-1][0]
+        if len(rows) >= flush_rows:
+            flush(last_path)
+            rows, embedded_files, embedded = [], [], []
+        now = time.monotonic()
+        if now - last_report >= REPORT_EVERY:
+            print(f"{label}: {count} images, {count / (now - start):.1f} images/s")
+            last_report = now
+    flush(last_path)
+    if hook is not None:
+        hook.remove()
+    elapsed = time.monotonic() - start
+    print(f"{label}: done, {count} images in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.1f} images/s)")
+    return count
+
+def process_images(model: YOLO, model_name: str, input_dirs: List[str], conn: sqlite3.Connection,
+                   batch_size: int = BATCH_SIZE, workers: int = PREFETCH_WORKERS, flush_rows: int = FLUSH_ROWS,
+                   embed: bool = False) -> int:
+    """Predict every image under input_dirs that has no row for model_name yet"""
+    done: set = processed_files(conn, model_name)
+    todo: Iterator[Path] = (p for p in find_images(input_dirs) if p.name not in done)
+    return run_pipeline(model, model_name, todo, conn, batch_size, workers, flush_rows, embed=embed)
+
+def shard_of(image_path: Path, num_shards: int) -> int:
+    """Stable shard for a file, based on its name so it does not depend on listing order"""
+    return zlib.crc32(image_path.name.encode()) % num_shards
+
+def run_shard(model_path: str, model_name: str, db_path: str, shard: int, num_shards: int, image_paths: List[str],
+              threads: int, batch_size: int = BATCH_SIZE, workers: int = PREFETCH_WORKERS, flush_rows: int = FLUSH_ROWS,
+              embed: bool = False) -> int:
+    """Process one shard in a worker process, resuming after its last checkpointed file.
+
+    image_paths must be sorted, the checkpoint is the last file written.
+    Files that already have a prediction are skipped as well.
+    """
+    import torch
+    torch.set_num_threads(threads)
+    conn: sqlite3.Connection = create_db_connection(db_path)
+    create_jobs_table(conn)
+    last_file, processed, status = load_checkpoint(conn, model_name, shard, num_shards)
+    if status == 'done':
+        # a finished shard is rerun to pick up new images, which may sort before the old checkpoint
+        last_file = None
+    done: set = processed_files(conn, model_name)
+    todo: List[Path] = [Path(p) for p in image_paths if (last_file is None or p > last_file) and Path(p).name not in done]
+    save_checkpoint(conn, model_name, shard, num_shards, last_file, processed, 'running')
+    conn.commit()
+    model: YOLO = YOLO(model_path)
+
+    def checkpoint(last_path: Path, count: int) -> None:
+        save_checkpoint(conn, model_name, shard, num_shards, str(last_path), processed + count, 'running')
+
+    try:
+        count = run_pipeline(model, model_name, todo, conn, batch_size, workers, flush_rows,
+                             checkpoint=checkpoint, label=f"{model_name} shard {shard}/{num_shards}",
+                             embed=embed, segment=f"shard-{shard}-of-{num_shards}")
+        save_checkpoint(conn, model_name, shard, num_shards, image_paths[-1] if image_paths else None, processed + count, 'done')
+        conn.commit()
+    finally:
+        conn.close()
+    return count
+
+def run_job(model_path: str, model_name: str, input_dirs: List[str], db_path: str, num_shards: int,
+            processes: Optional[int] = None, threads: Optional[int] = None,
+            batch_size: int = BATCH_SIZE, workers: int = PREFETCH_WORKERS, embed: bool = False) -> int:
+    """Split the images into num_shards deterministic shards and predict them in parallel processes.
+
+    Each process loads its own model and gets `threads` CPU threads. Progress
+    is checkpointed per shard in prediction_jobs, so rerunning the same job
+    resumes every shard where it stopped.
+    """
+    processes = processes or num_shards
+    threads = threads or max(1, (os.cpu_count() or 1) // processes)
+    shards: List[List[str]] = [[] for _ in range(num_shards)]
+    for image_path in find_images(input_dirs):
+        shards[shard_of(image_path, num_shards)].append(str(image_path))
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(processes, mp_context=ctx) as pool:
+        futures = [pool.submit(run_shard, model_path, model_name, str(db_path), shard, num_shards, sorted(paths),
+                               threads, batch_size, workers, FLUSH_ROWS, embed)
+                   for shard, paths in enumerate(shards)]
+        return sum(f.result() for f in futures)
 
 if __name__ == "__main__":
-    model_name: str = "FEB28_N_1536_v5_T2_v1"
-    model_path: str = f"/home/newton/repo/Football-Analysis-using-YOLO/runs/detect/{model_name}/weights/best.pt"
+    parser = argparse.ArgumentParser(description="score images with a YOLO model and log predictions")
+    parser.add_argument("--model-name", default="FEB28_N_1536_v5_T2_v1")
+    parser.add_argument("--model-path", default=None, help="defaults to the training run of --model-name")
+    parser.add_argument("--db", default=str(p / "images.db"))
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--prefetch-workers", type=int, default=PREFETCH_WORKERS)
+    parser.add_argument("--shards", type=int, default=0, help="run as a resumable job split into this many shards")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes for --shards, defaults to one per shard")
+    parser.add_argument("--threads", type=int, default=None, help="CPU threads per worker process")
+    parser.add_argument("--embed", action="store_true", help="also store image embeddings for /similar and rebuild their index")
+    args = parser.parse_args()
+    model_name: str = args.model_name
+    model_path: str = args.model_path or f"/home/newton/repo/Football-Analysis-using-YOLO/runs/detect/{model_name}/weights/best.pt"
 
     data_paths: List[str] = []
     with open(p / "paths.txt") as f:
@@ -145,9 +325,15 @@ if __name__ == "__main__":
             data_paths.append(pth)
 
     print(data_paths)
-    conn: sqlite3.Connection = create_db_connection(p/"images.db")
-    model: YOLO = YOLO(model_path)
-    try:
-        process_images(model, model_name, data_paths, conn)
-    finally:
-        conn.close()
+    if args.shards:
+        run_job(model_path, model_name, data_paths, args.db, args.shards, args.processes, args.threads,
+                args.batch_size, args.prefetch_workers, args.embed)
+    else:
+        conn: sqlite3.Connection = create_db_connection(args.db)
+        model: YOLO = YOLO(model_path)
+        try:
+            process_images(model, model_name, data_paths, conn, args.batch_size, args.prefetch_workers, embed=args.embed)
+        finally:
+            conn.close()
+    if args.embed:
+        print(f"indexed {embeddings.EmbeddingStore(model_name).build_index()} embeddings")
@@ -0,0 +1,121 @@
+import sys
+import sqlite3
+from typing import Any, List, Tuple
+import database
+import boxes
+from collection_stats import LABELED_SQL
+
+# the trigram tokenizer matches any substring of three or more characters
+MIN_MATCH_CHARS: int = 3
+
+TRIGGERS: List[str] = [
+    '''CREATE TRIGGER IF NOT EXISTS image_search_insert AFTER INSERT ON images BEGIN
+        INSERT INTO image_search (rowid, path)
+        SELECT NEW.id, COALESCE((SELECT root_dir FROM root_dirs WHERE id = NEW.root_dir_id) || '/', '') || NEW.file;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS image_search_delete AFTER DELETE ON images BEGIN
+        DELETE FROM image_search WHERE rowid = OLD.id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS image_search_update AFTER UPDATE OF file, root_dir_id ON images BEGIN
+        UPDATE image_search
+        SET path = COALESCE((SELECT root_dir FROM root_dirs WHERE id = NEW.root_dir_id) || '/', '') || NEW.file
+        WHERE rowid = NEW.id;
+    END''',
+]
+
+def create_search_index(conn: sqlite3.Connection) -> None:
+    """Create the full text index over image paths and the triggers that maintain it, filling it on first use"""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if 'images' not in tables:
+        return
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS image_search USING fts5(path, tokenize = 'trigram')")
+    for statement in TRIGGERS:
+        conn.execute(statement)
+    if 'image_search' not in tables:
+        rebuild_search_index(conn)
+    conn.commit()
+
+def rebuild_search_index(conn: sqlite3.Connection) -> None:
+    conn.execute('DELETE FROM image_search')
+    conn.execute('''
+        INSERT INTO image_search (rowid, path)
+        SELECT i.id, COALESCE(r.root_dir || '/', '') || i.file
+        FROM images AS i LEFT JOIN root_dirs AS r ON r.id = i.root_dir_id
+    ''')
+
+def match_expression(text: str) -> str:
+    """Quote text as one FTS5 phrase so the query syntax characters are matched literally"""
+    return '"' + text.replace('"', '""') + '"'
+
+def like_pattern(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_filters(args: Any) -> Tuple[str, str, str, List[Any]]:
+    """FROM and WHERE clauses for a search on request args, returns (from_sql, id_sql, where_sql, params).
+
+    `q` matches any part of the image path (collection directory and file
+    name), `prefix` matches the start of the file name. `class`, `not_class`,
+    `min_boxes` and `max_boxes` look at the labels, or at one model's
+    predictions with source=prediction&model=... as in the /boxes endpoints.
+    `min_loss` and `max_loss` look at the loss of `model`, `labeled` is 1 or 0.
+    """
+    from_sql, id_sql, clauses, params = 'images AS i', 'i.id', [], []
+    text = (args.get('q') or '').strip()
+    if len(text) >= MIN_MATCH_CHARS:
+        # drive from the index, which yields rowids in order
+        from_sql, id_sql = 'image_search AS s JOIN images AS i ON i.id = s.rowid', 's.rowid'
+        clauses.append('image_search MATCH ?')
+        params.append(match_expression(text))
+    elif text:
+        clauses.append("i.file LIKE ? ESCAPE '\\'")
+        params.append(f'%{like_pattern(text)}%')
+    prefix = args.get('prefix')
+    if prefix:
+        # a range on the unique file index instead of LIKE, which would scan
+        clauses.append('i.file >= ? AND i.file < ?')
+        params += [prefix, prefix + '\U0010ffff']
+    if 'collection_id' in args:
+        clauses.append('i.root_dir_id = ?')
+        params.append(args.get('collection_id', type=int))
+    labeled = args.get('labeled', type=int)
+    if labeled is not None:
+        exists = 'EXISTS' if labeled else 'NOT EXISTS'
+        clauses.append(f"{exists} (SELECT 1 FROM labels AS l WHERE l.image_id = i.id AND {LABELED_SQL.format('l')})")
+    model = args.get('model')
+    source = args.get('source', boxes.SOURCE_LABEL)
+    box_model = (model or '') if source == boxes.SOURCE_PREDICTION else ''
+    for name, exists in (('class', 'EXISTS'), ('not_class', 'NOT EXISTS')):
+        class_id = args.get(name, type=int)
+        if class_id is not None:
+            clauses.append(f'''{exists} (SELECT 1 FROM boxes AS b
+                WHERE b.source = ? AND b.model = ? AND b.class_id = ? AND b.image_id = i.id)''')
+            params += [source, box_model, class_id]
+    min_boxes, max_boxes = args.get('min_boxes', type=int), args.get('max_boxes', type=int)
+    if min_boxes is not None or max_boxes is not None:
+        clauses.append('''(SELECT COUNT(*) FROM boxes AS b
+            WHERE b.image_id = i.id AND b.source = ? AND b.model = ?) BETWEEN ? AND ?''')
+        params += [source, box_model, min_boxes or 0, max_boxes if max_boxes is not None else sys.maxsize]
+    min_loss, max_loss = args.get('min_loss', type=float), args.get('max_loss', type=float)
+    if model and (min_loss is not None or max_loss is not None):
+        clauses.append('''EXISTS (SELECT 1 FROM model_predictions AS mp
+            WHERE mp.file = i.file AND mp.model = ? AND mp.loss BETWEEN ? AND ?)''')
+        params += [model, min_loss if min_loss is not None else float('-inf'), max_loss if max_loss is not None else float('inf')]
+    return from_sql, id_sql, ' AND '.join(clauses) or '1', params
+
+def search_images(conn: sqlite3.Connection, args: Any, after_id: int = 0, limit: int = 200) -> sqlite3.Cursor:
+    """Cursor over (id, file) of matching images in id order, starting after after_id"""
+    from_sql, id_sql, where, params = search_filters(args)
+    return conn.execute(f'''
+        SELECT i.id, i.file FROM {from_sql}
+        WHERE {id_sql} > ? AND {where}
+        ORDER BY {id_sql}
+        LIMIT ?
+    ''', (after_id, *params, limit))
+
+if __name__ == "__main__":
+    conn = database.connect(sys.argv[1] if len(sys.argv) > 1 else database.DB_PATH)
+    create_search_index(conn)
+    rebuild_search_index(conn)
+    conn.commit()
+    print(f"indexed: {conn.execute('SELECT COUNT(*) FROM image_search').fetchone()[0]}")
+    conn.close()
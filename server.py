@@ -1,18 +1,83 @@
 import os
+import sys
+import math
+import array
+import struct
+import itertools
+import base64
 import re
 import json
-import sqlite3
+import database
 from pathlib import Path
 from PIL import Image, ImageDraw
-from flask import Flask, render_template, request, send_file, jsonify, Response, abort
-from ultralytics import YOLO
+from flask import Flask, render_template, request, send_file, jsonify, Response, abort, stream_with_context
+from inference import DEFAULT_MODEL, registry, predictor
+import thumbnails
+import boxes
+import collection_stats
+import search
+import videos
+import overlays
+import instrumentation
+import embeddings
+import label_ops
+import loss_overview
+import model_diff
 
 app = Flask(__name__)
+instrumentation.install(app, database.pool)
+
+PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+NEIGHBOURS = 5
+PREDICT_TIMEOUT = 60
+STREAM_BLOCK = 1000
+LISTING_FORMATS = {'json': 'application/json', 'ndjson': 'application/x-ndjson',
+                   'columns': 'application/x-ndjson', 'binary': 'application/octet-stream'}
 
 def get_db_connection():
-    conn = sqlite3.connect('images.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    return database.pool.connection()
+
+def init_db():
+    with get_db_connection() as conn:
+        boxes.create_boxes_table(conn)
+        database.create_indexes(conn)
+        collection_stats.create_collection_stats(conn)
+        search.create_search_index(conn)
+        model_diff.create_model_diff(conn)
+        loss_overview.create_loss_overview(conn)
+        conn.execute('PRAGMA optimize')
+
+def find_image_id(conn, filename):
+    row = conn.execute('SELECT id FROM images WHERE file = ?', (filename,)).fetchone()
+    return row['id'] if row else None
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def is_keyset(values):
+    """A [sort value, image id] keyset: a number or null, then an integer id"""
+    return (isinstance(values, list) and len(values) == 2
+            and (values[0] is None or isinstance(values[0], (int, float))) and not isinstance(values[0], bool)
+            and isinstance(values[1], int) and not isinstance(values[1], bool))
+
+def decode_cursor(cursor):
+    """['l', loss, id] after a loss ordered page or ['n', id] after an id ordered one, ValueError for anything else"""
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"invalid cursor {cursor}") from e
+    kind = values[:1] if isinstance(values, list) else None
+    if not is_keyset(values[1:] if kind == ['l'] else [None, *values[1:]] if kind == ['n'] else None):
+        raise ValueError(f"invalid cursor {cursor}")
+    return values
+
+def latest_model(cursor):
+    cursor.execute('SELECT model FROM model_predictions ORDER BY id DESC LIMIT 1')
+    row = cursor.fetchone()
+    return row['model'] if row else None
 
 @app.route('/')
 def index():
@@ -24,176 +89,598 @@ def inspect(image):
 
 @app.route('/image_collections')
 def get_image_collections():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM root_dirs')
-    collections = cursor.fetchall()
-
-    # Add cover_image to each collection
-    res = [dict(row) for row in collections] 
-    for row in res:
-        collection_id = row['id']
-        cursor.execute('SELECT file FROM images WHERE root_dir_id = ? LIMIT 1', (collection_id,))
-        path = cursor.fetchone()
-        if id: row['cover_image'] = path[0]
-        else: raise LookupError(f"could not find any images in root_dir with id {collection_id}")
-    conn.close()
+    """Every collection with its stats, with ?format=ndjson one collection per line as they are read"""
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            with get_db_connection() as conn:
+                for summary in collection_stats.iter_collection_summaries(conn):
+                    yield json.dumps(summary) + '\n'
+        return Response(stream_with_context(generate()), mimetype=LISTING_FORMATS['ndjson'])
+    with get_db_connection() as conn:
+        res = collection_stats.collection_summaries(conn)
     return jsonify(res)
 
 @app.route('/image_id/<path:filename>')
 def get_image_id(filename):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    # Fetch the current image and its order
-    cursor.execute('SELECT id FROM images WHERE file = ?', (filename,))
-    current = cursor.fetchone()
-    if not current:
-        return "Image not found", 404
-    current_id = current['id']
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # Fetch the current image and its order
+        cursor.execute('SELECT id FROM images WHERE file = ?', (filename,))
+        current = cursor.fetchone()
+        if not current:
+            return "Image not found", 404
+        current_id = current['id']
     return jsonify(current_id)
 
+def listing_query(phase, collection_id, model, keyset, limit, reverse):
+    """SQL and parameters of one listing phase, a limit of -1 reads the phase to its end"""
+    cmp, order = ('>', 'ASC') if reverse else ('<', 'DESC')
+    if phase == 'l':
+        keyset_sql = '' if keyset is None else f'AND (mp.loss, i.id) {cmp} (?, ?)'
+        return f'''
+          SELECT 'l', mp.loss, i.id, i.file
+          FROM images as i
+          JOIN model_predictions as mp
+              ON mp.file = i.file AND mp.model = ?
+          WHERE i.root_dir_id = ? AND mp.loss IS NOT NULL {keyset_sql}
+          ORDER BY mp.loss {order}, i.id {order}
+          LIMIT ?
+        ''', (model, collection_id, *(keyset[1:] if keyset else ()), limit)
+    keyset_sql = '' if keyset is None else f'AND i.id {cmp} ?'
+    return f'''
+      SELECT 'n', i.id, i.file
+      FROM images as i
+      WHERE i.root_dir_id = ? {keyset_sql} AND NOT EXISTS (
+          SELECT 1 FROM model_predictions as mp
+          WHERE mp.file = i.file AND mp.model = ? AND mp.loss IS NOT NULL)
+      ORDER BY i.id {order}
+      LIMIT ?
+    ''', (collection_id, *(keyset[1:] if keyset else ()), model, limit)
+
+def listing_phase(cursor, phase, collection_id, model, keyset, limit, reverse):
+    cursor.execute(*listing_query(phase, collection_id, model, keyset, limit, reverse))
+    return [tuple(row) for row in cursor.fetchall()]
+
+def listing_rows(cursor, collection_id, model, after=None, limit=PAGE_SIZE, reverse=False):
+    """Rows of a collection listing that follow the keyset `after`, or precede it when reverse is set.
+
+    The listing has the images with a loss for model first, highest loss
+    first, followed by the images the model has not scored yet, newest first.
+    Rows are ('l', loss, id, file) or ('n', id, file), without the file they
+    are the keyset of that row. Reverse results are nearest first.
+    """
+    phases = ['l', 'n'] if model is not None else ['n']
+    if reverse: phases.reverse()
+    rows = []
+    started = after is None
+    for phase in phases:
+        if len(rows) >= limit: break
+        keyset = None
+        if not started:
+            if after[0] != phase: continue
+            keyset, started = after, True
+        rows += listing_phase(cursor, phase, collection_id, model, keyset, limit - len(rows), reverse)
+    return rows
+
+def row_loss(row):
+    return row[1] if row[0] == 'l' else None
+
+def iter_listing(cursor, collection_id, model, after=None):
+    """Every row of a collection listing after the keyset `after`, in listing order, read straight from the cursor"""
+    phases = ['l', 'n'] if model is not None else ['n']
+    started = after is None
+    for phase in phases:
+        keyset = None
+        if not started:
+            if after[0] != phase: continue
+            keyset, started = after, True
+        cursor.execute(*listing_query(phase, collection_id, model, keyset, -1, False))
+        while True:
+            rows = cursor.fetchmany(STREAM_BLOCK)
+            if not rows: break
+            yield from map(tuple, rows)
+
+def stream_listing(collection_id, model, after, limit, fmt):
+    """Generate a listing as NDJSON rows, NDJSON column blocks or binary frames.
+
+    ndjson: one {"file", "loss"} object per line.
+    columns: one {"files": [...], "losses": [...]} object per block of rows.
+    binary: per block a little endian uint32 row count and uint32 name byte
+    length, the losses as float32 (NaN for unscored images) and the file
+    names joined by newlines.
+    All three end with the cursor of the next page, null or empty when the
+    listing is complete: a {"next_cursor"} line, or a binary frame with no
+    rows whose names hold the cursor.
+    """
+    def blocks():
+        with get_db_connection() as conn:
+            rows = itertools.islice(iter_listing(conn.cursor(), collection_id, model, after), limit)
+            count, last = 0, None
+            while True:
+                block = list(itertools.islice(rows, STREAM_BLOCK))
+                if not block: break
+                count, last = count + len(block), block[-1]
+                yield block
+        yield encode_cursor(list(last[:-1])) if limit is not None and count == limit else None
+
+    for block in blocks():
+        if not isinstance(block, list):
+            if fmt == 'binary':
+                name_bytes = (block or '').encode()
+                yield struct.pack('<II', 0, len(name_bytes)) + name_bytes
+            else:
+                yield json.dumps({'next_cursor': block}) + '\n'
+        elif fmt == 'ndjson':
+            yield ''.join(json.dumps({'file': row[-1], 'loss': row_loss(row)}) + '\n' for row in block)
+        elif fmt == 'columns':
+            yield json.dumps({'files': [row[-1] for row in block], 'losses': [row_loss(row) for row in block]}) + '\n'
+        else:
+            name_bytes = '\n'.join(row[-1] for row in block).encode()
+            losses = array.array('f', (row[1] if row[0] == 'l' else math.nan for row in block))
+            if sys.byteorder != 'little': losses.byteswap()
+            yield struct.pack('<II', len(block), len(name_bytes)) + losses.tobytes() + name_bytes
+
 @app.route('/images/<int:collection_id>')
 def list_images(collection_id):
-    images_conn = get_db_connection()
-    images_cursor = images_conn.cursor()
-    images_cursor.execute('''
-      SELECT i.file, mp.loss
-      FROM images as i
-      LEFT JOIN model_predictions as mp
-          ON i.file LIKE mp.file
-      WHERE i.root_dir_id = ?
-      ORDER BY mp.loss DESC
-    ''', (collection_id,))
-    images = images_cursor.fetchall()
-    images_conn.close()
-    return jsonify([{'file': row['file'], 'loss': row['loss']} for row in images])
+    """A page of a collection listing as JSON, or with ?format=ndjson|columns|binary the listing streamed from
+    the cursor, see stream_listing. Streams have no limit unless ?limit is given."""
+    fmt = request.args.get('format', 'json')
+    if fmt not in LISTING_FORMATS:
+        return f"Unsupported format, expected one of {LISTING_FORMATS}", 400
+    try:
+        after = decode_cursor(request.args.get('cursor'))
+    except ValueError:
+        return "invalid cursor", 400
+    if fmt != 'json':
+        limit = request.args.get('limit', type=int)
+        with get_db_connection() as conn:
+            model = request.args.get('model') or latest_model(conn.cursor())
+        response = Response(stream_with_context(stream_listing(collection_id, model, after, None if limit is None else max(1, limit), fmt)),
+                            mimetype=LISTING_FORMATS[fmt])
+        response.headers['X-Model'] = model or ''
+        return response
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        model = request.args.get('model') or latest_model(cursor)
+        rows = listing_rows(cursor, collection_id, model, after, limit)
+    next_cursor = encode_cursor(rows[-1][:-1]) if len(rows) == limit else None
+    return jsonify({
+        'model': model,
+        'images': [{'file': row[-1], 'loss': row_loss(row)} for row in rows],
+        'next_cursor': next_cursor,
+    })
+
+def prediction_boxes(predictions, class_names):
+    """Stored model predictions in the label format the inspect view draws"""
+    return [{'class': boxes.class_id_for(p, class_names), 'conf': p.get('conf'), 'coordinates': boxes.box_coordinates(p)}
+            for p in predictions]
+
+@app.route('/inspect_data/<path:filename>')
+def get_inspect_data(filename):
+    """Everything the inspect view needs for one image, returns 304 when the client copy is current"""
+    neighbours = max(0, min(request.args.get('neighbours', NEIGHBOURS, type=int), MAX_PAGE_SIZE))
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT i.id, i.root_dir_id, i.revisions, r.label_classes, l.labels_json
+            FROM images AS i
+            JOIN root_dirs AS r ON r.id = i.root_dir_id
+            LEFT JOIN labels AS l ON l.image_id = i.id
+            WHERE i.file = ?
+        ''', (filename,))
+        image = cursor.fetchone()
+        if not image:
+            return "Image not found", 404
+        class_names = image['label_classes'].split(" ") if image['label_classes'] else []
+        cursor.execute('SELECT model, predictions, loss, timestamp FROM model_predictions WHERE file = ?', (filename,))
+        predictions = {row['model']: {
+            'loss': row['loss'],
+            'timestamp': row['timestamp'],
+            'boxes': prediction_boxes(json.loads(row['predictions']) if row['predictions'] else [], class_names),
+        } for row in cursor.fetchall()}
+        model = request.args.get('model') or latest_model(cursor)
+        loss = predictions.get(model, {}).get('loss')
+        current = ('l', loss, image['id']) if loss is not None else ('n', image['id'])
+        prev_rows = listing_rows(cursor, image['root_dir_id'], model, current, neighbours, reverse=True)[::-1]
+        next_rows = listing_rows(cursor, image['root_dir_id'], model, current, neighbours)
+        neighbour_files = [row[-1] for row in prev_rows + next_rows]
+        cursor.execute(f'''
+            SELECT i.file FROM images AS i JOIN labels AS l ON l.image_id = i.id
+            WHERE i.file IN ({", ".join("?" * len(neighbour_files))})
+              AND l.labels_json IS NOT NULL AND l.labels_json NOT IN ('[]', '{{}}')
+        ''', neighbour_files)
+        labeled = {row['file'] for row in cursor.fetchall()}
+    labels = json.loads(image['labels_json']) if image['labels_json'] else []
+    neighbour = lambda row: {'file': row[-1], 'loss': row_loss(row), 'has_labels': row[-1] in labeled}
+    response = jsonify({
+        'file': filename,
+        'image_id': image['id'],
+        'root_dir_id': image['root_dir_id'],
+        'revision': image['revisions'],
+        'classes': {k: c for c, k in enumerate(class_names)},
+        'labels': labels if isinstance(labels, list) else [],
+        'model': model,
+        'loss': loss,
+        'predictions': predictions,
+        'prev': [neighbour(row) for row in prev_rows],
+        'next': [neighbour(row) for row in next_rows],
+    })
+    response.add_etag()
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/image/<path:filename>')
 def get_image(filename):
-    print("DEBUG")
-    print(filename)
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT r.root_dir, i.file FROM root_dirs as r JOIN images as i on r.id = i.root_dir_id WHERE i.file = ?', (filename,))
-    result = cursor.fetchone()
-    if not result:
-        return "Image not found", 404
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT r.root_dir, i.file FROM root_dirs as r JOIN images as i on r.id = i.root_dir_id WHERE i.file = ?', (filename,))
+        result = cursor.fetchone()
+        if not result:
+            return "Image not found", 404
     image_full_path = Path(os.path.join(*result))
     assert image_full_path.exists(), f"could not find {image_full_path}"
     return send_file(image_full_path)
 
+@app.route('/thumb/<int:size>/<path:filename>')
+def get_thumbnail(size, filename):
+    if size not in thumbnails.THUMB_SIZES:
+        return f"Unsupported thumbnail size, expected one of {thumbnails.THUMB_SIZES}", 404
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT r.root_dir, i.file FROM root_dirs as r JOIN images as i on r.id = i.root_dir_id WHERE i.file = ?', (filename,))
+        result = cursor.fetchone()
+        if not result:
+            return "Image not found", 404
+    image_full_path = Path(os.path.join(*result))
+    if not image_full_path.exists():
+        return "Image file does not exist", 404
+    return send_file(thumbnails.cache.get(image_full_path, size), mimetype='image/jpeg', max_age=86400)
+
+@app.route('/draw_labels/<path:filename>')
+def draw_labels(filename):
+    """The image resized to ?size with its labels and/or the boxes of ?model drawn on it"""
+    size = max(16, min(request.args.get('size', 512, type=int), overlays.MAX_SIZE))
+    show_labels = request.args.get('labels', 1, type=int) != 0
+    model = request.args.get('model')
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT i.id, i.revisions, r.root_dir, r.label_classes, l.labels_json
+            FROM images AS i
+            JOIN root_dirs AS r ON r.id = i.root_dir_id
+            LEFT JOIN labels AS l ON l.image_id = i.id
+            WHERE i.file = ?
+        ''', (filename,))
+        image = cursor.fetchone()
+        if not image:
+            return "Image not found", 404
+        prediction = None
+        if model:
+            cursor.execute('SELECT id, predictions FROM model_predictions WHERE file = ? AND model = ?', (filename, model))
+            prediction = cursor.fetchone()
+    image_full_path = Path(image['root_dir']) / filename
+    if not image_full_path.exists():
+        return "Image file does not exist", 404
+    class_names = image['label_classes'].split(" ") if image['label_classes'] else []
+    labels = json.loads(image['labels_json']) if show_labels and image['labels_json'] else []
+    predictions = json.loads(prediction['predictions']) if prediction and prediction['predictions'] else []
+    key = overlays.overlay_key(image['id'], image['revisions'] or 0, size, show_labels, model, prediction['id'] if prediction else None)
+    data = overlays.cache.get(key, image_full_path, size,
+                              overlays.overlay_boxes(labels if isinstance(labels, list) else [], class_names),
+                              overlays.overlay_boxes(predictions, class_names), class_names)
+    response = Response(data, mimetype='image/jpeg')
+    response.set_etag(key)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
 @app.route('/root_dir_id/<path:filename>')
 def get_root_dir_id(filename):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT root_dir_id FROM images WHERE file = ?', (filename,))
-    result = cursor.fetchone()
-    if not result:
-        return "root_dir_id not found", 404
-    root_dir_id = result['root_dir_id']
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT root_dir_id FROM images WHERE file = ?', (filename,))
+        result = cursor.fetchone()
+        if not result:
+            return "root_dir_id not found", 404
+        root_dir_id = result['root_dir_id']
     return jsonify(root_dir_id)
 
 @app.route('/label_classes/<path:filename>')
 def get_label_classes(filename):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT r.label_classes 
-        FROM root_dirs AS r 
-        JOIN images AS i ON r.id = i.root_dir_id 
-        WHERE i.file = ?
-    ''', (filename,))
-    result = cursor.fetchone()
-    if not result or not result['label_classes']:
-        return jsonify({})
-    label_classes = {k:c for c,k in enumerate(result['label_classes'].split(" "))}
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT r.label_classes 
+            FROM root_dirs AS r 
+            JOIN images AS i ON r.id = i.root_dir_id 
+            WHERE i.file = ?
+        ''', (filename,))
+        result = cursor.fetchone()
+        if not result or not result['label_classes']:
+            return jsonify({})
+        label_classes = {k:c for c,k in enumerate(result['label_classes'].split(" "))}
     return jsonify(label_classes)
 
 @app.route('/labels/<path:filename>')
 def get_labels(filename):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT labels_json FROM labels WHERE image_id = (select id from images where file = ?)', (filename,))
-    result = cursor.fetchone()
-    if not result or not result['labels_json']:
-        return jsonify([])
-    labels = json.loads(result['labels_json'])
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT labels_json FROM labels WHERE image_id = (select id from images where file = ?)', (filename,))
+        result = cursor.fetchone()
+        if not result or not result['labels_json']:
+            return jsonify([])
+        labels = json.loads(result['labels_json'])
     return jsonify(labels)
 
+def revision_conflict(e):
+    return jsonify({"status": "conflict", "message": str(e), "conflicts": e.conflicts}), 409
+
 @app.route('/update_labels', methods=['post'])
 def add_labels():
+    """Replace an image's labels, with "revision" only if nobody changed them since that revision"""
     data = request.get_json()
     if not isinstance(data, dict) or 'filename' not in data or 'labels' not in data:
         return "invalid input data", 400
     filename = data['filename']
     labels = data['labels']
-    if not isinstance(labels, list):
+    revision = data.get('revision')
+    if not isinstance(labels, list) or not (revision is None or isinstance(revision, int)):
         return "invalid label data", 400
 
-    # remove duplicate labels based on 'class' and 'coordinates'
-    unique_labels = {}
-    for label in labels:
-        label_class = label.get('class')
-        coordinates = tuple(label.get('coordinates', []))
-        key = (label_class, coordinates)
-        if key not in unique_labels:
-            unique_labels[key] = label
-    print(f"adding {len(list(unique_labels.values()))} labels, duplicates: {len(labels)-len(list(unique_labels.values()))}")
-
-    labels = list(unique_labels.values())
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE labels
-        SET labels_json = ?
-        WHERE image_id = (SELECT id FROM images WHERE file = ?)
-    ''', (json.dumps(labels), filename))
-    conn.commit()
-    conn.close()
-    return jsonify({"status": "success", "message": "labels added successfully"})
+    unique_labels = label_ops.dedupe_labels(labels)
+    try:
+        with get_db_connection() as conn:
+            image_id = find_image_id(conn, filename)
+            if image_id is None:
+                return "Image not found", 404
+            revision = label_ops.write_labels(conn, image_id, unique_labels, revision)
+    except label_ops.RevisionConflict as e:
+        return revision_conflict(e)
+    overlays.cache.invalidate(image_id)
+    return jsonify({"status": "success", "message": "labels added successfully", "revision": revision})
 
 @app.route('/delete_labels/<path:filename>')
 def delete_labels(filename):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE labels
-        SET labels_json = ?
-        WHERE image_id = (SELECT id FROM images WHERE file = ?)
-    ''', (json.dumps([]), filename))
-    conn.commit()
-    conn.close()
-    return jsonify({"status": "success", "message": "Labels removed successfully"})
+    with get_db_connection() as conn:
+        image_id = find_image_id(conn, filename)
+        if image_id is None:
+            return "Image not found", 404
+        revision = label_ops.write_labels(conn, image_id, [])
+    overlays.cache.invalidate(image_id)
+    return jsonify({"status": "success", "message": "Labels removed successfully", "revision": revision})
+
+@app.route('/bulk_labels', methods=['post'])
+def bulk_labels():
+    """Apply many label operations in one transaction, see label_ops.BulkEditor.
+
+    The body is {"operations": [...], "revisions": {image_id: revision}, "dry_run": false}, operations are
+    {"op": "set", "file" or "image_id", "labels", "revision"},
+    {"op": "remap", "collection_id", "classes": {old: new or null}},
+    {"op": "filter_size", "collection_id", "min_w", "min_h", "min_area", "max_w", "max_h", "max_area", "classes"} and
+    {"op": "accept_predictions", "collection_id", "model", "min_conf", "mode": "missing" | "replace" | "append"}.
+    Any stale revision rolls back every operation and returns 409 with the conflicts.
+    """
+    data = request.get_json()
+    if not isinstance(data, dict) or not isinstance(data.get('operations'), list):
+        return "invalid input data", 400
+    dry_run = bool(data.get('dry_run'))
+    try:
+        with get_db_connection() as conn:
+            editor = label_ops.BulkEditor(conn, {int(k): int(v) for k, v in (data.get('revisions') or {}).items()})
+            results = editor.apply(data['operations'])
+            if dry_run:
+                conn.rollback()
+    except label_ops.RevisionConflict as e:
+        return revision_conflict(e)
+    except label_ops.UnknownImage as e:
+        return f"image not found: {e}", 404
+    except (KeyError, ValueError, TypeError, AttributeError) as e:
+        return f"invalid operation: {e}", 400
+    if not dry_run:
+        for image_id in editor.written:
+            overlays.cache.invalidate(image_id)
+    return jsonify({"status": "success", "dry_run": dry_run, "results": results})
+
+@app.route('/similar/<path:filename>')
+def similar_images(filename):
+    """The k images whose embeddings for ?model are closest to this image's, across all collections"""
+    k = max(1, min(request.args.get('k', embeddings.DEFAULT_K, type=int), MAX_PAGE_SIZE))
+    nprobe = max(1, request.args.get('nprobe', embeddings.NPROBE, type=int))
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        image_id = find_image_id(conn, filename)
+        if image_id is None:
+            return "Image not found", 404
+        model = request.args.get('model') or latest_model(cursor)
+        if model is None:
+            return "No model to compare with", 404
+        if model not in embeddings.models():
+            return f"No embeddings for model {model}", 404
+        try:
+            hits = embeddings.store_for(model).search(image_id, k, nprobe)
+        except KeyError:
+            return f"No {model} embedding for this image", 404
+        cursor.execute(f'SELECT id, file, root_dir_id FROM images WHERE id IN ({", ".join("?" * len(hits))})',
+                       [image_id for image_id, _ in hits])
+        images = {row['id']: row for row in cursor.fetchall()}
+    return jsonify({'model': model, 'images': [
+        {'file': images[i]['file'], 'image_id': i, 'root_dir_id': images[i]['root_dir_id'], 'score': score}
+        for i, score in hits if i in images]})
 
 @app.route('/predict/<path:filename>')
 def predict_image(filename):
-    # Define the path to the YOLO model
-    model_path = Path(__file__).parent / "models" / "feb16.pt"
-    model = YOLO(model_path)
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT r.root_dir, i.file
-        FROM root_dirs as r
-        JOIN images as i on r.id = i.root_dir_id WHERE i.file = ?
-    ''', (filename,))
-    result = cursor.fetchone()
-    conn.close()
-    if not result:
-        return "Image not found", 404
-    print([x for x in result])
+    model_name = request.args.get('model', DEFAULT_MODEL)
+    if model_name not in registry.available():
+        return f"Model {model_name} not found", 404
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT r.root_dir, i.file
+            FROM root_dirs as r
+            JOIN images as i on r.id = i.root_dir_id WHERE i.file = ?
+        ''', (filename,))
+        result = cursor.fetchone()
+        if not result:
+            return "Image not found", 404
     image_full_path = Path(os.path.join(*result))
     if not image_full_path.exists():
         return "Image file does not exist", 404
-    preds = [p.boxes for p in model.predict(image_full_path)]
-    res = []
-    for p in model.predict(image_full_path):
-        for b in p.boxes:
-            for (_cls,_conf,_xyxy) in zip(b.cls.T.tolist(), b.conf.T.tolist(), b.xywhn.tolist()):
-                res.append({"class": _cls, "conf": _conf, "coordinates": _xyxy})
-    return jsonify(res)
+    try:
+        return jsonify(predictor.predict(model_name, image_full_path, timeout=PREDICT_TIMEOUT))
+    except TimeoutError:
+        return "Prediction timed out", 503
 
-VIDEO_PATH = Path("/home/newton/repo/Football-Analysis-using-YOLO/output_videos")
+def box_filters(args):
+    """WHERE clause and params shared by the box endpoints, source/model pick labels or one model's predictions"""
+    source = args.get('source', boxes.SOURCE_LABEL)
+    model = args.get('model', '') if source == boxes.SOURCE_PREDICTION else ''
+    clauses, params = ['b.source = ?', 'b.model = ?'], [source, model]
+    if 'class_id' in args:
+        clauses.append('b.class_id = ?')
+        params.append(args.get('class_id', type=int))
+    for column in ('w', 'h'):
+        for bound, op in (('min', '>='), ('max', '<=')):
+            value = args.get(f'{bound}_{column}', type=float)
+            if value is not None:
+                clauses.append(f'b.{column} {op} ?')
+                params.append(value)
+    if 'collection_id' in args:
+        clauses.append('b.image_id IN (SELECT id FROM images WHERE root_dir_id = ?)')
+        params.append(args.get('collection_id', type=int))
+    return ' AND '.join(clauses), params
+
+@app.route('/boxes/stats')
+def box_stats():
+    where, params = box_filters(request.args)
+    bins = max(1, min(request.args.get('bins', 20, type=int), 200))
+    # upper edge of the histogram range, boxes above it land in the last bin
+    hist_max = request.args.get('hist_max', 1.0, type=float) or 1.0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT b.class_id, COUNT(*) AS boxes, COUNT(DISTINCT b.image_id) AS images
+            FROM boxes AS b WHERE {where}
+            GROUP BY b.class_id
+        ''', params)
+        classes = {row['class_id']: {'boxes': row['boxes'], 'images': row['images']} for row in cursor.fetchall()}
+        histograms = {}
+        for column in ('w', 'h'):
+            cursor.execute(f'''
+                SELECT b.class_id, MIN(CAST(b.{column} * ? AS INTEGER), ? - 1) AS bin, COUNT(*) AS n
+                FROM boxes AS b WHERE {where}
+                GROUP BY b.class_id, bin
+            ''', (bins / hist_max, bins, *params))
+            histograms[column] = {}
+            for row in cursor.fetchall():
+                histograms[column].setdefault(row['class_id'], [0] * bins)[row['bin']] = row['n']
+    return jsonify({'classes': classes, 'bins': bins, 'hist_max': hist_max, 'histograms': histograms})
+
+@app.route('/boxes/images')
+def box_images():
+    where, params = box_filters(request.args)
+    min_count = request.args.get('min_count', 1, type=int)
+    max_count = request.args.get('max_count', type=int)
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    after_id = request.args.get('cursor', 0, type=int)
+    having = 'COUNT(*) >= ?' + (' AND COUNT(*) <= ?' if max_count is not None else '')
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT i.file, c.image_id, c.n
+            FROM (SELECT b.image_id, COUNT(*) AS n
+                  FROM boxes AS b WHERE {where} AND b.image_id > ?
+                  GROUP BY b.image_id HAVING {having}
+                  ORDER BY b.image_id LIMIT ?) AS c
+            JOIN images AS i ON i.id = c.image_id
+            ORDER BY c.image_id
+        ''', (*params, after_id, min_count, *([max_count] if max_count is not None else []), limit))
+        rows = cursor.fetchall()
+    return jsonify({
+        'images': [{'file': row['file'], 'count': row['n']} for row in rows],
+        'next_cursor': rows[-1]['image_id'] if len(rows) == limit else None,
+    })
+
+@app.route('/loss_overview')
+def get_loss_overview():
+    """Loss and detection quality of every model plus the histogram, classes and time series of ?model.
+
+    Everything is read from the aggregates loss_overview keeps, never from
+    model_predictions. ?collection_id and ?class_id narrow the summaries and
+    the histogram, ?resolution is minute, hour or day and ?since an epoch second.
+    """
+    collection_id = request.args.get('collection_id', type=int)
+    class_id = request.args.get('class_id', loss_overview.ALL_CLASSES, type=int)
+    resolution = request.args.get('resolution', 'hour')
+    if resolution not in loss_overview.RESOLUTIONS:
+        return f"Unsupported resolution, expected one of {list(loss_overview.RESOLUTIONS)}", 400
+    with get_db_connection() as conn:
+        model = request.args.get('model') or latest_model(conn.cursor())
+        models = loss_overview.summaries(conn, class_id, collection_id)
+        response = jsonify({
+            'model': model,
+            'bucket_width': loss_overview.BUCKET_WIDTH,
+            'models': models,
+            'histogram': loss_overview.histogram(conn, model, class_id, collection_id) if model else [],
+            'classes': loss_overview.summaries(conn, loss_overview.ALL_CLASSES, collection_id, [model], group_by_class=True) if model else [],
+            'series': loss_overview.series(conn, model, resolution, request.args.get('since', type=int)) if model else [],
+        })
+    response.headers['Cache-Control'] = 'no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route('/model_diff')
+def get_model_diff():
+    """Per image differences of ?new against ?base, ranked by ?sort, biggest regression first by default.
+
+    Only reads the model_diffs table. A pair is computed by
+    `python model_diff.py base new` and kept up to date by prediction jobs.
+    """
+    base, new = request.args.get('base'), request.args.get('new')
+    if not base or not new:
+        return "base and new models are required", 400
+    sort = request.args.get('sort', 'loss_delta')
+    if sort not in model_diff.SORTS:
+        return f"Unsupported sort, expected one of {model_diff.SORTS}", 400
+    descending = request.args.get('order', 'desc') != 'asc'
+    collection_id = request.args.get('collection_id', type=int)
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    try:
+        after = json.loads(base64.urlsafe_b64decode(request.args['cursor'])) if request.args.get('cursor') else None
+        if after is not None and not is_keyset(after):
+            raise ValueError(after)
+    except (ValueError, TypeError):
+        return "invalid cursor", 400
+    with get_db_connection() as conn:
+        if not model_diff.is_registered(conn, base, new):
+            return f"no diff of {new} against {base}, compute it with: python model_diff.py {base} {new}", 404
+        rows = model_diff.diff_page(conn, base, new, sort, descending, collection_id, after, limit)
+        summary = model_diff.diff_summary(conn, base, new, collection_id) if after is None else None
+    return jsonify({
+        'base': base,
+        'new': new,
+        'sort': sort,
+        'summary': summary,
+        'images': rows,
+        'next_cursor': encode_cursor([rows[-1][sort], rows[-1]['image_id']]) if len(rows) == limit else None,
+    })
+
+@app.route('/search')
+def search_images():
+    """Images matching the filters in search.search_filters, streamed as they are read"""
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    after_id = request.args.get('cursor', 0, type=int)
+    args = request.args.copy()
+
+    def generate():
+        yield '{"images": ['
+        last_id, count = None, 0
+        with get_db_connection() as conn:
+            for row in search.search_images(conn, args, after_id, limit):
+                yield (', ' if count else '') + json.dumps({'file': row['file'], 'image_id': row['id']})
+                last_id, count = row['id'], count + 1
+        yield '], "next_cursor": %s}' % json.dumps(last_id if count == limit else None)
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 @app.route('/video')
 def video():
@@ -201,24 +688,43 @@ def video():
 
 @app.route('/video/<path:filename>')
 def stream_video(filename):
-    video_path = os.path.join(VIDEO_PATH, filename)
-    if not os.path.exists(video_path):
+    video_path = videos.catalogue.path_for(filename)
+    if video_path is None or not video_path.exists():
         abort(404, description="Video file does not exist")
-    return send_file(video_path, mimetype='video/mp4')
+    # conditional responses answer Range requests with 206 partial content, so seeking only fetches what is played
+    return send_file(video_path, mimetype=videos.MIMETYPES[video_path.suffix.lower()], conditional=True, max_age=3600)
 
 @app.route('/videos')
 def list_videos():
-    # List all video files in the VIDEO_DIR
-    videos = []
-    for filename in os.listdir(VIDEO_PATH):
-        if filename.endswith(('.mp4', '.webm', '.ogg')):  # Add supported video formats
-            videos.append({
-                'title': os.path.splitext(filename)[0],
-                'filename': str(Path(filename).name),
-                'thumbnailpath': f'/thumbnails/{os.path.splitext(filename)[0]}.jpg'  # assuming thumbnails are named similarly
-            })
-    return jsonify({"videos": videos})
+    catalogue = videos.catalogue
+    return jsonify({"videos": [dict(video, sprite=catalogue.sprite_layout(video['filename'])) for video in catalogue.videos()]})
+
+@app.route('/video_poster/<path:filename>')
+def get_video_poster(filename):
+    try:
+        poster = videos.catalogue.image(filename, 'poster', timeout=30)
+    except FileNotFoundError:
+        return "Video not found", 404
+    if poster is None:
+        return "Poster not available", 404
+    return send_file(poster, mimetype='image/jpeg', max_age=86400)
+
+@app.route('/video_sprite/<path:filename>')
+def get_video_sprite(filename):
+    try:
+        sprite = videos.catalogue.image(filename, 'sprite', timeout=0)
+    except FileNotFoundError:
+        return "Video not found", 404
+    if sprite is None:
+        if videos.catalogue.building(filename, 'sprite'):
+            return "Sprite is being built", 202
+        return "Sprite not available", 404
+    return send_file(sprite, mimetype='image/jpeg', max_age=86400)
 
 if __name__ == '__main__':
+    init_db()
+    # the reloader runs the app in a child process, only that one needs the inference worker
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        predictor.start()
     app.run(debug=True, port=8000)
 
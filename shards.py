@@ -0,0 +1,155 @@
+import io
+import os
+import sys
+import json
+import mmap
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from PIL import Image
+import boxes
+
+FORMAT_VERSION: int = 1
+SHARD_BYTES: int = 1024**3
+BOX_FIELDS: Tuple[str, ...] = ('class', 'x', 'y', 'w', 'h')
+# one index row per sample, image bytes and boxes are both inside the shard data file
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('size', '<u4'), ('boxes_offset', '<u8'), ('boxes', '<u4')])
+ALIGN: int = 4
+
+Sample = Tuple[str, memoryview, np.ndarray]
+
+def boxes_array(labels: Sequence[Dict[str, Any]]) -> np.ndarray:
+    """(N, 5) float32 array of class, x, y, w, h from label dicts"""
+    rows = [(label['class'], *boxes.box_coordinates(label)[:4]) for label in labels]
+    return np.array(rows, dtype='<f4').reshape(-1, len(BOX_FIELDS))
+
+class ShardWriter:
+    """Packs encoded images and their boxes into large shard files.
+
+    Each shard is one data file holding, per sample, the encoded image
+    followed by its boxes as a 4-byte aligned float32 (N, 5) array, plus an
+    index with the offsets and a names file. A new shard starts once the
+    current one passes `shard_bytes`. `close` writes index.json, which lists
+    the shards in order.
+    """
+
+    def __init__(self, output_dir: Union[str, Path], prefix: str = 'shard', shard_bytes: int = SHARD_BYTES,
+                 metadata: Optional[Dict[str, Any]] = None) -> None:
+        self.output_dir: Path = Path(output_dir)
+        self.prefix: str = prefix
+        self.shard_bytes: int = shard_bytes
+        self.metadata: Dict[str, Any] = metadata or {}
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self._shards: List[Dict[str, Any]] = []
+        self._data = None
+        self._index: List[Tuple[int, int, int, int]] = []
+        self._names: List[str] = []
+        self._offset: int = 0
+
+    def _open(self) -> None:
+        name = f"{self.prefix}-{len(self._shards):05d}"
+        self._shards.append({'data': f"{name}.bin", 'index': f"{name}.idx.npy", 'names': f"{name}.names", 'count': 0})
+        self._data = open(self.output_dir / f"{name}.bin", 'wb')
+        self._index, self._names, self._offset = [], [], 0
+
+    def _flush(self) -> None:
+        if self._data is None:
+            return
+        self._data.close()
+        shard = self._shards[-1]
+        np.save(self.output_dir / shard['index'], np.array(self._index, dtype=INDEX_DTYPE))
+        (self.output_dir / shard['names']).write_text("\n".join(self._names))
+        shard['count'] = len(self._index)
+        self._data = None
+
+    def add(self, name: str, image: bytes, box_array: np.ndarray) -> None:
+        if self._data is None or self._offset >= self.shard_bytes:
+            self._flush()
+            self._open()
+        box_array = np.ascontiguousarray(box_array, dtype='<f4').reshape(-1, len(BOX_FIELDS))
+        offset = self._offset
+        padding = -(offset + len(image)) % ALIGN
+        self._data.write(image)
+        self._data.write(b'\0' * padding)
+        boxes_offset = offset + len(image) + padding
+        self._data.write(box_array.tobytes())
+        self._offset = boxes_offset + box_array.nbytes
+        self._index.append((offset, len(image), boxes_offset, len(box_array)))
+        self._names.append(name)
+
+    def close(self) -> Path:
+        self._flush()
+        manifest = {'version': FORMAT_VERSION, 'box_fields': list(BOX_FIELDS), 'shards': self._shards, **self.metadata}
+        path = self.output_dir / 'index.json'
+        path.write_text(json.dumps(manifest, indent=1))
+        return path
+
+    def __enter__(self) -> "ShardWriter":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+class ShardReader:
+    """Random access over a shard set through mmap, no file is opened per sample.
+
+    `reader[i]` returns (name, image bytes as a memoryview into the mapping,
+    boxes as a read-only (N, 5) float32 view). Iteration reads the shards
+    sequentially, which is the fastest order for a data loader.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        path = Path(path)
+        self.manifest_path: Path = path / 'index.json' if path.is_dir() else path
+        self.manifest: Dict[str, Any] = json.loads(self.manifest_path.read_text())
+        if self.manifest.get('version') != FORMAT_VERSION:
+            raise ValueError(f"unsupported shard format version {self.manifest.get('version')}")
+        root = self.manifest_path.parent
+        self._maps: List[Optional[mmap.mmap]] = []
+        self._indexes: List[np.ndarray] = []
+        self._names: List[List[str]] = []
+        for shard in self.manifest['shards']:
+            with open(root / shard['data'], 'rb') as f:
+                # an empty file cannot be mapped
+                self._maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else None)
+            self._indexes.append(np.load(root / shard['index'], mmap_mode='r'))
+            names = (root / shard['names']).read_text()
+            self._names.append(names.split("\n") if names else [])
+        self._starts: np.ndarray = np.cumsum([0] + [len(index) for index in self._indexes])
+
+    def __len__(self) -> int:
+        return int(self._starts[-1])
+
+    def locate(self, i: int) -> Tuple[int, int]:
+        """(shard, row) of global sample i"""
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        shard = int(np.searchsorted(self._starts, i, side='right')) - 1
+        return shard, i - int(self._starts[shard])
+
+    def __getitem__(self, i: int) -> Sample:
+        shard, row = self.locate(i)
+        offset, size, boxes_offset, count = self._indexes[shard][row]
+        data = memoryview(self._maps[shard])
+        box_array = np.frombuffer(data, dtype='<f4', count=int(count) * len(BOX_FIELDS),
+                                  offset=int(boxes_offset)).reshape(-1, len(BOX_FIELDS))
+        return self._names[shard][row], data[int(offset):int(offset) + int(size)], box_array
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def image(self, i: int) -> Image.Image:
+        """Decoded PIL image of sample i"""
+        return Image.open(io.BytesIO(self[i][1]))
+
+    def close(self) -> None:
+        for m in self._maps:
+            if m is not None:
+                m.close()
+
+if __name__ == "__main__":
+    reader = ShardReader(sys.argv[1])
+    print(f"{len(reader)} samples in {len(reader.manifest['shards'])} shards")
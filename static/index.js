@@ -1,7 +1,11 @@
 let currentCollectionIndex = 0;
 
 let collections = [];
-let images = [];
+// the listing of the open collection as parallel columns, filled while it streams in
+let files = [];
+let losses = [];
+let listingDone = true;
+let listingAbort = null;
 let displayedImages = 50;
 const container = document.getElementById('container');
 const collectionGrid = document.getElementById('collection-grid');
@@ -20,7 +24,7 @@ async function loadCollections() {
 function createCollectionGrid() {
     collectionGrid.innerHTML = collections.map((collection, index) => `
         <div onclick="handleCollectionClick(${index})" class="collection-item">
-            <img src="/image/${collection.cover_image}" alt="${collection.name}">
+            <img src="/thumb/256/${collection.cover_image}" alt="${collection.name}">
             <p>${collection.name}</p>
         </div>
     `).join('');
@@ -32,32 +36,86 @@ async function handleCollectionClick(collectionIndex) {
     await loadCollectionImages(collectionIndex);
 }
 
-// Load images for a specific collection
+// Stream a collection's listing in the binary format of /images and call onBlock(files, losses) per block.
+// A block is a uint32 row count and uint32 name byte length, float32 losses (NaN when unscored) and
+// newline separated file names. A block without rows ends the listing.
+async function streamImages(collectionId, signal, onBlock) {
+    const res = await fetch(`/images/${collectionId}?format=binary`, { signal });
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = new Uint8Array(0);
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) return;
+        const joined = new Uint8Array(buffer.length + value.length);
+        joined.set(buffer);
+        joined.set(value, buffer.length);
+        buffer = joined;
+        let offset = 0;
+        while (buffer.length - offset >= 8) {
+            const view = new DataView(buffer.buffer, buffer.byteOffset + offset);
+            const count = view.getUint32(0, true);
+            const nameBytes = view.getUint32(4, true);
+            const size = 8 + 4 * count + nameBytes;
+            if (buffer.length - offset < size) break;
+            if (count === 0) return;
+            const blockLosses = new Float32Array(count);
+            for (let i = 0; i < count; i++) blockLosses[i] = view.getFloat32(8 + 4 * i, true);
+            const names = decoder.decode(buffer.subarray(offset + 8 + 4 * count, offset + size)).split('\n');
+            onBlock(names, blockLosses);
+            offset += size;
+        }
+        buffer = buffer.slice(offset);
+    }
+}
+
+// Load images for a specific collection, the first thumbnails show while the rest of the listing streams in
 async function loadCollectionImages(collectionIndex) {
-    const collectionId = collections[collectionIndex].id;
-    const res = await fetch(`/images/${collectionId}`);
-    images = await res.json();
+    if (listingAbort) listingAbort.abort();
+    listingAbort = new AbortController();
+    const signal = listingAbort.signal;
+    files = [];
+    losses = [];
+    listingDone = false;
     displayedImages = 50; // Reset the number of displayed images
     createThumbnailGrid();
     setupSeeMoreButton();
+    try {
+        await streamImages(collections[collectionIndex].id, signal, (names, blockLosses) => {
+            const wasShort = files.length < displayedImages;
+            files.push(...names);
+            losses.push(...blockLosses);
+            if (wasShort) createThumbnailGrid();
+            setupSeeMoreButton();
+        });
+    } catch (e) {
+        if (e.name === 'AbortError') return;
+        throw e;
+    }
+    listingDone = true;
+    setupSeeMoreButton();
 }
 
 // Create the thumbnail grid for images
 function createThumbnailGrid() {
-    const imagesToDisplay = images.slice(0, displayedImages);
-    thumbnailGrid.innerHTML = imagesToDisplay.map((img, index) => `
+    const count = Math.min(files.length, displayedImages);
+    let html = '';
+    for (let index = 0; index < count; index++) {
+        const loss = losses[index];
+        html += `
         <div class="thumbnail-item">
-            <img src="/image/${img.file}" 
+            <img src="/thumb/256/${files[index]}" 
                  onclick="navigateToSingleView(${index})"
                  class="${index === currentCollectionIndex ? 'active' : ''}">
-            <div class="loss-value">${img.loss}</div>
-        </div>
-    `).join('');
+            <div class="loss-value">${Number.isNaN(loss) ? '' : loss.toFixed(4)}</div>
+        </div>`;
+    }
+    thumbnailGrid.innerHTML = html;
 }
 
 // Setup the "See More" button functionality
 function setupSeeMoreButton() {
-    if (displayedImages < images.length) {
+    if (displayedImages < files.length || !listingDone) {
         seeMoreButton.style.display = 'block';
         seeMoreButton.onclick = () => {
             displayedImages += 50;
@@ -71,7 +129,7 @@ function setupSeeMoreButton() {
 
 // Navigate to the single view for an image
 function navigateToSingleView(index) {
-    const imageName = images[index].file;
+    const imageName = files[index];
     window.location.href = `inspect/${imageName}`;
 }
 
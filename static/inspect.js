@@ -49,6 +49,8 @@ const initialState = {
     imageId: null,
     labels: [],
     predictions: [],
+    bundleLabels: null,
+    cachedPredictions: null,
     changeBuffer: [],
     currentStateIndex: -1,
     isLabeledShown: false,
@@ -110,16 +112,22 @@ const setImageAndCanvasSize = (img, canvas, container, width, height) => {
 };
 
 // Update Labels on the Server
+// Sends the revision the labels were loaded at, the server refuses the write if someone changed them since
 const updateLabels = async (image, labels) => {
-    const data = { filename: image, labels };
+    const data = { filename: image, labels, revision: state.revision };
     try {
         const response = await fetch('/update_labels', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify(data)
         });
+        if (response.status === 409) {
+            alert("These labels were changed by someone else, reload the page to see their version");
+            return;
+        }
         if (!response.ok) throw new Error("Failed to update labels");
         const responseData = await response.json();
+        setState({ ...state, revision: responseData.revision });
         console.log(responseData.message);
     } catch (error) {
         console.error("Error updating labels:", error);
@@ -226,7 +234,7 @@ const handleToggleLabelButtonClick = async () => {
     if (newState.isLabeledShown) {
         try {
             if (!newState.isFetchedLabels) {
-                const fetchedLabels = await fetchLabels(newState.image);
+                const fetchedLabels = newState.bundleLabels ?? await fetchLabels(newState.image);
                 newState.labels = [...state.labels, ...fetchedLabels];
                 newState.isFetchedLabels = true;
             }
@@ -245,7 +253,7 @@ const handleTogglePredictionButtonClick = async () => {
     var newState = { ...state, isPredictionShown: !state.isPredictionShown };
     if (!state.isPredictDone) {
         try {
-            const predictions = await fetchPredictions(state.image);
+            const predictions = state.cachedPredictions ?? await fetchPredictions(state.image);
             newState = {
                 ...newState,
                 predictions: predictions,
@@ -361,7 +369,7 @@ const openThumbnailFloatingWindow = async () => {
         images.forEach(img => {
             const thumbnailWrapper = createElement('div', { style: 'position: relative;' });
             const thumbnail = createElement('img', {
-                src: `/image/${img.file}`,
+                src: `/thumb/128/${img.file}`,
                 alt: img.file,
                 style: 'width: 100px; height: 100px; object-fit: cover; cursor: pointer;',
                 onclick: () => window.location.href = `/inspect/${img.file}`
@@ -377,7 +385,7 @@ const openThumbnailFloatingWindow = async () => {
                       border-radius: 3px;
                       font-size: 12px;
                   `
-            }, `Loss: ${img.loss.toFixed(2)}`);
+            }, `Loss: ${img.loss === null ? '-' : img.loss.toFixed(2)}`);
 
             if (state.imageHasLabels[img.file]) {
                 const labelOverlay = createElement('div', {
@@ -412,6 +420,12 @@ const openThumbnailFloatingWindow = async () => {
 };
 
 // Fetch Functions
+const fetchInspectData = async (image) => {
+    const res = await fetch(`/inspect_data/${image}`);
+    if (!res.ok) throw new Error("Failed to fetch inspect data");
+    return await res.json();
+};
+
 const fetchLabels = async (image) => {
     const res = await fetch(`/labels/${image}`);
     if (!res.ok) throw new Error("Failed to fetch labels");
@@ -424,42 +438,22 @@ const fetchPredictions = async (image) => {
     return await res.json();
 };
 
-const fetchImageId = async (image) => {
-    const res = await fetch(`/image_id/${image}`);
-    if (!res.ok) throw new Error("Failed to fetch image ID");
-    const id = await res.json();
-    return Number(id);
-};
-
-const fetchClasses = async (image) => {
-    const res = await fetch(`/label_classes/${image}`);
-    if (!res.ok) throw new Error("Failed to fetch label classes");
-    return await res.json();
-};
-
 const fetchImages = async (image) => {
     const root_dir_id_res = await fetch(`/root_dir_id/${image}`);
     if (!root_dir_id_res.ok) throw new Error("Failed to fetch root_dir_id");
     const root_dir_id = await root_dir_id_res.json()
-    const res = await fetch(`/images/${Number(root_dir_id)}`);
-    if (!res.ok) throw new Error("Failed to fetch images");
-    return await res.json();
-};
-
-const fetchLabelStatus = async (images) => {
-    const statusPromises = images.map(async (img) => {
-        try {
-            const labels = await fetchLabels(img);
-            return { img, hasLabels: labels.length > 0 };
-        } catch {
-            return { img, hasLabels: false };
-        }
-    });
-    const statuses = await Promise.all(statusPromises);
-    return statuses.reduce((acc, { img, hasLabels }) => {
-        acc[img] = hasLabels;
-        return acc;
-    }, {});
+    let images = [];
+    let cursor = null;
+    do {
+        const params = new URLSearchParams({ limit: 1000 });
+        if (cursor) params.set('cursor', cursor);
+        const res = await fetch(`/images/${Number(root_dir_id)}?${params}`);
+        if (!res.ok) throw new Error("Failed to fetch images");
+        const page = await res.json();
+        images = images.concat(page.images);
+        cursor = page.next_cursor;
+    } while (cursor);
+    return images;
 };
 
 const sortImages = (images) => {
@@ -793,7 +787,7 @@ const renderThumbnails = (container, elements) => {
     const thumbnails = images.slice(currentImageIndex, endIndex).map(img => {
         const thumbnailWrapper = createElement('div', { style: 'position: relative; display: inline-block;' });
         const thumbnail = createElement('img', {
-            src: `/image/${img.file}`,
+            src: `/thumb/128/${img.file}`,
             style: 'height: 90%; cursor: pointer; margin: 0 5px;',
             border: img.file === image ? '2px solid red' : '',
             title: 'Click to inspect',
@@ -832,11 +826,16 @@ const initializeApp = async () => {
         const image = state.image; // Set this appropriately
         elements.img.src = `/image/${image}`;
 
-        const [imageId, classes] = await Promise.all([
-            fetchImageId(image),
-            fetchClasses(image)
-        ]);
-        setState({ ...state, imageId });
+        const data = await fetchInspectData(image);
+        const classes = data.classes;
+        const cached = data.predictions[data.model];
+        setState({
+            ...state,
+            imageId: data.image_id,
+            revision: data.revision || 0,
+            bundleLabels: data.labels,
+            cachedPredictions: cached ? cached.boxes : null
+        });
 
         const { classColors, classNames } = configureClasses(classes);
         setState({ ...state, classColors, classNames });
@@ -855,12 +854,10 @@ const initializeApp = async () => {
             setImageAndCanvasSize(elements.img, elements.canvas, elements.container, dim.width, dim.height)();
         });
 
-        let images = await fetchImages(image);
-
-        // images = sortImages(images);
-        const imageNames = images.map(img => img.file);
-        const imageHasLabels = await fetchLabelStatus(imageNames);
-        setState({ ...state, images, imageHasLabels, currentImageIndex: imageNames.indexOf(image) });
+        // the current image with its neighbours in collection order
+        const images = [...data.prev, { file: image, loss: data.loss, has_labels: data.labels.length > 0 }, ...data.next];
+        const imageHasLabels = Object.fromEntries(images.map(img => [img.file, img.has_labels]));
+        setState({ ...state, images, imageHasLabels, currentImageIndex: data.prev.length });
 
         createThumbnailBar(images, elements);
         updateButtonStyles(state, elements);
@@ -0,0 +1,54 @@
+import sys
+import sqlite3
+from pathlib import Path
+import pytest
+
+# the modules live in the repository root, as the scripts in scritps/ expect
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent.parent / 'scritps'))
+import boxes
+import loss_overview
+
+@pytest.fixture
+def conn(tmp_path):
+    """An empty images.db with the tables of scritps/db.py and scritps/model_predictions.py"""
+    conn = sqlite3.connect(tmp_path / 'images.db')
+    conn.executescript('''
+        CREATE TABLE root_dirs (id INTEGER PRIMARY KEY AUTOINCREMENT, root_dir TEXT NOT NULL, label_classes TEXT);
+        CREATE TABLE images (id INTEGER PRIMARY KEY AUTOINCREMENT, root_dir_id INTEGER, file TEXT NOT NULL,
+                             revisions INTEGER DEFAULT 0, UNIQUE(file));
+        CREATE TABLE labels (id INTEGER PRIMARY KEY AUTOINCREMENT, image_id INTEGER NOT NULL, labels_json JSON);
+        CREATE TABLE model_predictions (id INTEGER PRIMARY KEY AUTOINCREMENT, model TEXT NOT NULL, file TEXT NOT NULL,
+                                        base_path TEXT NOT NULL, predictions JSON, loss REAL, timestamp DATETIME,
+                                        UNIQUE(model, file));
+    ''')
+    boxes.create_boxes_table(conn)
+    loss_overview.create_loss_overview(conn)
+    yield conn
+    conn.close()
+
+@pytest.fixture
+def server_db(tmp_path, monkeypatch):
+    """images.db made by scritps/db.py with collections a and b of three images each, served by server.app"""
+    import database
+    import db
+    import server
+    for collection in ('a', 'b'):
+        (tmp_path / 'images' / collection).mkdir(parents=True)
+        for i in range(3):
+            (tmp_path / 'images' / collection / f'{collection}{i}.jpg').write_bytes(b'jpeg')
+    db_path = tmp_path / 'images.db'
+    db.create_db(db_path)
+    db.populate_db_with_images(tmp_path / 'images', db_path, workers=1)
+    pool = database.ConnectionPool(db_path)
+    monkeypatch.setattr(database, 'pool', pool)
+    with pool.connection() as conn:
+        conn.execute("UPDATE root_dirs SET label_classes = 'car person'")
+    server.init_db()
+    yield db_path
+    pool.close_all()
+
+@pytest.fixture
+def client(server_db):
+    import server
+    return server.app.test_client()
@@ -0,0 +1,45 @@
+import json
+import boxes
+import label_ops
+
+A = {'class': 0, 'coordinates': [0.2, 0.2, 0.1, 0.1]}
+B = {'class': 1, 'coordinates': [0.7, 0.7, 0.2, 0.2]}
+
+def stored_boxes(conn, source=boxes.SOURCE_LABEL, model=''):
+    return conn.execute('SELECT image_id, class_id, x, y, w, h FROM boxes WHERE source = ? AND model = ? ORDER BY image_id, class_id',
+                        (source, model)).fetchall()
+
+def test_a_new_table_is_filled_from_existing_data(conn):
+    conn.execute("INSERT INTO root_dirs (id, root_dir, label_classes) VALUES (1, '/data', 'car person')")
+    conn.executemany('INSERT INTO images (root_dir_id, file) VALUES (1, ?)', [('a.jpg',), ('b.jpg',)])
+    conn.execute('INSERT INTO labels (image_id, labels_json) VALUES (1, ?)', (json.dumps([A, B]),))
+    conn.execute("INSERT INTO model_predictions (model, file, base_path, predictions) VALUES ('m', 'b.jpg', '/data', ?)",
+                 (json.dumps([{'class': 'person', 'conf': 0.9, 'bbox': [0.5, 0.5, 0.1, 0.1]}]),))
+    # a db from before the boxes table
+    conn.execute('DROP TABLE boxes')
+    boxes.create_boxes_table(conn)
+    assert stored_boxes(conn) == [(1, 0, 0.2, 0.2, 0.1, 0.1), (1, 1, 0.7, 0.7, 0.2, 0.2)]
+    assert stored_boxes(conn, boxes.SOURCE_PREDICTION, 'm') == [(2, 1, 0.5, 0.5, 0.1, 0.1)]
+    # an existing table is left alone
+    conn.execute('DELETE FROM boxes')
+    boxes.create_boxes_table(conn)
+    assert stored_boxes(conn) == []
+    boxes.rebuild_boxes(conn)
+    assert len(stored_boxes(conn)) == 2
+
+def test_label_writes_replace_the_label_boxes(conn):
+    conn.execute("INSERT INTO root_dirs (id, root_dir, label_classes) VALUES (1, '/data', 'car person')")
+    image_id = conn.execute("INSERT INTO images (root_dir_id, file) VALUES (1, 'a.jpg')").lastrowid
+    conn.execute("INSERT INTO model_predictions (model, file, base_path, predictions) VALUES ('m', 'a.jpg', '/data', ?)",
+                 (json.dumps([{'class': 'car', 'conf': 0.9, 'bbox': A['coordinates']}]),))
+    boxes.rebuild_boxes(conn)
+    label_ops.write_labels(conn, image_id, [A, B])
+    assert stored_boxes(conn) == [(image_id, 0, 0.2, 0.2, 0.1, 0.1), (image_id, 1, 0.7, 0.7, 0.2, 0.2)]
+    label_ops.write_labels(conn, image_id, [B])
+    assert stored_boxes(conn) == [(image_id, 1, 0.7, 0.7, 0.2, 0.2)]
+    label_ops.BulkEditor(conn).apply([{'op': 'remap', 'collection_id': 1, 'classes': {'1': 0}}])
+    assert stored_boxes(conn) == [(image_id, 0, 0.7, 0.7, 0.2, 0.2)]
+    label_ops.write_labels(conn, image_id, [])
+    assert stored_boxes(conn) == []
+    # the prediction boxes are not touched by label writes
+    assert stored_boxes(conn, boxes.SOURCE_PREDICTION, 'm') == [(image_id, 0, 0.2, 0.2, 0.1, 0.1)]
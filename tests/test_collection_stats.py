@@ -0,0 +1,68 @@
+import json
+import collection_stats
+import label_ops
+
+A = {'class': 0, 'coordinates': [0.2, 0.2, 0.1, 0.1]}
+B = {'class': 1, 'coordinates': [0.7, 0.7, 0.2, 0.2]}
+
+def snapshot(conn):
+    """The stats rows that count, a rebuild does not keep rows that went back to zero"""
+    return (conn.execute('SELECT * FROM collection_stats WHERE image_count > 0 ORDER BY 1').fetchall(),
+            conn.execute('SELECT root_dir_id, model, scored_count, ROUND(loss_sum, 9), max_loss FROM collection_model_stats WHERE scored_count > 0 ORDER BY 1, 2').fetchall(),
+            conn.execute('SELECT * FROM collection_class_stats WHERE box_count > 0 ORDER BY 1, 2').fetchall())
+
+def assert_in_sync(conn):
+    incremental = snapshot(conn)
+    collection_stats.rebuild_collection_stats(conn)
+    assert incremental == snapshot(conn)
+    return incremental
+
+def predict(conn, model, file, loss):
+    conn.execute("INSERT INTO model_predictions (model, file, base_path, predictions, loss) VALUES (?, ?, '/data', '[]', ?)", (model, file, loss))
+
+def test_triggers_follow_inserts_updates_and_deletes(conn):
+    conn.executemany("INSERT INTO root_dirs (id, root_dir, label_classes) VALUES (?, ?, 'car person')", [(1, '/a'), (2, '/b')])
+    collection_stats.create_collection_stats(conn)
+    ids = [conn.execute('INSERT INTO images (root_dir_id, file) VALUES (?, ?)', (1 + i % 2, f'{i}.jpg')).lastrowid for i in range(6)]
+    for image_id, labels in zip(ids, ([A], [A, B], [], [B], None, [A, A])):
+        if labels is not None:
+            label_ops.write_labels(conn, image_id, labels)
+    for i, loss in enumerate((0.5, 0.9, None, 0.2, 0.7)):
+        predict(conn, 'm', f'{i}.jpg', loss)
+    predict(conn, 'n', '0.jpg', 0.1)
+    stats, models, classes = assert_in_sync(conn)
+    assert stats == [(1, 3, 1, ids[0]), (2, 3, 3, ids[1])]
+    assert models == [(1, 'm', 2, 1.2, 0.7), (1, 'n', 1, 0.1, 0.1), (2, 'm', 2, 1.1, 0.9)]
+    assert classes == [(1, 0, 1), (2, 0, 3), (2, 1, 2)]
+
+    # updates: relabel, clear labels, change and drop losses, move a prediction to another model
+    label_ops.write_labels(conn, ids[2], [B, B])
+    label_ops.write_labels(conn, ids[1], [])
+    conn.execute("UPDATE labels SET labels_json = '{}' WHERE image_id = ?", (ids[3],))
+    conn.execute("UPDATE model_predictions SET loss = 0.05 WHERE model = 'm' AND file = '1.jpg'")
+    conn.execute("UPDATE model_predictions SET loss = 0.3 WHERE model = 'm' AND file = '2.jpg'")
+    conn.execute("UPDATE model_predictions SET loss = NULL WHERE model = 'm' AND file = '4.jpg'")
+    conn.execute("UPDATE model_predictions SET model = 'k' WHERE model = 'm' AND file = '0.jpg'")
+    assert_in_sync(conn)
+
+    # deletes: the cover image with its rows, a max loss, labels and a whole model
+    conn.execute('DELETE FROM boxes WHERE image_id = ?', (ids[0],))
+    conn.execute('DELETE FROM labels WHERE image_id = ?', (ids[0],))
+    conn.execute("DELETE FROM model_predictions WHERE file = '0.jpg'")
+    conn.execute('DELETE FROM images WHERE id = ?', (ids[0],))
+    conn.execute("DELETE FROM model_predictions WHERE model = 'm' AND file = '3.jpg'")
+    conn.execute('DELETE FROM labels WHERE image_id = ?', (ids[5],))
+    conn.execute("DELETE FROM boxes WHERE image_id = ?", (ids[5],))
+    conn.execute("DELETE FROM model_predictions WHERE model = 'n'")
+    stats, models, classes = assert_in_sync(conn)
+    assert stats == [(1, 2, 1, ids[2]), (2, 3, 0, ids[1])]
+    assert [row[:2] for row in models] == [(1, 'm'), (2, 'm')]
+
+def test_summaries_skip_empty_collections(conn):
+    conn.execute("INSERT INTO root_dirs (id, root_dir, label_classes) VALUES (1, '/a', 'car'), (2, '/empty', 'car')")
+    image_id = conn.execute("INSERT INTO images (root_dir_id, file) VALUES (1, 'a.jpg')").lastrowid
+    conn.execute('INSERT INTO labels (image_id, labels_json) VALUES (?, ?)', (image_id, json.dumps([A])))
+    # a db from before the stats tables is filled on creation
+    collection_stats.create_collection_stats(conn)
+    summary, = collection_stats.collection_summaries(conn)
+    assert (summary['id'], summary['cover_image'], summary['image_count'], summary['labeled_count']) == (1, 'a.jpg', 1, 1)
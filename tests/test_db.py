@@ -0,0 +1,70 @@
+import json
+import database
+import label_ops
+import db
+
+def write_label(path, *lines):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("".join(line + "\n" for line in lines))
+
+def labels_of(db_path):
+    conn = database.connect(db_path)
+    rows = conn.execute('SELECT i.file, l.labels_json FROM images AS i JOIN labels AS l ON l.image_id = i.id ORDER BY i.file').fetchall()
+    conn.close()
+    return {file: json.loads(labels_json) if labels_json else None for file, labels_json in rows}
+
+def ingest(tmp_path, images=('a.jpg', 'b.jpg')):
+    db_path = tmp_path / 'images.db'
+    db.create_db(db_path)
+    for name in images:
+        (tmp_path / 'images' / 'x').mkdir(parents=True, exist_ok=True)
+        (tmp_path / 'images' / 'x' / name).write_bytes(b'jpeg')
+    db.populate_db_with_images(tmp_path / 'images', db_path, workers=2)
+    return db_path
+
+def test_label_ingest_without_predictions(tmp_path):
+    db_path = ingest(tmp_path)
+    write_label(tmp_path / 'labels' / 'a.txt', '0 0.5 0.5 0.1 0.2')
+    db.update_db_with_labels(tmp_path / 'labels', db_path, workers=1)
+    assert labels_of(db_path) == {'a.jpg': [{'class': 0, 'coordinates': [0.5, 0.5, 0.1, 0.2]}], 'b.jpg': None}
+    # label edits work before the first prediction run too
+    conn = database.connect(db_path)
+    image_id = conn.execute("SELECT id FROM images WHERE file = 'b.jpg'").fetchone()[0]
+    assert label_ops.write_labels(conn, image_id, [{'class': 1, 'coordinates': [0.1, 0.1, 0.1, 0.1]}], 0) == 1
+    conn.commit()
+    assert conn.execute('SELECT COUNT(*) FROM boxes WHERE image_id = ?', (image_id,)).fetchone()[0] == 1
+    conn.close()
+
+def test_label_ingest_follows_changed_files(tmp_path):
+    db_path = ingest(tmp_path)
+    label_a = tmp_path / 'labels' / 'a.txt'
+    write_label(label_a, '0 0.5 0.5 0.1 0.2')
+    write_label(tmp_path / 'labels' / 'b.txt', '1 0.1 0.1 0.1 0.1')
+    db.update_db_with_labels(tmp_path / 'labels', db_path, workers=1)
+    first = labels_of(db_path)
+
+    # unchanged files are not read again, so a label edited in the UI stays
+    conn = database.connect(db_path)
+    b_id = conn.execute("SELECT id FROM images WHERE file = 'b.jpg'").fetchone()[0]
+    label_ops.write_labels(conn, b_id, [])
+    conn.commit()
+    db.update_db_with_labels(tmp_path / 'labels', db_path, workers=1)
+    assert labels_of(db_path) == {**first, 'b.jpg': []}
+
+    # a changed file replaces labels that still hold its previous contents, not edited ones
+    write_label(label_a, '0 0.5 0.5 0.1 0.2', '1 0.3 0.3 0.1 0.1')
+    write_label(tmp_path / 'labels' / 'b.txt', '0 0.9 0.9 0.1 0.1')
+    db.update_db_with_labels(tmp_path / 'labels', db_path, workers=1)
+    labels = labels_of(db_path)
+    assert labels['a.jpg'] == first['a.jpg'] + [{'class': 1, 'coordinates': [0.3, 0.3, 0.1, 0.1]}]
+    assert labels['b.jpg'] == []
+    a_id = conn.execute("SELECT id FROM images WHERE file = 'a.jpg'").fetchone()[0]
+    assert conn.execute('SELECT revisions FROM images WHERE id = ?', (a_id,)).fetchone()[0] == 2
+    assert conn.execute("SELECT COUNT(*) FROM boxes WHERE image_id = ? AND model = ''", (a_id,)).fetchone()[0] == 2
+
+    # a deleted file is forgotten, its labels stay
+    label_a.unlink()
+    db.update_db_with_labels(tmp_path / 'labels', db_path, workers=1)
+    assert labels_of(db_path)['a.jpg'] == labels['a.jpg']
+    assert [row[0] for row in conn.execute('SELECT path FROM label_files')] == [str(tmp_path / 'labels' / 'b.txt')]
+    conn.close()
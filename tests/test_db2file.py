@@ -0,0 +1,50 @@
+import errno
+import os
+import pytest
+import database
+import db2file
+import label_ops
+
+LABEL = {'class': 1, 'coordinates': [0.5, 0.5, 0.25, 0.125]}
+
+@pytest.fixture
+def labeled(server_db):
+    """server_db with every image but a2.jpg labeled, returns the image paths by file"""
+    with database.pool.connection() as conn:
+        rows = conn.execute('SELECT i.id, i.file, r.root_dir FROM images AS i JOIN root_dirs AS r ON r.id = i.root_dir_id').fetchall()
+        for image_id, file, _ in rows:
+            label_ops.write_labels(conn, image_id, [] if file == 'a2.jpg' else [LABEL])
+    return {file: os.path.join(root_dir, file) for _, file, root_dir in rows}
+
+def exported(out):
+    return {split: sorted(os.listdir(out / split / 'images')) for split in ('train', 'valid')}
+
+def test_export_splits_and_hardlinks(server_db, labeled, tmp_path):
+    out = tmp_path / 'out'
+    stats = db2file.export_collections(db2file.get_collection_ids(server_db), server_db, out, train_ratio=0.5, workers=2)
+    files = sorted(file for file in labeled if file != 'a2.jpg')
+    splits = {split: [file for file in files if db2file.split_for(file, 0, 0.5) == split] for split in ('train', 'valid')}
+    assert exported(out) == splits and all(splits.values())
+    assert stats == {'train': len(splits['train']), 'valid': len(splits['valid']), 'hardlink': len(files)}
+    for split, names in splits.items():
+        for file in names:
+            assert os.path.samefile(out / split / 'images' / file, labeled[file])
+            assert (out / split / 'labels' / file.replace('.jpg', '.txt')).read_text() == '1 0.5 0.5 0.25 0.125'
+    # a second run replaces the files of the first
+    db2file.export_collections(db2file.get_collection_ids(server_db), server_db, out, train_ratio=0.5, workers=2)
+    assert exported(out) == splits
+
+def test_export_copies_when_links_fail(server_db, labeled, tmp_path, monkeypatch):
+    def cross_device(src, dst):
+        raise OSError(errno.EXDEV, 'cross-device link')
+    monkeypatch.setattr(db2file.os, 'link', cross_device)
+    monkeypatch.setattr(db2file, 'reflink', cross_device)
+    out = tmp_path / 'out'
+    stats = db2file.export_collections(db2file.get_collection_ids(server_db), server_db, out, workers=2)
+    assert stats['copy'] == 5 and 'hardlink' not in stats
+    for split, names in exported(out).items():
+        for file in names:
+            path = out / split / 'images' / file
+            assert not os.path.samefile(path, labeled[file]) and path.read_bytes() == b'jpeg'
+    with pytest.raises(OSError):
+        db2file.export_collections(db2file.get_collection_ids(server_db), server_db, tmp_path / 'linked', mode='hardlink', workers=2)
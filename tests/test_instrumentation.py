@@ -0,0 +1,21 @@
+import sqlite3
+import instrumentation
+from instrumentation import QUERY_SECONDS, TimedConnection, TimedCursor
+
+def query_count(statement):
+    return sum(sum(counts) for key, (counts, _) in QUERY_SECONDS._values.items() if key == (statement,))
+
+def test_connection_execute_is_timed():
+    conn = sqlite3.connect(':memory:', factory=TimedConnection)
+    conn.execute('CREATE TABLE t (x INTEGER)')
+    before = query_count('INSERT t'), query_count('SELECT t')
+    assert isinstance(conn.execute('INSERT INTO t VALUES (1)'), TimedCursor)
+    conn.executemany('INSERT INTO t VALUES (?)', [(2,), (3,)])
+    assert conn.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 3
+    assert query_count('INSERT t') == before[0] + 2
+    assert query_count('SELECT t') == before[1] + 1
+
+def test_statement_label():
+    assert instrumentation.statement_label('SELECT id FROM images WHERE x = 1') == 'SELECT images'
+    assert instrumentation.statement_label('UPDATE OR IGNORE labels SET x = 1') == 'UPDATE labels'
+    assert instrumentation.statement_label('PRAGMA optimize') == 'PRAGMA'
@@ -0,0 +1,110 @@
+import json
+import pytest
+import label_ops
+from label_ops import BulkEditor, RevisionConflict
+
+A = {'class': 0, 'coordinates': [0.2, 0.2, 0.1, 0.1]}
+B = {'class': 1, 'coordinates': [0.7, 0.7, 0.2, 0.2]}
+
+def add_image(conn, file, labels=None, collection_id=1):
+    conn.execute("INSERT OR IGNORE INTO root_dirs (id, root_dir, label_classes) VALUES (?, '/data', 'car person')", (collection_id,))
+    image_id = conn.execute('INSERT INTO images (root_dir_id, file) VALUES (?, ?)', (collection_id, file)).lastrowid
+    if labels is not None:
+        conn.execute('INSERT INTO labels (image_id, labels_json) VALUES (?, ?)', (image_id, json.dumps(labels)))
+    return image_id
+
+def add_prediction(conn, model, file, predictions, loss=0.5):
+    conn.execute("INSERT INTO model_predictions (model, file, base_path, predictions, loss) VALUES (?, ?, '/data', ?, ?)",
+                 (model, file, json.dumps(predictions), loss))
+
+def stored(conn, image_id):
+    labels_json, revision = conn.execute('''SELECT l.labels_json, i.revisions FROM images AS i
+                                            LEFT JOIN labels AS l ON l.image_id = i.id WHERE i.id = ?''', (image_id,)).fetchone()
+    return (json.loads(labels_json) if labels_json else []), revision
+
+def test_write_labels_checks_revision(conn):
+    image_id = add_image(conn, 'a.jpg', [A])
+    assert label_ops.write_labels(conn, image_id, [B], 0) == 1
+    with pytest.raises(RevisionConflict) as e:
+        label_ops.write_labels(conn, image_id, [A], 0)
+    assert e.value.conflicts == [{'image_id': image_id, 'revision': 0, 'current': 1}]
+    assert stored(conn, image_id) == ([B], 1)
+    assert conn.execute("SELECT class_id FROM boxes WHERE image_id = ? AND model = ''", (image_id,)).fetchall() == [(1,)]
+    with pytest.raises(label_ops.UnknownImage):
+        label_ops.write_labels(conn, 999, [A])
+
+def test_conflict_rolls_back_the_batch(conn):
+    first, second = add_image(conn, 'a.jpg', [A]), add_image(conn, 'b.jpg', [A])
+    conn.commit()
+    editor = BulkEditor(conn, {second: 5})
+    with pytest.raises(RevisionConflict) as e:
+        editor.apply([{'op': 'set', 'image_id': first, 'labels': [B]},
+                      {'op': 'remap', 'collection_id': 1, 'classes': {'0': None}}])
+    # the set of the first image went through, remapping the second one was stale
+    assert e.value.conflicts == [{'image_id': second, 'revision': 5, 'current': 0}]
+    conn.rollback()
+    assert stored(conn, first) == ([A], 0)
+    assert stored(conn, second) == ([A], 0)
+
+def test_apply_reports_changes(conn):
+    first, second = add_image(conn, 'a.jpg', [A, B]), add_image(conn, 'b.jpg', [B])
+    editor = BulkEditor(conn)
+    results = editor.apply([{'op': 'remap', 'collection_id': 1, 'classes': {'0': 1}},
+                            {'op': 'filter_size', 'collection_id': 1, 'max_area': 0.02}])
+    assert results == [{'op': 'remap', 'collection_id': 1, 'changed': 1}, {'op': 'filter_size', 'collection_id': 1, 'changed': 2}]
+    assert stored(conn, first) == ([{**A, 'class': 1}], 2)
+    assert stored(conn, second) == ([], 1)
+    assert editor.written == [first, first, second]
+    with pytest.raises(ValueError):
+        editor.apply([{'op': 'rename'}])
+
+@pytest.mark.parametrize('op', [
+    {'op': 'set', 'labels': [A]},
+    {'op': 'set', 'file': 'a.jpg'},
+    {'op': 'remap', 'collection_id': 1},
+    {'op': 'filter_size', 'max_w': 0.1},
+    {'op': 'accept_predictions', 'collection_id': 1},
+])
+def test_malformed_operations_run_nothing(conn, op):
+    image_id = add_image(conn, 'a.jpg', [A])
+    with pytest.raises(ValueError):
+        BulkEditor(conn).apply([{'op': 'set', 'image_id': image_id, 'labels': [B]}, op])
+    assert stored(conn, image_id) == ([A], 0)
+
+def test_set_of_an_unknown_image(conn):
+    with pytest.raises(label_ops.UnknownImage):
+        BulkEditor(conn).apply([{'op': 'set', 'file': 'missing.jpg', 'labels': []}])
+
+@pytest.fixture
+def predicted(conn):
+    """An image with a label and predictions, one without labels and one the model did not see"""
+    labeled, unlabeled, unseen = add_image(conn, 'a.jpg', [A]), add_image(conn, 'b.jpg', []), add_image(conn, 'c.jpg')
+    add_prediction(conn, 'm', 'a.jpg', [{'class': 'car', 'conf': 0.9, 'bbox': [0.21, 0.2, 0.1, 0.1]},
+                                        {'class': 'person', 'conf': 0.8, 'bbox': B['coordinates']}])
+    add_prediction(conn, 'm', 'b.jpg', [{'class': 'person', 'conf': 0.9, 'bbox': B['coordinates']},
+                                        {'class': 'car', 'conf': 0.1, 'bbox': A['coordinates']}])
+    return labeled, unlabeled, unseen
+
+def accept(conn, mode):
+    return BulkEditor(conn).apply([{'op': 'accept_predictions', 'collection_id': 1, 'model': 'm', 'mode': mode, 'min_conf': 0.5}])
+
+def test_accept_missing(conn, predicted):
+    labeled, unlabeled, unseen = predicted
+    assert accept(conn, 'missing')[0]['changed'] == 1
+    assert stored(conn, labeled)[0] == [A]
+    assert stored(conn, unlabeled)[0] == [B]
+    assert stored(conn, unseen) == ([], 0)
+
+def test_accept_replace(conn, predicted):
+    labeled, unlabeled, _ = predicted
+    assert accept(conn, 'replace')[0]['changed'] == 2
+    assert stored(conn, labeled)[0] == [{'class': 0, 'coordinates': [0.21, 0.2, 0.1, 0.1]}, B]
+    assert stored(conn, unlabeled)[0] == [B]
+
+def test_accept_append_skips_covered_predictions(conn, predicted):
+    labeled, unlabeled, _ = predicted
+    assert accept(conn, 'append')[0]['changed'] == 2
+    assert stored(conn, labeled)[0] == [A, B]
+    assert stored(conn, unlabeled)[0] == [B]
+    with pytest.raises(ValueError):
+        accept(conn, 'merge')
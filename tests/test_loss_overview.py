@@ -0,0 +1,44 @@
+import json
+import pytest
+import label_ops
+import loss_overview
+from loss_overview import BUCKET_WIDTH, percentiles
+
+def test_percentiles_interpolate_inside_a_bucket():
+    assert percentiles({10: 4}, (0.5,)) == {'p50': pytest.approx(10.5 * BUCKET_WIDTH)}
+    assert percentiles({10: 4}, (0.25, 1.0)) == {'p25': pytest.approx(10.25 * BUCKET_WIDTH), 'p100': pytest.approx(11 * BUCKET_WIDTH)}
+
+def test_percentiles_walk_the_buckets_in_order():
+    got = percentiles({50: 1, 0: 8, 20: 1}, (0.5, 0.9, 0.99))
+    assert got == {'p50': pytest.approx(5 / 8 * BUCKET_WIDTH), 'p90': pytest.approx(21 * BUCKET_WIDTH),
+                   'p99': pytest.approx(50.9 * BUCKET_WIDTH)}
+
+def test_percentiles_of_nothing():
+    assert percentiles({}) == {'p50': None, 'p90': None, 'p99': None}
+
+def aggregates(conn):
+    summary = conn.execute('''SELECT model, root_dir_id, class_id, count, ROUND(loss_sum, 9), ROUND(loss_sq_sum, 9), tp, fp, fn
+                              FROM loss_summary ORDER BY 1, 2, 3''').fetchall()
+    return summary, conn.execute('SELECT * FROM loss_histogram WHERE count != 0 ORDER BY 1, 2, 3, 4').fetchall()
+
+def test_relabel_matches_a_rebuild(conn):
+    box = lambda cls, x: {'class': cls, 'coordinates': [x, 0.5, 0.1, 0.1]}
+    conn.execute("INSERT INTO root_dirs (id, root_dir, label_classes) VALUES (1, '/data', 'car person')")
+    for i, labels in enumerate([[box(0, 0.2)], [], None, [box(1, 0.6), box(0, 0.2)]]):
+        image_id = conn.execute('INSERT INTO images (root_dir_id, file) VALUES (1, ?)', (f'{i}.jpg',)).lastrowid
+        if labels is not None:
+            conn.execute('INSERT INTO labels (image_id, labels_json) VALUES (?, ?)', (image_id, json.dumps(labels)))
+        for model, loss in (('m1', 0.1 * (i + 1)), ('m2', 0.3 * (i + 1))):
+            predictions = [{'class': 'car', 'conf': 0.9, 'bbox': [0.2, 0.5, 0.1, 0.1]}, {'class': 'person', 'conf': 0.5, 'bbox': [0.4, 0.5, 0.1, 0.1]}]
+            conn.execute("INSERT INTO model_predictions (model, file, base_path, predictions, loss, timestamp) VALUES (?, ?, '/data', ?, ?, '2026-10-01 12:00:00')",
+                         (model, f'{i}.jpg', json.dumps(predictions[:i % 2 + 1]), loss))
+    loss_overview.rebuild_loss_overview(conn)
+    label_ops.write_labels(conn, 1, [box(1, 0.4)])
+    label_ops.write_labels(conn, 2, [box(0, 0.2), box(1, 0.4)])
+    label_ops.write_labels(conn, 3, [])
+    label_ops.write_labels(conn, 4, [])
+    incremental = aggregates(conn)
+    loss_overview.rebuild_loss_overview(conn)
+    assert incremental == aggregates(conn)
+    # the unlabelled images leave every class row they had through their labels
+    assert all(count or tp or fp or fn for *_, count, _, _, tp, fp, fn in incremental[0])
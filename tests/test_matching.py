@@ -0,0 +1,95 @@
+import random
+from typing import Any, Dict, List, Tuple
+import pytest
+from matching import calculate_metrics, calculate_metrics_batch, class_counts_batch
+
+def calculate_iou(box1: List[float], box2: List[float]) -> float:
+    """The per pair IoU of scritps/model_predictions.py before matching.py"""
+    b1_x1, b1_y1 = box1[0] - box1[2]/2, box1[1] - box1[3]/2
+    b1_x2, b1_y2 = box1[0] + box1[2]/2, box1[1] + box1[3]/2
+    b2_x1, b2_y1 = box2[0] - box2[2]/2, box2[1] - box2[3]/2
+    b2_x2, b2_y2 = box2[0] + box2[2]/2, box2[1] + box2[3]/2
+    inter_area = max(min(b1_x2, b2_x2) - max(b1_x1, b2_x1), 0) * max(min(b1_y2, b2_y2) - max(b1_y1, b2_y1), 0)
+    union_area = box1[2] * box1[3] + box2[2] * box2[3] - inter_area
+    return inter_area / union_area if union_area > 0 else 0.0
+
+def reference_metrics(predictions: List[Dict[str, Any]], ground_truth: List[Dict[str, Any]]) -> Tuple[float, float, float, float]:
+    """The loop based calculate_metrics that matching.py replaced"""
+    tp, fp, iou_sum, used_gt = 0, 0, 0.0, set()
+    for pred in predictions:
+        best_iou, best_gt_idx = 0.0, -1
+        for gt_idx, gt in enumerate(ground_truth):
+            if gt_idx in used_gt:
+                continue
+            iou = calculate_iou(pred['bbox'], gt['bbox'])
+            if iou > best_iou and pred['class'] == gt['class']:
+                best_iou, best_gt_idx = iou, gt_idx
+        if best_iou > 0.5:
+            tp += 1
+            used_gt.add(best_gt_idx)
+            iou_sum += best_iou
+        else:
+            fp += 1
+    precision = tp / (tp + fp) if tp + fp > 0 else 0.0
+    recall = tp / len(ground_truth) if ground_truth else 0.0
+    avg_iou = iou_sum / tp if tp > 0 else 0.0
+    class_acc = sum(1 for gt in ground_truth if any(p['class'] == gt['class'] for p in predictions)) / len(ground_truth) if ground_truth else 0.0
+    return precision, recall, avg_iou, class_acc
+
+def random_image(rng: random.Random) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    ground_truth = [{'class': rng.randint(0, 2), 'bbox': [rng.random(), rng.random(), rng.uniform(0.05, 0.4), rng.uniform(0.05, 0.4)]}
+                    for _ in range(rng.randint(0, 6))]
+    predictions = []
+    for _ in range(rng.randint(0, 8)):
+        if ground_truth and rng.random() < 0.7:
+            # jitter a ground truth box so there are hits, near misses and competing predictions
+            gt = rng.choice(ground_truth)
+            bbox = [v + rng.uniform(-0.03, 0.03) for v in gt['bbox'][:2]] + [v * rng.uniform(0.8, 1.2) for v in gt['bbox'][2:]]
+            cls = gt['class'] if rng.random() < 0.8 else rng.randint(0, 2)
+        else:
+            bbox, cls = [rng.random(), rng.random(), rng.uniform(0.05, 0.4), rng.uniform(0.05, 0.4)], rng.randint(0, 2)
+        predictions.append({'class': cls, 'bbox': bbox})
+    return predictions, ground_truth
+
+def test_matches_reference_implementation():
+    rng = random.Random(6)
+    pairs = [random_image(rng) for _ in range(2000)]
+    for got, (predictions, ground_truth) in zip(calculate_metrics_batch(pairs), pairs):
+        assert got == pytest.approx(reference_metrics(predictions, ground_truth), abs=1e-12)
+    for predictions, ground_truth in pairs[:200]:
+        assert calculate_metrics(predictions, ground_truth) == pytest.approx(reference_metrics(predictions, ground_truth), abs=1e-12)
+
+def test_competing_predictions_match_in_order():
+    ground_truth = [{'class': 0, 'bbox': [0.5, 0.5, 0.2, 0.2]}]
+    predictions = [{'class': 0, 'bbox': [0.51, 0.5, 0.2, 0.2]}, {'class': 0, 'bbox': [0.5, 0.5, 0.2, 0.2]}]
+    precision, recall, avg_iou, _ = calculate_metrics(predictions, ground_truth)
+    assert (precision, recall) == (0.5, 1.0)
+    assert avg_iou == pytest.approx(calculate_iou(predictions[0]['bbox'], ground_truth[0]['bbox']))
+
+def test_class_counts_batch():
+    box = lambda cls, x: {'class': cls, 'bbox': [x, 0.5, 0.1, 0.1]}
+    pairs = [
+        ([box(0, 0.2), box(0, 0.6), box(1, 0.4)], [box(0, 0.2), box(1, 0.8)]),
+        ([], [box(0, 0.2), box(1, 0.4)]),
+        ([box(0, 0.2), box(0, 0.2), box(1, 0.4)], []),
+        # same place, other class: a false positive and a false negative, not a match
+        ([box(1, 0.2)], [box(0, 0.2)]),
+    ]
+    assert class_counts_batch(pairs) == [
+        {0: (1, 1, 0), 1: (0, 1, 1)},
+        {0: (0, 0, 1), 1: (0, 0, 1)},
+        {0: (0, 2, 0), 1: (0, 1, 0)},
+        {0: (0, 0, 1), 1: (0, 1, 0)},
+    ]
+    assert class_counts_batch([]) == []
+
+def test_class_counts_agree_with_metrics():
+    rng = random.Random(24)
+    pairs = [random_image(rng) for _ in range(500)]
+    for counts, (predictions, ground_truth) in zip(class_counts_batch(pairs), pairs):
+        tp = sum(c[0] for c in counts.values())
+        assert tp + sum(c[1] for c in counts.values()) == len(predictions)
+        assert tp + sum(c[2] for c in counts.values()) == len(ground_truth)
+        precision, recall, _, _ = reference_metrics(predictions, ground_truth)
+        assert precision == pytest.approx(tp / len(predictions) if predictions else 0.0)
+        assert recall == pytest.approx(tp / len(ground_truth) if ground_truth else 0.0)
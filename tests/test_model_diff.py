@@ -0,0 +1,36 @@
+import json
+import model_diff
+
+def predict(conn, model, file, predictions, loss):
+    conn.execute("INSERT INTO model_predictions (model, file, base_path, predictions, loss) VALUES (?, ?, '/data', ?, ?)",
+                 (model, file, json.dumps(predictions), loss))
+
+def test_class_names_and_ids_are_compared_as_classes(conn):
+    model_diff.create_model_diff(conn)
+    conn.execute("INSERT INTO root_dirs (id, root_dir, label_classes) VALUES (1, '/data', 'car person')")
+    conn.executemany('INSERT INTO images (root_dir_id, file) VALUES (1, ?)', [('same.jpg',), ('flip.jpg',)])
+    box = [0.5, 0.5, 0.2, 0.2]
+    # an older run stored class names, a newer one class ids
+    predict(conn, 'old', 'same.jpg', [{'class': 'car', 'conf': 0.9, 'bbox': box}], 0.4)
+    predict(conn, 'new', 'same.jpg', [{'class_id': 0, 'class': 0, 'conf': 0.9, 'bbox': box}], 0.3)
+    predict(conn, 'old', 'flip.jpg', [{'class': 'car', 'conf': 0.9, 'bbox': box}, {'class': 'person', 'conf': 0.9, 'bbox': [0.1, 0.1, 0.1, 0.1]}], 0.2)
+    predict(conn, 'new', 'flip.jpg', [{'class_id': 1, 'class': 1, 'conf': 0.9, 'bbox': box}], 0.5)
+    assert model_diff.refresh(conn, 'old', 'new') == 2
+    rows = {row['file']: row for row in model_diff.diff_page(conn, 'old', 'new')}
+    assert (rows['same.jpg']['matched'], rows['same.jpg']['class_flips'], rows['same.jpg']['changes']) == (1, 0, 0)
+    assert (rows['flip.jpg']['matched'], rows['flip.jpg']['class_flips'], rows['flip.jpg']['lost']) == (1, 1, 1)
+    assert rows['flip.jpg']['loss_delta'] == 0.5 - 0.2
+    assert [row['file'] for row in model_diff.diff_page(conn, 'old', 'new', 'class_flips')] == ['flip.jpg', 'same.jpg']
+
+def test_prediction_changes_are_picked_up(conn):
+    model_diff.create_model_diff(conn)
+    conn.execute("INSERT INTO root_dirs (id, root_dir, label_classes) VALUES (1, '/data', 'car')")
+    conn.execute("INSERT INTO images (root_dir_id, file) VALUES (1, 'a.jpg')")
+    predict(conn, 'a', 'a.jpg', [], 0.1)
+    predict(conn, 'b', 'a.jpg', [], 0.1)
+    assert model_diff.refresh(conn, 'a', 'b') == 1
+    assert model_diff.refresh(conn, 'a', 'b') == 0
+    conn.execute("UPDATE model_predictions SET predictions = ? WHERE model = 'b'", (json.dumps([{'class': 'car', 'bbox': [0.5, 0.5, 0.1, 0.1]}]),))
+    assert model_diff.diff_page(conn, 'a', 'b') == []
+    assert model_diff.refresh(conn, 'a', 'b') == 1
+    assert model_diff.diff_summary(conn, 'a', 'b')['gained'] == 1
@@ -0,0 +1,175 @@
+import json
+import math
+import struct
+import numpy as np
+import pytest
+import database
+import embeddings
+import server
+
+def image_ids(server_db):
+    with database.pool.connection() as conn:
+        return {row['file']: row['id'] for row in conn.execute('SELECT id, file FROM images')}
+
+def test_bulk_labels_status_codes(client, server_db):
+    a0 = image_ids(server_db)['a0.jpg']
+    label = {'class': 0, 'coordinates': [0.5, 0.5, 0.1, 0.1]}
+    assert client.post('/bulk_labels', json={'operations': [{'op': 'remap', 'classes': {'0': 1}}]}).status_code == 400
+    assert client.post('/bulk_labels', json={'operations': [{'op': 'set', 'labels': [label]}]}).status_code == 400
+    assert client.post('/bulk_labels', json={'operations': [{'op': 'explode'}]}).status_code == 400
+    assert client.post('/bulk_labels', json={'operations': [{'op': 'set', 'file': 'nope.jpg', 'labels': []}]}).status_code == 404
+    stale = client.post('/bulk_labels', json={'operations': [{'op': 'set', 'image_id': a0, 'labels': [label], 'revision': 3}]})
+    assert stale.status_code == 409 and stale.get_json()['conflicts'][0]['image_id'] == a0
+    dry = client.post('/bulk_labels', json={'operations': [{'op': 'set', 'image_id': a0, 'labels': [label]}], 'dry_run': True})
+    assert dry.status_code == 200 and client.get('/labels/a0.jpg').get_json() == []
+    done = client.post('/bulk_labels', json={'operations': [{'op': 'set', 'image_id': a0, 'labels': [label, label]}]})
+    assert done.get_json()['results'] == [{'op': 'set', 'image_id': a0, 'changed': 1, 'revision': 1}]
+    assert client.get('/labels/a0.jpg').get_json() == [label]
+
+def collection_id(name):
+    with database.pool.connection() as conn:
+        return conn.execute("SELECT id FROM root_dirs WHERE root_dir LIKE ?", (f'%/{name}',)).fetchone()['id']
+
+def add_predictions(losses, model='m'):
+    with database.pool.connection() as conn:
+        database.create_model_predictions(conn)
+        conn.executemany("INSERT INTO model_predictions (model, file, base_path, predictions, loss) VALUES (?, ?, '/data', '[]', ?)",
+                         [(model, file, loss) for file, loss in losses.items()])
+
+def walk_listing(client, url, limit, **params):
+    files, cursor = [], None
+    while True:
+        page = client.get(url, query_string={'limit': limit, **params, **({'cursor': cursor} if cursor else {})}).get_json()
+        files += [(image['file'], image['loss']) for image in page['images']]
+        cursor = page['next_cursor']
+        if cursor is None:
+            return files
+
+def test_keyset_pages_follow_the_listing_order(client, server_db):
+    add_predictions({'a0.jpg': 0.5, 'a2.jpg': 0.9, 'b0.jpg': 2.0})
+    url = f"/images/{collection_id('a')}"
+    expected = [('a2.jpg', 0.9), ('a0.jpg', 0.5), ('a1.jpg', None)]
+    assert client.get(url).get_json() == {'model': 'm', 'images': [{'file': f, 'loss': l} for f, l in expected], 'next_cursor': None}
+    for limit in (1, 2, 3):
+        assert walk_listing(client, url, limit) == expected
+    # a page after a cursor ends with the rows added before the cursor position
+    first = client.get(url, query_string={'limit': 1}).get_json()
+    add_predictions({'a1.jpg': 0.1})
+    assert [i['file'] for i in client.get(url, query_string={'cursor': first['next_cursor']}).get_json()['images']] == ['a0.jpg', 'a1.jpg']
+
+def test_bad_cursors_are_rejected(client, server_db):
+    add_predictions({'a0.jpg': 0.5})
+    encode = server.encode_cursor
+    for cursor in ('not a cursor', encode({'l': 1}), encode(['x', 1]), encode(['l', 'high', 1]), encode(['l', 0.5]),
+                   encode(['n', True]), encode(['n', 1.5]), encode(['n', 1, 2])):
+        assert client.get('/images/1', query_string={'cursor': cursor}).status_code == 400, cursor
+    assert client.get('/images/1', query_string={'cursor': encode(['l', 0.5, 1])}).status_code == 200
+    assert client.get('/images/1', query_string={'cursor': encode(['n', 1])}).status_code == 200
+
+def read_binary(data):
+    """(files, losses) of the binary row frames and the cursor of the closing frame"""
+    files, losses, offset = [], [], 0
+    while True:
+        rows, name_length = struct.unpack_from('<II', data, offset)
+        offset += 8
+        values = struct.unpack_from(f'<{rows}f', data, offset)
+        offset += 4 * rows
+        names = data[offset:offset + name_length].decode()
+        offset += name_length
+        if not rows:
+            assert offset == len(data)
+            return files, losses, names or None
+        files += names.split('\n')
+        losses += [None if math.isnan(v) else round(v, 6) for v in values]
+
+def streamed(client, url, fmt, **params):
+    """(files, losses, next_cursor) of a streamed listing"""
+    response = client.get(url, query_string={'format': fmt, **params})
+    assert response.status_code == 200 and response.mimetype == server.LISTING_FORMATS[fmt]
+    if fmt == 'binary':
+        return read_binary(response.data)
+    *lines, end = [json.loads(line) for line in response.data.decode().splitlines()]
+    if fmt == 'ndjson':
+        return [line['file'] for line in lines], [line['loss'] for line in lines], end['next_cursor']
+    return sum((line['files'] for line in lines), []), sum((line['losses'] for line in lines), []), end['next_cursor']
+
+@pytest.mark.parametrize('fmt', [fmt for fmt in server.LISTING_FORMATS if fmt != 'json'])
+def test_streamed_listing_formats(client, server_db, monkeypatch, fmt):
+    monkeypatch.setattr(server, 'STREAM_BLOCK', 2)
+    add_predictions({'a0.jpg': 0.5, 'a2.jpg': 0.25})
+    url = f"/images/{collection_id('a')}"
+    files, losses = ['a0.jpg', 'a2.jpg', 'a1.jpg'], [0.5, 0.25, None]
+    assert streamed(client, url, fmt) == (files, losses, None)
+    *first, cursor = streamed(client, url, fmt, limit=2)
+    assert first == [files[:2], losses[:2]] and cursor
+    assert streamed(client, url, fmt, cursor=cursor) == (files[2:], losses[2:], None)
+    assert streamed(client, url, fmt, cursor=cursor, limit=1) == (files[2:], losses[2:], server.encode_cursor(['n', image_ids(server_db)['a1.jpg']]))
+
+def test_unknown_listing_format(client, server_db):
+    assert client.get('/images/1', query_string={'format': 'xml'}).status_code == 400
+
+def search(client, **params):
+    """Files of the matching images, which come in image id order"""
+    images = client.get('/search', query_string=params).get_json()['images']
+    assert [image['image_id'] for image in images] == sorted(image['image_id'] for image in images)
+    return sorted(image['file'] for image in images)
+
+def test_search_matches_paths_and_filters(client, server_db):
+    a = collection_id('a')
+    assert search(client, q='b1.jpg') == ['b1.jpg']
+    # any part of the path, the collection directory included
+    assert search(client, q='/a/a') == ['a0.jpg', 'a1.jpg', 'a2.jpg']
+    assert search(client, q='s/b') == ['b0.jpg', 'b1.jpg', 'b2.jpg']
+    # shorter than a trigram falls back to the file name
+    assert search(client, q='2.') == ['a2.jpg', 'b2.jpg']
+    # query syntax is matched literally
+    assert search(client, q='"jpg OR') == [] and search(client, q='a0*') == []
+    assert search(client, prefix='b') == ['b0.jpg', 'b1.jpg', 'b2.jpg']
+    assert search(client, q='jpg', collection_id=a) == ['a0.jpg', 'a1.jpg', 'a2.jpg']
+    label = {'class': 1, 'coordinates': [0.5, 0.5, 0.1, 0.1]}
+    client.post('/bulk_labels', json={'operations': [{'op': 'set', 'file': 'a1.jpg', 'labels': [label]},
+                                                     {'op': 'set', 'file': 'b2.jpg', 'labels': [label, {**label, 'class': 0}]}]})
+    assert search(client, q='jpg', labeled=1) == ['a1.jpg', 'b2.jpg']
+    assert search(client, q='jpg', **{'class': 0}) == ['b2.jpg']
+    assert search(client, q='jpg', not_class=1) == ['a0.jpg', 'a2.jpg', 'b0.jpg', 'b1.jpg']
+    assert search(client, min_boxes=2) == ['b2.jpg']
+
+def test_search_pages_and_follows_renames(client, server_db):
+    pages, cursor = [], 0
+    while cursor is not None:
+        page = client.get('/search', query_string={'q': 'jpg', 'limit': 4, 'cursor': cursor}).get_json()
+        pages.append([image['file'] for image in page['images']])
+        cursor = page['next_cursor']
+    assert [len(page) for page in pages] == [4, 2] and sorted(sum(pages, [])) == sorted(image_ids(server_db))
+    with database.pool.connection() as conn:
+        conn.execute("UPDATE images SET file = 'renamed.jpg' WHERE file = 'a0.jpg'")
+        conn.execute("INSERT INTO images (root_dir_id, file) VALUES (?, 'added.jpg')", (collection_id('b'),))
+    assert search(client, q='renamed') == ['renamed.jpg'] and search(client, q='a0.jpg') == []
+    assert search(client, q='/b/added') == ['added.jpg']
+
+@pytest.fixture
+def embedded(server_db, tmp_path, monkeypatch):
+    """Embeddings of model m for a0, a1 and b0 in a temporary cache, a0 and b0 close to each other"""
+    root = tmp_path / 'embeddings'
+    models = embeddings.models
+    monkeypatch.setattr(embeddings, 'models', lambda root=root: models(root))
+    store = embeddings.EmbeddingStore('m', root)
+    monkeypatch.setitem(embeddings._stores, 'm', store)
+    ids = image_ids(server_db)
+    store.append([ids['a0.jpg'], ids['a1.jpg'], ids['b0.jpg']], np.array([[1, 0, 0], [0, 1, 0], [0.9, 0.1, 0]], dtype=np.float32))
+    add_predictions({'a0.jpg': 0.5}, model='m')
+    add_predictions({'a0.jpg': 0.5}, model='plain')
+    return ids
+
+def test_similar_images(client, embedded):
+    hits = client.get('/similar/a0.jpg', query_string={'model': 'm', 'k': 1}).get_json()
+    assert hits['model'] == 'm' and [(hit['file'], hit['image_id']) for hit in hits['images']] == [('b0.jpg', embedded['b0.jpg'])]
+    assert [hit['file'] for hit in client.get('/similar/a0.jpg', query_string={'model': 'm'}).get_json()['images']] == ['b0.jpg', 'a1.jpg']
+
+def test_similar_without_embeddings(client, embedded):
+    # the latest model has predictions but was never embedded
+    response = client.get('/similar/a0.jpg')
+    assert response.status_code == 404 and 'plain' in response.get_data(as_text=True)
+    assert client.get('/similar/a0.jpg', query_string={'model': 'unknown'}).status_code == 404
+    assert client.get('/similar/a2.jpg', query_string={'model': 'm'}).status_code == 404
+    assert client.get('/similar/missing.jpg', query_string={'model': 'm'}).status_code == 404
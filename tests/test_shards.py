@@ -0,0 +1,49 @@
+import io
+import json
+import numpy as np
+import pytest
+from PIL import Image
+import shards
+from shards import ShardReader, ShardWriter
+
+def png(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (4, 3), color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def test_round_trip_across_shards(tmp_path):
+    samples = [(f'{i}.jpg', bytes(range(i % 7 + 1)) * (i + 1),
+                shards.boxes_array([{'class': c, 'coordinates': [0.1 * c, 0.2, 0.3, 0.4]} for c in range(i % 3)]))
+               for i in range(10)]
+    with ShardWriter(tmp_path, 'train', shard_bytes=64, metadata={'seed': 3}) as writer:
+        for sample in samples:
+            writer.add(*sample)
+    manifest = json.loads((tmp_path / 'index.json').read_text())
+    assert manifest['seed'] == 3 and manifest['box_fields'] == list(shards.BOX_FIELDS)
+    assert len(manifest['shards']) > 1 and sum(shard['count'] for shard in manifest['shards']) == len(samples)
+    reader = ShardReader(tmp_path)
+    assert len(reader) == len(samples)
+    for (name, image, box_array), (got_name, got_image, got_boxes) in zip(samples, reader):
+        assert (got_name, bytes(got_image)) == (name, image)
+        assert got_boxes.shape == (len(box_array), 5) and np.array_equal(got_boxes, box_array)
+        assert not got_boxes.flags.writeable
+    assert reader[-1][0] == '9.jpg' and reader.locate(len(samples) - 1) == (len(manifest['shards']) - 1, manifest['shards'][-1]['count'] - 1)
+    with pytest.raises(IndexError):
+        reader[len(samples)]
+    # the mapping can only be closed once no view into it is left
+    del got_image, got_boxes
+    reader.close()
+
+def test_images_decode_and_versions_are_checked(tmp_path):
+    with ShardWriter(tmp_path / 'valid') as writer:
+        writer.add('red.png', png('red'), shards.boxes_array([]))
+    reader = ShardReader(tmp_path / 'valid' / 'index.json')
+    assert reader.image(0).getpixel((0, 0)) == (255, 0, 0) and reader[0][2].shape == (0, 5)
+    reader.close()
+    with ShardWriter(tmp_path / 'empty') as writer:
+        pass
+    assert len(ShardReader(tmp_path / 'empty')) == 0
+    manifest = json.loads((tmp_path / 'valid' / 'index.json').read_text())
+    (tmp_path / 'valid' / 'index.json').write_text(json.dumps({**manifest, 'version': shards.FORMAT_VERSION + 1}))
+    with pytest.raises(ValueError):
+        ShardReader(tmp_path / 'valid')
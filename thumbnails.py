@@ -0,0 +1,147 @@
+import os
+import sys
+import hashlib
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+from PIL import Image
+import database
+
+THUMB_SIZES: Tuple[int, ...] = (128, 256, 512)
+CACHE_DIR: Path = Path(__file__).parent / "cache" / "thumbs"
+MAX_CACHE_BYTES: int = 2 * 1024**3
+JPEG_QUALITY: int = 85
+
+def cache_key(image_path: Path) -> str:
+    """Key a source image by its path, size and mtime, so edits produce a new key"""
+    st = os.stat(image_path)
+    return hashlib.sha1(f"{os.path.abspath(image_path)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()
+
+def thumb_path(cache_dir: Path, key: str, size: int) -> Path:
+    return Path(cache_dir) / key[:2] / f"{key}_{size}.jpg"
+
+def build_pyramid(image_path: Path, cache_dir: Path, key: str, sizes: Tuple[int, ...]) -> int:
+    """Write every thumbnail size for one image, returns the change in cache bytes.
+
+    Runs in a worker process. The image is decoded once (with JPEG draft mode
+    so the decoder already downscales) and each size is resized from the
+    previous, larger one.
+    """
+    delta = 0
+    with Image.open(image_path) as img:
+        img.draft("RGB", (max(sizes), max(sizes)))
+        img = img.convert("RGB")
+        for size in sorted(sizes, reverse=True):
+            img.thumbnail((size, size))
+            out = thumb_path(cache_dir, key, size)
+            out.parent.mkdir(parents=True, exist_ok=True)
+            old_size = out.stat().st_size if out.exists() else 0
+            tmp = out.with_suffix(f".{os.getpid()}.tmp")
+            img.save(tmp, "JPEG", quality=JPEG_QUALITY, optimize=True)
+            delta += tmp.stat().st_size - old_size
+            os.replace(tmp, out)
+    return delta
+
+class ThumbnailCache:
+    """Content-addressed on-disk thumbnail cache with size-bounded eviction.
+
+    Thumbnails are built in a background process pool, either ahead of time
+    through `warm` or lazily on the first `get`. When the cache grows past
+    `max_bytes` the least recently served files are removed.
+    """
+
+    def __init__(self, cache_dir: Path = CACHE_DIR, sizes: Tuple[int, ...] = THUMB_SIZES,
+                 max_bytes: int = MAX_CACHE_BYTES, workers: Optional[int] = None) -> None:
+        self.cache_dir: Path = Path(cache_dir)
+        self.sizes: Tuple[int, ...] = tuple(sizes)
+        self.max_bytes: int = max_bytes
+        self.workers: Optional[int] = workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pending: Dict[str, Future] = {}
+        self._bytes: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def _cache_bytes(self) -> int:
+        if self._bytes is None:
+            self._bytes = sum(p.stat().st_size for p in self.cache_dir.rglob("*.jpg")) if self.cache_dir.exists() else 0
+        return self._bytes
+
+    def _submit(self, image_path: Path, key: str) -> Future:
+        with self._lock:
+            fut = self._pending.get(key)
+            if fut is None:
+                fut = self._executor().submit(build_pyramid, Path(image_path), self.cache_dir, key, self.sizes)
+                fut.add_done_callback(lambda f, key=key: self._built(key, f))
+                self._pending[key] = fut
+            return fut
+
+    def _built(self, key: str, fut: Future) -> None:
+        with self._lock:
+            self._pending.pop(key, None)
+            if fut.exception() is None:
+                self._bytes = self._cache_bytes() + fut.result()
+            over = self._cache_bytes() > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently served thumbnails until the cache is below 90% of max_bytes"""
+        files = sorted((p.stat().st_mtime, p.stat().st_size, p) for p in self.cache_dir.rglob("*.jpg"))
+        total = sum(size for _, size, _ in files)
+        target = int(self.max_bytes * 0.9)
+        for _, size, p in files:
+            if total <= target:
+                break
+            p.unlink(missing_ok=True)
+            total -= size
+        with self._lock:
+            self._bytes = total
+
+    def get(self, image_path: Path, size: int, timeout: Optional[float] = None) -> Path:
+        if size not in self.sizes:
+            raise ValueError(f"unsupported thumbnail size {size}, expected one of {self.sizes}")
+        key = cache_key(image_path)
+        out = thumb_path(self.cache_dir, key, size)
+        if not out.exists():
+            self._submit(image_path, key).result(timeout=timeout)
+        else:
+            # the file mtime doubles as the last-served time for eviction
+            os.utime(out)
+        return out
+
+    def warm(self, image_paths: Iterable[Path]) -> int:
+        """Queue pyramid builds for images that have no thumbnails yet, returns how many were queued"""
+        queued = 0
+        for image_path in image_paths:
+            try:
+                key = cache_key(image_path)
+            except FileNotFoundError:
+                continue
+            if all(thumb_path(self.cache_dir, key, size).exists() for size in self.sizes):
+                continue
+            self._submit(image_path, key)
+            queued += 1
+        return queued
+
+    def wait(self) -> None:
+        with self._lock:
+            pending = list(self._pending.values())
+        for fut in pending:
+            fut.exception()
+
+cache: ThumbnailCache = ThumbnailCache()
+
+if __name__ == "__main__":
+    # build thumbnails for every image already in the db
+    db_name = sys.argv[1] if len(sys.argv) > 1 else database.DB_PATH
+    conn = database.connect(db_name)
+    rows = conn.execute('SELECT r.root_dir, i.file FROM root_dirs as r JOIN images as i on r.id = i.root_dir_id').fetchall()
+    conn.close()
+    print(f"queued {cache.warm(Path(root_dir) / file for root_dir, file in rows)} of {len(rows)} images")
+    cache.wait()
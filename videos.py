@@ -0,0 +1,205 @@
+import os
+import json
+import math
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+from PIL import Image
+from thumbnails import cache_key, JPEG_QUALITY
+
+VIDEO_PATH: Path = Path(os.environ.get("HINT_VIDEOS", "/home/newton/repo/Football-Analysis-using-YOLO/output_videos"))
+CACHE_DIR: Path = Path(__file__).parent / "cache" / "videos"
+MIMETYPES: Dict[str, str] = {'.mp4': 'video/mp4', '.webm': 'video/webm', '.ogg': 'video/ogg'}
+POSTER_WIDTH: int = 320
+SPRITE_TILE_WIDTH: int = 160
+SPRITE_COLUMNS: int = 10
+SPRITE_FRAMES: int = 100
+
+def _read_frame(capture: Any, index: int) -> Optional[Image.Image]:
+    import cv2
+    capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+    ok, frame = capture.read()
+    if not ok:
+        return None
+    return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+def _save(img: Image.Image, out: Path) -> None:
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out.with_suffix(f".{os.getpid()}.tmp")
+    img.save(tmp, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    os.replace(tmp, out)
+
+def build_poster(video_path: Path, out: Path) -> None:
+    """Write a poster frame taken a tenth into the video, runs in a worker process"""
+    import cv2
+    capture = cv2.VideoCapture(str(video_path))
+    try:
+        frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        img = _read_frame(capture, frames // 10)
+        if img is None:
+            img = _read_frame(capture, 0)
+    finally:
+        capture.release()
+    if img is None:
+        raise ValueError(f"could not decode a frame from {video_path}")
+    img.thumbnail((POSTER_WIDTH, POSTER_WIDTH))
+    _save(img, out)
+
+def build_sprite(video_path: Path, out: Path) -> None:
+    """Write a sprite sheet of evenly spaced frames and its layout as json next to it.
+
+    Runs in a worker process. The player maps a time t to tile
+    int(t / interval), so scrubbing only needs this one image.
+    """
+    import cv2
+    capture = cv2.VideoCapture(str(video_path))
+    try:
+        frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        count = max(1, min(SPRITE_FRAMES, frames))
+        step = max(1, frames // count)
+        tiles = []
+        for index in range(0, step * count, step):
+            img = _read_frame(capture, index)
+            if img is None: break
+            img.thumbnail((SPRITE_TILE_WIDTH, SPRITE_TILE_WIDTH))
+            tiles.append(img)
+    finally:
+        capture.release()
+    if not tiles:
+        raise ValueError(f"could not decode a frame from {video_path}")
+    tile_w, tile_h = tiles[0].size
+    columns = min(SPRITE_COLUMNS, len(tiles))
+    rows = math.ceil(len(tiles) / columns)
+    sheet = Image.new("RGB", (columns * tile_w, rows * tile_h))
+    for i, tile in enumerate(tiles):
+        sheet.paste(tile, ((i % columns) * tile_w, (i // columns) * tile_h))
+    layout = {'tiles': len(tiles), 'columns': columns, 'rows': rows,
+              'tile_width': tile_w, 'tile_height': tile_h, 'interval': step / fps}
+    # the layout goes first, a sprite on disk always has its layout
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.with_suffix('.json').write_text(json.dumps(layout))
+    _save(sheet, out)
+
+BUILDERS = {'poster': build_poster, 'sprite': build_sprite}
+
+class VideoCatalogue:
+    """Video listing of one directory with poster and sprite images in a disk cache.
+
+    The listing is rebuilt only when the directory mtime changes, which is
+    when files are added, removed or renamed. New videos get their poster and
+    sprite built in a background process pool.
+    """
+
+    def __init__(self, video_dir: Path = VIDEO_PATH, cache_dir: Path = CACHE_DIR, workers: Optional[int] = 2) -> None:
+        self.video_dir: Path = Path(video_dir)
+        self.cache_dir: Path = Path(cache_dir)
+        self.workers: Optional[int] = workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pending: Dict[Tuple[str, str], Future] = {}
+        self._failed: Set[Path] = set()
+        self._dir_mtime: Optional[int] = None
+        self._videos: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def _scan(self) -> Dict[str, Dict[str, Any]]:
+        videos = {}
+        with os.scandir(self.video_dir) as it:
+            for entry in it:
+                suffix = os.path.splitext(entry.name)[1].lower()
+                if suffix not in MIMETYPES or not entry.is_file(): continue
+                st = entry.stat()
+                videos[entry.name] = {
+                    'title': os.path.splitext(entry.name)[0],
+                    'filename': entry.name,
+                    'size': st.st_size,
+                    'mtime': st.st_mtime,
+                    'mimetype': MIMETYPES[suffix],
+                    'thumbnailPath': f'/video_poster/{entry.name}',
+                    'spritePath': f'/video_sprite/{entry.name}',
+                }
+        return videos
+
+    def videos(self) -> List[Dict[str, Any]]:
+        try:
+            dir_mtime = os.stat(self.video_dir).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        with self._lock:
+            if dir_mtime != self._dir_mtime:
+                self._videos, self._dir_mtime = self._scan(), dir_mtime
+                fresh = True
+            else:
+                fresh = False
+            videos = list(self._videos.values())
+        if fresh:
+            for video in videos:
+                for kind in BUILDERS:
+                    self._submit(video['filename'], kind)
+        return videos
+
+    def path_for(self, filename: str) -> Optional[Path]:
+        """Path of a listed video, None for anything else so requests cannot leave the video directory"""
+        self.videos()
+        return self.video_dir / filename if filename in self._videos else None
+
+    def _cached(self, filename: str, kind: str) -> Path:
+        key = cache_key(self.video_dir / filename)
+        return self.cache_dir / key[:2] / f"{key}_{kind}.jpg"
+
+    def _submit(self, filename: str, kind: str) -> Optional[Future]:
+        try:
+            out = self._cached(filename, kind)
+        except FileNotFoundError:
+            return None
+        if out.exists():
+            return None
+        with self._lock:
+            # a failed build is not retried until the video changes, which changes out
+            if out in self._failed:
+                return None
+            fut = self._pending.get((filename, kind))
+            if fut is None:
+                fut = self._executor().submit(BUILDERS[kind], self.video_dir / filename, out)
+                fut.add_done_callback(lambda f, k=(filename, kind), out=out: self._built(k, out, f))
+                self._pending[(filename, kind)] = fut
+            return fut
+
+    def _built(self, pending_key: Tuple[str, str], out: Path, fut: Future) -> None:
+        with self._lock:
+            self._pending.pop(pending_key, None)
+            if fut.exception() is not None:
+                self._failed.add(out)
+
+    def image(self, filename: str, kind: str, timeout: Optional[float] = None) -> Optional[Path]:
+        """Cached poster or sprite of a video, waits up to timeout for a build.
+
+        Returns None while the build is still running or when it failed,
+        e.g. for a video OpenCV cannot decode.
+        """
+        if self.path_for(filename) is None:
+            raise FileNotFoundError(filename)
+        fut = self._submit(filename, kind)
+        if fut is not None:
+            try:
+                fut.exception(timeout=timeout)
+            except TimeoutError:
+                return None
+        out = self._cached(filename, kind)
+        return out if out.exists() else None
+
+    def building(self, filename: str, kind: str) -> bool:
+        with self._lock:
+            return (filename, kind) in self._pending
+
+    def sprite_layout(self, filename: str) -> Optional[Dict[str, Any]]:
+        sprite = self.image(filename, 'sprite', timeout=0)
+        return json.loads(sprite.with_suffix('.json').read_text()) if sprite else None
+
+catalogue: VideoCatalogue = VideoCatalogue()